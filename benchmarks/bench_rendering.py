@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+    Micro-benchmark for HTML result rendering.
+
+    Compares ``render_table`` against the previous ``+=`` based renderer
+    for a range of displayed row counts::
+
+        $ python -m benchmarks.bench_rendering --repeat 5
+
+"""
+import argparse
+import timeit
+
+from xml.sax.saxutils import escape as xml_escape
+
+from bux_sql_grader.rendering import render_table
+
+ROW_COUNTS = (10, 100, 10000)
+
+COLS = (u"playerID", u"yearID", u"teamID", u"lgID", u"G", u"AB", u"R",
+        u"H", u"HR", u"notes")
+
+
+def make_results(row_count):
+    """ Generate a synthetic result set shaped like the Batting table """
+    rows = []
+    for idx in xrange(row_count):
+        rows.append((u"player%05d" % idx, u"2013", u"BOS", u"AL",
+                     unicode(idx % 162), unicode(idx % 600), unicode(idx % 90),
+                     unicode(idx % 200), unicode(idx % 40),
+                     None if idx % 7 else u"R&D <traded>"))
+    return COLS, tuple(rows)
+
+
+def legacy_format_col(col):
+    formatted = xml_escape(unicode(col))
+    if col is None:
+        formatted = "NULL"
+    return formatted
+
+
+def legacy_render_table(cols, rows, row_limit=None):
+    """ The string concatenation renderer ``render_table`` replaced """
+    html = "<pre><code><table><thead>"
+    html += u"<tr><th>{}</th></tr>".format(u"</th><th>".join(legacy_format_col(col) for col in cols))
+    html += "</thead><tbody>"
+
+    for idx, row in enumerate(rows):
+        if row_limit and idx >= row_limit:
+            break
+        html += u"<tr><td>{}</td></tr>".format(
+                u"</td><td>".join(legacy_format_col(col) for col in row))
+
+    html += "</tbody></table></code></pre>"
+    return html
+
+
+def run(repeat=3, number=10):
+    """ Time both renderers, returning a list of result dicts """
+    results = []
+    for row_count in ROW_COUNTS:
+        cols, rows = make_results(row_count)
+
+        # Sanity check: both renderers must produce identical markup
+        assert render_table(cols, rows)[0] == legacy_render_table(cols, rows)
+
+        for name, func in (("render_table", lambda: render_table(cols, rows)),
+                           ("legacy", lambda: legacy_render_table(cols, rows))):
+            best = min(timeit.repeat(func, repeat=repeat, number=number))
+            results.append({"renderer": name, "rows": row_count,
+                            "msec": best / number * 1000})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark HTML result rendering")
+    parser.add_argument("--repeat", default=3, type=int, help="timing repetitions")
+    parser.add_argument("--number", default=10, type=int, help="renders per repetition")
+    args = parser.parse_args()
+
+    print "%-14s %8s %12s" % ("renderer", "rows", "msec/render")
+    for result in run(args.repeat, args.number):
+        print "%-14s %8d %12.3f" % (result["renderer"], result["rows"], result["msec"])
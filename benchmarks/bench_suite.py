@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+    Offline micro-benchmarks for the grading pipeline.
+
+    Times scoring, HTML rendering, CSV generation and query filtering on
+    synthetic result sets, without a database, queue or S3::
+
+        $ python -m benchmarks.bench_suite --output before.json
+        $ python -m benchmarks.bench_suite --baseline before.json --max-regression 0.2
+
+    With ``--baseline`` the run fails (exit status 1) if any benchmark is
+    more than ``--max-regression`` slower than in the baseline file.
+
+"""
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import timeit
+
+from bux_sql_grader.metrics import configure_statsd
+from bux_sql_grader.mysql import MySQLEvaluator
+from bux_sql_grader.scoring import MySQLRubricScorer
+
+#: (rows, columns) of the synthetic result sets
+SIZES = ((10, 3), (1000, 3), (1000, 20), (10000, 10))
+QUICK_SIZES = ((10, 3), (1000, 10))
+
+QUERIES = {
+    "simple": u"SELECT * FROM Batting",
+    "join": (u"SELECT m.nameFirst, m.nameLast, b.yearID, b.HR "
+             u"FROM Master m JOIN Batting b ON m.playerID = b.playerID "
+             u"WHERE b.yearID = '2010' ORDER BY b.HR DESC LIMIT 50000"),
+    "long": (u"SELECT playerID, yearID FROM Batting WHERE " +
+             u" OR ".join(u"(HR > %d AND teamID = 'T%02d')" % (i, i)
+                          for i in range(200)) +
+             u" LIMIT 10, 20000; SELECT 1"),
+}
+
+#: Seconds each timing repetition should take at least
+MIN_SAMPLE_TIME = 0.05
+
+
+def make_results(row_count, width, seed=0):
+    """ Generates a synthetic ``(cols, rows)`` result set.
+
+    Values mimic what ``MySQLEvaluator.db_converter`` produces: unicode
+    strings for most types, floats for DOUBLE columns and ``None`` for NULL.
+
+    """
+    rand = random.Random(seed)
+    cols = tuple(u"col%d" % i for i in range(width))
+    rows = []
+    for idx in xrange(row_count):
+        row = []
+        for col in range(width):
+            kind = col % 5
+            if kind == 0:
+                row.append(unicode(idx))
+            elif kind == 1:
+                row.append(u"name %d & <co>" % rand.randint(0, 1000))
+            elif kind == 2:
+                row.append(rand.random() * 1000)
+            elif kind == 3:
+                row.append(None if rand.random() < 0.1 else u"2013-01-01")
+            else:
+                row.append(u"\xe9t\xe9 %s" % (u"x" * rand.randint(0, 40)))
+        rows.append(tuple(row))
+    return cols, tuple(rows)
+
+
+def make_evaluator():
+    return MySQLEvaluator(database="bench", host="localhost", user="bench",
+                          passwd="", s3_upload=False)
+
+
+def time_call(func, repeat):
+    """ Returns the best time per call of ``func`` in milliseconds """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= MIN_SAMPLE_TIME or number >= 1000000:
+            break
+        number *= 10
+
+    best = min([elapsed] + timeit.repeat(func, repeat=repeat - 1, number=number))
+    return best / number * 1000
+
+
+def benchmarks(sizes):
+    """ Generates ``(name, callable)`` pairs for each benchmark """
+    grader = make_evaluator()
+    grader_answer = QUERIES["simple"]
+
+    for row_count, width in sizes:
+        results = make_results(row_count, width)
+        shuffled = list(results[1])
+        random.Random(1).shuffle(shuffled)
+        unsorted = (results[0], tuple(shuffled))
+        label = "rows=%d,cols=%d" % (row_count, width)
+
+        def score(student_results, results=results):
+            scorer = MySQLRubricScorer(grader_answer, student_results,
+                                       grader_answer, results)
+            scorer.score()
+            scorer.close()
+
+        yield ("score_match[%s]" % label,
+               lambda results=results: score(results))
+        yield ("score_unsorted[%s]" % label,
+               lambda unsorted=unsorted: score(unsorted))
+        yield ("html_results[%s]" % label,
+               lambda results=results: grader.html_results(results, 10))
+        yield ("html_results_all[%s]" % label,
+               lambda results=results: grader.html_results(results))
+        yield ("csv_results[%s]" % label,
+               lambda results=results: grader.csv_results(results))
+
+    for name, query in sorted(QUERIES.items()):
+        yield ("filter_query[%s]" % name,
+               lambda query=query: grader.filter_query(query))
+        yield ("enforce_select_limit[%s]" % name,
+               lambda query=query: grader.enforce_select_limit(query))
+
+
+def run(sizes=SIZES, repeat=3, only=None):
+    """ Runs the benchmarks, returning a dict of name -> msec per call """
+    results = {}
+    for name, func in benchmarks(sizes):
+        if only and only not in name:
+            continue
+        results[name] = time_call(func, repeat)
+    return results
+
+
+def regressions(results, baseline, max_regression):
+    """ Compares results to a baseline.
+
+    :returns: a list of (name, baseline msec, msec) for benchmarks more than
+              ``max_regression`` (a fraction) slower than the baseline
+
+    """
+    slower = []
+    for name, msec in sorted(results.items()):
+        before = baseline.get(name)
+        if before and msec > before * (1 + max_regression):
+            slower.append((name, before, msec))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the grading pipeline")
+    parser.add_argument("--repeat", default=3, type=int, help="timing repetitions")
+    parser.add_argument("--quick", action="store_true", help="only benchmark small result sets")
+    parser.add_argument("--only", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file from a previous run to compare against")
+    parser.add_argument("--max-regression", default=0.25, type=float,
+                        help="allowed slowdown against the baseline, as a fraction")
+    args = parser.parse_args()
+
+    # Filtering logs a warning for every enforced LIMIT
+    logging.basicConfig(level=logging.ERROR)
+
+    # Scoring reports to statsd
+    configure_statsd()
+
+    results = run(QUICK_SIZES if args.quick else SIZES, args.repeat, args.only)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    print "%-45s %12s %12s" % ("benchmark", "msec/call", "baseline")
+    for name, msec in sorted(results.items()):
+        before = "%12.3f" % baseline[name] if name in baseline else ""
+        print "%-45s %12.3f %s" % (name, msec, before)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"created": time.time(),
+                       "python": platform.python_version(),
+                       "results": results}, f, indent=2, sort_keys=True)
+
+    slower = regressions(results, baseline, args.max_regression)
+    if slower:
+        print
+        print "Regressions (more than %d%% slower):" % (args.max_regression * 100)
+        for name, before, msec in slower:
+            print "  %s: %.3f -> %.3f msec" % (name, before, msec)
+        sys.exit(1)
@@ -1,116 +1,70 @@
 #!/usr/bin/env python
 import argparse
-import ConfigParser
 import logging
-import MySQLdb
 import sys
+import threading
 import time
 
-log = logging.getLogger(__name__)
-
-DEFAULT_CREDENTIALS = {
-    "host": "127.0.0.1",
-    "port": 3306,
-    "user": "",
-    "password": ""
-}
-
-
-def parse_db_args(args):
-    """ Extract database credentials from CLI args.
-
-    The --config flag takes priority, falling back to the
-    individual CLI args and finally to ``DEFAULT_CREDENTIALS``.
-
-    """
-
-    creds = {
-        "host": getattr(args, 'host', DEFAULT_CREDENTIALS['host']),
-        "port": getattr(args, 'port', DEFAULT_CREDENTIALS['port']),
-        "user": getattr(args, 'user', DEFAULT_CREDENTIALS['user']),
-        "password": getattr(args, 'password', DEFAULT_CREDENTIALS['password'])
-    }
-
-    # Parse credentials from MySQL options file
-    # Checks both [client] and [mysql] sections
-    if args.config:
-        with open(args.config, "r") as f:
-            config = ConfigParser.RawConfigParser(creds)
-            config.readfp(f)
-
-            try:
-                creds["host"] = config.get("client", "host")
-                creds["port"] = config.getint("client", "port")
-                creds["user"] = config.get("client", "user")
-                creds["password"] = config.get("client", "password")
-            except ConfigParser.NoSectionError:
-                creds["host"] = config.get("mysql", "host")
-                creds["port"] = config.getint("mysql", "port")
-                creds["user"] = config.get("mysql", "user")
-                creds["password"] = config.get("mysql", "password")
-
-    return creds
-
+from bux_sql_grader.history import HISTORY_MAX_BYTES, KillHistory
+from bux_sql_grader.metrics import configure_statsd
+from bux_sql_grader.monitor import (FAIR_SHARE_BUDGET, FAIR_SHARE_MODES,
+                                    FAIR_SHARE_WINDOW, MAX_POLL_INTERVAL,
+                                    MIN_POLL_INTERVAL, SAMPLE_INTERVAL,
+                                    ServerMonitor, parse_db_args,
+                                    parse_server_config)
 
-def expired_processes(db, db_blacklist=None, user_blacklist=None, limit=5):
-    """ Generates a list of processes which have exceeded the execution limit.
-
-        Returns a tuple of process ID and query.
-
-        :param db: MySQLdb connection object
-        :param db_blacklist: list of databases to monitor
-        :param user_blacklist: list of users to monitor queries of
-        :param limit: kill queries not finished in this many seconds
-
-    """
-    db.query("SHOW FULL PROCESSLIST")
-    process_list = db.store_result().fetch_row(maxrows=500, how=1)
-
-    for row in process_list:
-        if row['Info']:
-            log.debug("Process row: %s", row)
-
-            # Skip queries to databases not in our blacklist
-            if db_blacklist and row['db'] not in db_blacklist:
-                log.debug("Skipping row, query database not in blacklist: %s",
-                          db_blacklist)
-                continue
-
-            # Skip queries by users that are not in our blacklist
-            if user_blacklist and row['User'] not in user_blacklist:
-                log.debug("Skipping row, query user not in blacklist: %s",
-                          user_blacklist)
-                continue
-
-            # Check if this query has been running for too long
-            if row['Time'] > limit:
-                yield row['Id'], row['Info']
-            else:
-                log.debug("Skipping row, execution time is under %d second limit", limit)
+log = logging.getLogger(__name__)
 
 
-if __name__ == "__main__":
-
-    # Command line options
-    parser = argparse.ArgumentParser(description="Kills long running MySQL processes")
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Kills long running MySQL processes")
     parser.add_argument("--host", default="127.0.0.1", help="database host")
-    parser.add_argument("--port", default=3306, type=int, help="database port")
+    parser.add_argument("--port", default=3306, type=int,
+                        help="database port")
     parser.add_argument("--user", default="root", help="database user")
     parser.add_argument("--password", default="", help="database password")
     parser.add_argument("--config", help="MySQL client options file")
-    parser.add_argument("--dbs", default=[], nargs="+", help="limit monitoring to specified databases")
-    parser.add_argument("--users", default=[], nargs="+", help="limit monitoring to queries executed by these users")
-    parser.add_argument("--limit", default=30, type=int, help="query execution limit in seconds")
-    parser.add_argument("--loglevel", default="warning", help="python log level")
-    args = parser.parse_args()
-
-    # Log configuration
-    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
-                        format="%(asctime)s - %(levelname)s - %(message)s")
-
-    # Extract database credentials from CLI args
-    creds = parse_db_args(args)
-
+    parser.add_argument("--servers",
+                        help="INI file listing servers to monitor, one per "
+                             "section")
+    parser.add_argument("--dbs", default=[], nargs="+",
+                        help="limit monitoring to specified databases")
+    parser.add_argument("--users", default=[], nargs="+",
+                        help="limit monitoring to queries executed by these "
+                             "users")
+    parser.add_argument("--limit", default=30, type=int,
+                        help="query execution limit in seconds")
+    parser.add_argument("--min-interval", default=MIN_POLL_INTERVAL,
+                        type=float, help="minimum seconds between polls")
+    parser.add_argument("--max-interval", default=MAX_POLL_INTERVAL,
+                        type=float, help="maximum seconds between polls")
+    parser.add_argument("--fair-share", choices=FAIR_SHARE_MODES,
+                        help="limit cumulative query time per student "
+                             "(tagged by the grader's tag_queries option), "
+                             "MySQL user or database")
+    parser.add_argument("--budget", default=FAIR_SHARE_BUDGET, type=int,
+                        help="fair share query seconds allowed per window")
+    parser.add_argument("--window", default=FAIR_SHARE_WINDOW, type=int,
+                        help="fair share window in seconds")
+    parser.add_argument("--sample-interval", default=SAMPLE_INTERVAL,
+                        type=float,
+                        help="maximum seconds between polls in fair share "
+                             "mode")
+    parser.add_argument("--history",
+                        help="file to record killed statements in")
+    parser.add_argument("--history-max-bytes", default=HISTORY_MAX_BYTES,
+                        type=int, help="rotate the history file at this size")
+    parser.add_argument("--statsd-host", default="localhost",
+                        help="statsd host, if STATSD_HOST is not set")
+    parser.add_argument("--statsd-port", default=8125, type=int,
+                        help="statsd port, if STATSD_PORT is not set")
+    parser.add_argument("--loglevel", default="warning",
+                        help="python log level")
+    return parser
+
+
+def print_settings(args, servers):
     db_list = "All"
     if args.dbs:
         db_list = ", ".join(args.dbs)
@@ -122,43 +76,89 @@ if __name__ == "__main__":
     print
     print "Monitoring MySQL server for long running queries."
     print
-    print "Host: %s" % creds["host"]
-    print "Port: %s" % creds["port"]
-    print "User: %s" % creds["user"]
+    for server in servers:
+        if "name" in server:
+            print "Server: %s" % server["name"]
+        print "Host: %s" % server["host"]
+        print "Port: %s" % server["port"]
+        print "User: %s" % server["user"]
+        print
     print "Databases to watch: %s" % db_list
     print "Users to watch: %s" % user_list
     print "Time limit: %ds" % args.limit
+    if args.fair_share:
+        print "Fair share: %ds per %s every %ds" % (
+            args.budget, args.fair_share, args.window)
     print
 
     # Workaround to ensure run stats are displayed when script
     # is managed by supervisor
     sys.stdout.flush()
 
-    # Establish database connection
-    db = MySQLdb.connect(host=creds["host"],
-                         port=creds["port"],
-                         user=creds["user"],
-                         passwd=creds["password"])
 
-    # Enter query monitoring loop
-    try:
-        while True:
-            for pid, query in expired_processes(db=db,
-                                                db_blacklist=args.dbs,
-                                                user_blacklist=args.users,
-                                                limit=args.limit):
-                db.query("KILL %d" % pid)
+def start_monitors(args, servers):
+    """ Starts a monitor thread for each server """
+    history = None
+    if args.history:
+        history = KillHistory(args.history, max_bytes=args.history_max_bytes)
+
+    stop = threading.Event()
+    monitors = [ServerMonitor(server,
+                              db_blacklist=args.dbs,
+                              user_blacklist=args.users,
+                              limit=args.limit,
+                              stop=stop,
+                              min_interval=args.min_interval,
+                              max_interval=args.max_interval,
+                              fair_share=args.fair_share,
+                              budget=args.budget,
+                              window=args.window,
+                              history=history,
+                              sample_interval=args.sample_interval)
+                for server in servers]
+    for server_monitor in monitors:
+        server_monitor.start()
+    return stop, monitors
+
+
+def main():
+    args = build_parser().parse_args()
+
+    # Log configuration
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+
+    # Extract database credentials from CLI args
+    creds = parse_db_args(args)
+
+    servers = [creds]
+    if args.servers:
+        servers = parse_server_config(args.servers, creds)
+
+    print_settings(args, servers)
 
-                log.warning("Killed query #%d: %s (exceeded %ds execution limit)",
-                            pid, query, args.limit)
+    # The shared statsd client is only configured from the environment
+    configure_statsd(args.statsd_host, args.statsd_port)
 
-            time.sleep(2)
+    # Monitor each server on its own thread
+    stop, monitors = start_monitors(args, servers)
+
+    # Sleep in the main thread so it can receive KeyboardInterrupt
+    try:
+        while any(server_monitor.is_alive() for server_monitor in monitors):
+            time.sleep(1)
 
     except (KeyboardInterrupt, SystemExit):
         pass
 
-    db.close()
+    stop.set()
+    for server_monitor in monitors:
+        server_monitor.join(5)
 
     print
     print "MySQL query monitor exiting."
     print
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import argparse
+import importlib
+import logging
+import os
+import sys
+
+from bux_sql_grader import MySQLEvaluator, SQLiteEvaluator
+from bux_sql_grader.metrics import configure_statsd
+from bux_sql_grader.warmup import load_manifest, warm_answers
+
+log = logging.getLogger(__name__)
+
+EVALUATORS = {
+    MySQLEvaluator.name: MySQLEvaluator,
+    SQLiteEvaluator.name: SQLiteEvaluator,
+}
+
+
+def load_evaluator(settings, name):
+    """ Creates an evaluator from a grader settings module """
+    config = importlib.import_module(settings).EVALUATOR_CONFIG[name]
+    return EVALUATORS[name](**config)
+
+
+if __name__ == "__main__":
+
+    # Command line options
+    parser = argparse.ArgumentParser(
+        description="Runs the grader answers of a course's problems to "
+                    "warm caches")
+    parser.add_argument("manifest",
+                        help="file of problem grader payloads, one JSON "
+                             "object per line")
+    parser.add_argument("--settings", required=True,
+                        help="grader settings module with an "
+                             "EVALUATOR_CONFIG")
+    parser.add_argument("--evaluator", default=MySQLEvaluator.name,
+                        choices=sorted(EVALUATORS), help="evaluator to warm")
+    parser.add_argument("--workers", default=4, type=int,
+                        help="answers to run at once")
+    parser.add_argument("--loglevel", default="warning",
+                        help="python log level")
+    args = parser.parse_args()
+
+    # Log configuration
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+
+    # The evaluator reports to statsd
+    configure_statsd()
+
+    sys.path.insert(0, os.getcwd())
+    evaluator = load_evaluator(args.settings, args.evaluator)
+    problems = load_manifest(args.manifest)
+
+    print
+    print "Warming %d problem answers with %d workers." % (len(problems),
+                                                           args.workers)
+    print
+    sys.stdout.flush()
+
+    # The answer cache goes away with this process, so nothing is rendered
+    reports = warm_answers(evaluator, problems, args.workers, render=False)
+
+    print "%-30s %-15s %10s %12s %10s" % ("problem", "database", "rows",
+                                          "bytes", "msec")
+    for report in reports:
+        print "%-30s %-15s %10d %12d %10.1f" % (
+            report["problem"][:30], (report["database"] or "")[:15],
+            report["rows"], report["bytes"], report["seconds"] * 1000)
+
+    errors = [report for report in reports if report["error"]]
+    if errors:
+        print
+        for report in errors:
+            print "Error in %s: %s" % (report["problem"], report["error"])
+
+    print
+    print "Total: %.1f msec, %d rows" % (
+        sum(report["seconds"] for report in reports) * 1000,
+        sum(report["rows"] for report in reports))
+
+    sys.exit(1 if errors else 0)
@@ -14,3 +14,4 @@
 __version__ = '0.4.2'
 
 from .mysql import MySQLEvaluator
+from .sqlite import SQLiteEvaluator
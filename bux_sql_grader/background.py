@@ -0,0 +1,216 @@
+"""
+    bux_sql_grader.background
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A bounded thread pool for moving work (e.g. S3 uploads) off the grading
+    critical path.
+
+"""
+
+import logging
+import sys
+import threading
+import time
+
+from Queue import Queue, Full
+
+from statsd import statsd
+
+from .breaker import CircuitOpen
+
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when a call doesn't finish within its deadline """
+    pass
+
+
+class DeadlineRunner(object):
+    """ Calls functions with a deadline, each on its own daemon thread.
+
+    When the deadline passes the caller gets ``DeadlineExceeded`` straight
+    away; the call itself can't be interrupted and is left to finish (or
+    time out) in the background, its result discarded. At most
+    ``max_threads`` calls, finished or abandoned, run at once. Past that,
+    calls fail fast with ``DeadlineExceeded`` without being started, so
+    stuck calls can't pile up threads without limit.
+
+    :param int max_threads: maximum number of calls running at once
+    :param str name: statsd metric prefix
+
+    """
+
+    def __init__(self, max_threads=8, name='bux_sql_grader.deadline'):
+        self.max_threads = max_threads
+        self.name = name
+        self._slots = threading.BoundedSemaphore(max_threads)
+
+    def call(self, timeout, func, *args, **kwargs):
+        """ Calls ``func(*args, **kwargs)``, giving up after ``timeout``
+        seconds.
+
+        :param float timeout: seconds to wait, or ``None`` to call ``func``
+                              directly without a deadline
+
+        """
+        if timeout is None:
+            return func(*args, **kwargs)
+
+        if not self._slots.acquire(False):
+            statsd.incr(self.name + '.rejected')
+            raise DeadlineExceeded("%d calls already running, not starting %s"
+                                   % (self.max_threads, func))
+
+        outcome = {}
+
+        def run():
+            try:
+                outcome["result"] = func(*args, **kwargs)
+            except Exception:
+                outcome["error"] = sys.exc_info()
+            finally:
+                self._slots.release()
+
+        thread = threading.Thread(target=run, name="deadline-%s" % func)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+
+        if thread.is_alive():
+            statsd.incr(self.name + '.exceeded')
+            raise DeadlineExceeded("%s did not finish within %s seconds"
+                                   % (func, timeout))
+        if "error" in outcome:
+            exc_type, exc_value, exc_tb = outcome["error"]
+            raise exc_type, exc_value, exc_tb
+        return outcome.get("result")
+
+
+class BackgroundQueue(object):
+    """ Runs jobs on a fixed pool of worker threads.
+
+    Producers are throttled when the queue is full: ``submit`` waits up to
+    ``put_timeout`` seconds for space before dropping the job. Failed jobs
+    are retried with exponential backoff, except for jobs skipped by an
+    open circuit breaker (``CircuitOpen``).
+
+    :param str name: statsd metric prefix and worker thread name, which
+                     also identifies the queue in log messages
+    :param int workers: number of worker threads
+    :param int maxsize: maximum number of queued jobs
+    :param int retries: attempts after the first failure
+    :param float retry_delay: seconds to wait before the first retry
+    :param float put_timeout: seconds ``submit`` may block when full
+
+    """
+
+    def __init__(self, name='bux_sql_grader.background_queue', workers=2,
+                 maxsize=100, retries=2, retry_delay=0.5, put_timeout=1.0):
+        self.name = name
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.put_timeout = put_timeout
+
+        self._queue = Queue(maxsize)
+        self._closed = False
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name="%s-%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue ``func(*args, **kwargs)`` to run in the background.
+
+        :returns: ``True`` if the job was queued, ``False`` if it was dropped
+
+        """
+        if self._closed:
+            log.warning("%s is closed, dropping job: %s", self.name, func)
+            statsd.incr(self.name + '.dropped')
+            return False
+
+        try:
+            self._queue.put((time.time(), func, args, kwargs),
+                            timeout=self.put_timeout)
+        except Full:
+            log.warning("%s is full, dropping job: %s", self.name, func)
+            statsd.incr(self.name + '.dropped')
+            return False
+
+        statsd.gauge(self.name + '.depth', self._queue.qsize())
+        return True
+
+    def close(self, timeout=None):
+        """ Stop accepting jobs and wait up to ``timeout`` seconds for
+        queued jobs to finish.
+
+        Jobs still queued at the deadline are abandoned; the workers are
+        daemon threads and won't keep the process alive.
+
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        def remaining():
+            return None if deadline is None else max(deadline - time.time(), 0)
+
+        try:
+            for thread in self._threads:
+                self._queue.put(_STOP, timeout=remaining())
+        except Full:
+            log.warning("%s did not drain within %s seconds, abandoning "
+                        "%d jobs", self.name, timeout, self._queue.qsize())
+            statsd.incr(self.name + '.abandoned')
+            return
+
+        for thread in self._threads:
+            thread.join(remaining())
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _STOP:
+                    return
+                self._run(*job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, queued_at, func, args, kwargs):
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                func(*args, **kwargs)
+            except CircuitOpen as e:
+                log.info("Background job %s skipped: %s", func, e)
+                statsd.incr(self.name + '.skipped')
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    log.error("Background job %s failed after %d attempts: %s",
+                              func, attempt + 1, e)
+                    statsd.incr(self.name + '.failed')
+                    return
+                log.warning("Background job %s failed, retrying: %s", func, e)
+                statsd.incr(self.name + '.retried')
+                time.sleep(delay)
+                delay *= 2
+            else:
+                break
+
+        statsd.timing(self.name + '.latency',
+                      (time.time() - queued_at) * 1000)
+        statsd.gauge(self.name + '.depth', self._queue.qsize())
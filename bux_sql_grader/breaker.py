@@ -0,0 +1,113 @@
+"""
+    bux_sql_grader.breaker
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    A circuit breaker for calls to unreliable services (e.g. S3).
+
+"""
+
+import logging
+import threading
+import time
+
+from statsd import statsd
+
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """ Raised when a call is skipped because the circuit is open """
+    pass
+
+
+class CircuitBreaker(object):
+    """ Skips calls to a failing service for a cool-off period.
+
+    The breaker starts *closed* and lets every call through. After
+    ``failure_threshold`` consecutive failures it *opens* and rejects calls
+    for ``reset_timeout`` seconds. It then goes *half open* and lets a
+    single probe call through: success closes the circuit again, failure
+    re-opens it.
+
+    State changes are logged and reported to statsd as
+    ``<name>.<state>`` counters and a ``<name>.state`` gauge (0 = closed,
+    1 = half open, 2 = open).
+
+    :param str name: statsd metric prefix
+    :param int failure_threshold: consecutive failures before opening
+    :param float reset_timeout: seconds to stay open before probing
+
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name='bux_sql_grader.upload_breaker',
+                 failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def available(self):
+        """ Checks whether a call would be allowed, without claiming the
+        half open probe.
+
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.time() - self.opened_at >= self.reset_timeout
+            if self.state == self.HALF_OPEN:
+                return not self._probing
+            return True
+
+    def allow(self):
+        """ Returns ``True`` if a call may proceed. Callers must report the
+        outcome with ``record_success`` or ``record_failure``.
+
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                self._set_state(self.HALF_OPEN)
+
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if (self.state == self.HALF_OPEN or
+                    (self.state == self.CLOSED and
+                     self.failures >= self.failure_threshold)):
+                self.opened_at = time.time()
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        log.warning("Circuit %s: %s -> %s (%d consecutive failures)",
+                    self.name, self.state, state, self.failures)
+        self.state = state
+        statsd.incr('%s.%s' % (self.name, state))
+        statsd.gauge(self.name + '.state', self.STATE_GAUGE[state])
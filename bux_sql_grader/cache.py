@@ -0,0 +1,138 @@
+"""
+    bux_sql_grader.cache
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Bounded in-process caches for data derived from grader answers.
+
+"""
+
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+
+def answer_fingerprint(query):
+    """ Returns a stable digest identifying a grader answer query """
+    if isinstance(query, unicode):
+        query = query.encode('utf-8')
+    return hashlib.sha1(query.strip()).hexdigest()
+
+
+def results_fingerprint(results):
+    """ Returns a digest of a ``(cols, rows)`` query result """
+    cols, rows = results
+    digest = hashlib.sha1(repr(cols))
+    for row in rows:
+        digest.update(repr(row))
+    return digest.hexdigest()
+
+
+class LRUCache(object):
+    """ A thread-safe mapping that discards the least recently used items.
+
+    :param int maxsize: maximum number of items to hold. A cache with a
+                        ``maxsize`` below 1 stores nothing.
+
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        if self.maxsize < 1:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+
+class AnswerCache(object):
+    """ Caches values derived from grader answers.
+
+    Values are grouped by database and answer fingerprint so that everything
+    known about an answer (rendered tables, warnings, results) is evicted or
+    invalidated together. Each group holds any number of named values, e.g.
+    one rendered table per ``row_limit``.
+
+    :meth:`check` ties the values to the answer's results, so they are
+    dropped when a dataset is reloaded under the same database name.
+
+    :param int maxsize: maximum number of answers to hold
+
+    """
+
+    def __init__(self, maxsize=128):
+        self._groups = LRUCache(maxsize)
+
+    def key(self, database, answer):
+        return database, answer_fingerprint(answer)
+
+    def get(self, database, answer, name, default=None):
+        group = self._groups.get(self.key(database, answer))
+        if group is None:
+            return default
+        return group.get(name, default)
+
+    def set(self, database, answer, name, value):
+        key = self.key(database, answer)
+        group = self._groups.get(key)
+        if group is None:
+            group = {}
+            self._groups.set(key, group)
+        group[name] = value
+
+    def invalidate(self, database, answer):
+        """ Drops every cached value for an answer """
+        self._groups.pop(self.key(database, answer))
+
+    def check(self, database, answer, results):
+        """ Drops an answer's cached values if they were derived from other
+        results than ``results``, and records ``results`` as the ones values
+        cached from now on derive from.
+
+        :returns: ``True`` if stale values were dropped
+
+        """
+        digest = results_fingerprint(results)
+        current = self.get(database, answer, "results")
+        if current == digest:
+            return False
+        self.invalidate(database, answer)
+        self.set(database, answer, "results", digest)
+        return current is not None
+
+    def clear(self):
+        self._groups.clear()
+
+    def __len__(self):
+        return len(self._groups)
@@ -0,0 +1,264 @@
+"""
+    bux_sql_grader.history
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    A local record of statements killed by ``sqlmon.py``, shared with the
+    evaluator so known runaway queries aren't run again.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+#: Default size (in bytes) at which the history file is rotated
+HISTORY_MAX_BYTES = 1024*1024
+
+#: Longest statement text kept for each fingerprint
+MAX_QUERY_CHARS = 1000
+
+#: Comment the evaluator puts before student statements (``tag_queries``)
+#: so sqlmon can tell apart students sharing one MySQL account
+STUDENT_TAG = "/* student:%s */ "
+
+_whitespace = re.compile(r"\s+")
+_student_tag = re.compile(r"^\s*/\* student:([\w-]+) \*/ ?")
+
+
+def tag_statement(statement, student_id):
+    """ Prefixes a statement with a comment naming the student running it.
+
+    Characters other than letters, digits, ``_`` and ``-`` are dropped from
+    ``student_id``. The statement is returned as is if no ID is left.
+
+    """
+    student_id = re.sub(r"[^\w-]", "", student_id or "")
+    if not student_id:
+        return statement
+    return STUDENT_TAG % str(student_id) + statement
+
+
+def parse_student_tag(statement):
+    """ Splits the student tag from a statement.
+
+    :returns: a two item tuple: (student ID or ``None``, untagged statement)
+
+    """
+    match = _student_tag.match(statement or "")
+    if match is None:
+        return None, statement
+    return match.group(1), statement[match.end():]
+
+
+def normalize_query(query):
+    """ Collapses whitespace and case so trivially different copies of a
+    statement compare equal. Student tags are ignored.
+
+    """
+    if isinstance(query, str):
+        query = query.decode('utf-8', 'replace')
+    query = parse_student_tag(query)[1]
+    return _whitespace.sub(u" ", query).strip().rstrip(u";").strip().lower()
+
+
+def query_fingerprint(query):
+    """ Returns a short digest identifying a statement """
+    return hashlib.sha1(normalize_query(query).encode('utf-8')).hexdigest()[:16]
+
+
+def read_history(path):
+    """ Reads the latest entry for each fingerprint from a history file.
+
+    If the file is missing (e.g. while it is being rotated) the most recent
+    backup is read instead.
+
+    :returns: a dict of fingerprint -> entry
+
+    """
+    entries = {}
+    if not os.path.exists(path) and os.path.exists(path + ".1"):
+        path = path + ".1"
+
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    entries[entry["fingerprint"]] = entry
+                except (ValueError, KeyError, TypeError):
+                    log.warning("Skipping bad history line: %r", line)
+    except IOError:
+        pass
+
+    return entries
+
+
+class KillHistory(object):
+    """ Counts killed statements by fingerprint.
+
+    Every kill appends a JSON line with the statement's fingerprint, kill
+    count, last seen time, database, user and (shortened) text, along with
+    the count and last seen time of each kind of kill (``"limit"`` for the
+    time limit, ``"budget"`` for fair share). When the file grows past
+    ``max_bytes`` (or twice the size it had after the last rotation,
+    whichever is larger) it is rotated to ``<path>.1`` (keeping ``backups``
+    old files) and a fresh file is started with one line per fingerprint,
+    so the latest counts are always in the current file.
+
+    Writes are serialized within a process. Only one process should record
+    to a file; any number may read it.
+
+    :param str path: history file
+    :param int max_bytes: rotate the file once it is this large
+    :param int backups: number of rotated files to keep
+    :param int max_entries: fingerprints kept when rotating, most recently
+                            seen first
+
+    """
+
+    def __init__(self, path, max_bytes=HISTORY_MAX_BYTES, backups=3,
+                 max_entries=10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_entries = max_entries
+
+        self.entries = {}
+        self._rotated_size = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """ Reads the latest entry for each fingerprint from the file """
+        entries = read_history(self.path)
+        with self._lock:
+            self.entries = entries
+        return entries
+
+    def record(self, query, database=None, user=None, now=None,
+               kind="limit"):
+        """ Records a kill, returning the updated entry """
+        fingerprint = query_fingerprint(query)
+        now = time.time() if now is None else now
+
+        with self._lock:
+            entry = dict(self.entries.get(fingerprint) or {
+                "fingerprint": fingerprint, "count": 0})
+            kinds = dict(entry.get("kinds") or {})
+            kinds[kind] = {"count": kinds.get(kind, {}).get("count", 0) + 1,
+                           "last_seen": now}
+            entry.update(count=entry["count"] + 1,
+                         kinds=kinds,
+                         last_seen=now,
+                         db=database,
+                         user=user,
+                         query=query[:MAX_QUERY_CHARS])
+            self.entries[fingerprint] = entry
+
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+                size = f.tell()
+
+            if size > max(self.max_bytes, 2 * self._rotated_size):
+                self._rotate()
+
+        return entry
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = "%s.%d" % (self.path, i)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.path, i + 1))
+        os.rename(self.path, self.path + ".1")
+
+        entries = sorted(self.entries.values(),
+                         key=lambda entry: entry.get("last_seen", 0),
+                         reverse=True)[:self.max_entries]
+        self.entries = dict((entry["fingerprint"], entry) for entry in entries)
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".history-")
+        with os.fdopen(fd, "w") as f:
+            for entry in reversed(entries):
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+            self._rotated_size = f.tell()
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, self.path)
+
+
+class RunawayQueries(object):
+    """ A read-only view of a kill history file for rejecting statements
+    before they are run. Only time limit kills count; a statement killed
+    because its student was over a fair share budget may be fine to run.
+
+    The file is re-read when its size or modification time changes. That
+    is checked at most every ``check_interval`` seconds, so lookups are
+    normally just a dict access.
+
+    :param str path: history file written by ``sqlmon.py --history``
+    :param int min_kills: kills before a statement is rejected
+    :param int ttl: forget statements not killed for this many seconds
+    :param float check_interval: seconds between checks for changes
+
+    """
+
+    def __init__(self, path, min_kills=1, ttl=60*60*24, check_interval=5):
+        self.path = path
+        self.min_kills = min_kills
+        self.ttl = ttl
+        self.check_interval = check_interval
+
+        self.entries = {}
+        self._stat = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self, now=None):
+        """ Re-reads the history file if it has changed """
+        now = time.time() if now is None else now
+        with self._lock:
+            if (self._checked_at is not None and
+                    now - self._checked_at < self.check_interval):
+                return
+            self._checked_at = now
+
+            try:
+                st = os.stat(self.path)
+                stat = (st.st_ino, st.st_size, st.st_mtime)
+            except OSError:
+                stat = None
+
+            if stat == self._stat:
+                return
+            self._stat = stat
+            self.entries = read_history(self.path)
+
+    def get(self, query, now=None):
+        """ Returns the history entry for a known runaway statement, or
+        ``None`` if the statement may be run.
+
+        """
+        now = time.time() if now is None else now
+        self.refresh(now)
+
+        entry = self.entries.get(query_fingerprint(query))
+        if entry is None:
+            return None
+
+        # Entries written before kills had kinds were all time limit kills
+        kills = entry
+        if "kinds" in entry:
+            kills = entry["kinds"].get("limit") or {}
+        if kills.get("count", 0) < self.min_kills:
+            return None
+        if now - kills.get("last_seen", 0) > self.ttl:
+            return None
+        return entry
@@ -0,0 +1,36 @@
+"""
+    bux_sql_grader.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Sets up the shared statsd client for command line tools.
+
+"""
+
+import sys
+
+import statsd as statsd_package
+
+
+def configure_statsd(host="localhost", port=8125):
+    """ Makes sure the shared statsd client exists.
+
+    The ``statsd`` package only creates its client when ``STATSD_HOST`` is
+    set in the environment, and modules bind it (or ``None``) when they are
+    imported. If it wasn't set, a client for ``host`` and ``port`` is
+    created and given to every ``bux_sql_grader`` module already loaded.
+    Nothing needs to be listening on the port.
+
+    :returns: the shared ``StatsClient``
+
+    """
+    client = statsd_package.statsd
+    if client is None:
+        client = statsd_package.StatsClient(host, port)
+        statsd_package.statsd = client
+
+    for name, module in sys.modules.items():
+        if (module is not None and name.split(".")[0] == "bux_sql_grader"
+                and getattr(module, "statsd", client) is None):
+            module.statsd = client
+
+    return client
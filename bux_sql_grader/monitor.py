@@ -0,0 +1,513 @@
+"""
+    bux_sql_grader.monitor
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Watches MySQL servers for long running student queries and kills them.
+    Used by ``sqlmon.py``.
+
+"""
+
+import collections
+import ConfigParser
+import logging
+import re
+import threading
+import time
+
+from statsd import statsd
+
+import MySQLdb
+
+from .history import parse_student_tag
+
+
+log = logging.getLogger(__name__)
+
+#: Prefix for statsd metrics
+STATSD_PREFIX = "bux_sql_grader.sqlmon"
+
+#: Bounds (in seconds) on the time between process list polls. Polls are
+#: scheduled for when the oldest watched query will reach the limit.
+MIN_POLL_INTERVAL = 0.25
+MAX_POLL_INTERVAL = 10
+
+#: Seconds between kill lateness reports
+LATENESS_REPORT_INTERVAL = 300
+
+#: Default fair share limits: query seconds allowed per student (or user
+#: or database) within a sliding window of seconds
+FAIR_SHARE_BUDGET = 120
+FAIR_SHARE_WINDOW = 600
+
+#: Fair share modes: what running queries are charged to
+FAIR_SHARE_MODES = ("student", "user", "db")
+
+#: Maximum seconds between polls in fair share mode. Usage is sampled on
+#: each poll, so queries shorter than this may go uncharged.
+SAMPLE_INTERVAL = 1
+
+#: Reconnect delays (in seconds) after a server error. The delay doubles
+#: after each consecutive failure.
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
+#: MySQL error raised when killing a process that has already finished
+ER_NO_SUCH_THREAD = 1094
+
+DEFAULT_CREDENTIALS = {
+    "host": "127.0.0.1",
+    "port": 3306,
+    "user": "",
+    "password": ""
+}
+
+
+def parse_db_args(args):
+    """ Extract database credentials from CLI args.
+
+    The --config flag takes priority, falling back to the
+    individual CLI args and finally to ``DEFAULT_CREDENTIALS``.
+
+    """
+
+    creds = {
+        "host": getattr(args, 'host', DEFAULT_CREDENTIALS['host']),
+        "port": getattr(args, 'port', DEFAULT_CREDENTIALS['port']),
+        "user": getattr(args, 'user', DEFAULT_CREDENTIALS['user']),
+        "password": getattr(args, 'password', DEFAULT_CREDENTIALS['password'])
+    }
+
+    # Parse credentials from MySQL options file
+    # Checks both [client] and [mysql] sections
+    if args.config:
+        with open(args.config, "r") as f:
+            config = ConfigParser.RawConfigParser(creds)
+            config.readfp(f)
+
+            try:
+                creds["host"] = config.get("client", "host")
+                creds["port"] = config.getint("client", "port")
+                creds["user"] = config.get("client", "user")
+                creds["password"] = config.get("client", "password")
+            except ConfigParser.NoSectionError:
+                creds["host"] = config.get("mysql", "host")
+                creds["port"] = config.getint("mysql", "port")
+                creds["user"] = config.get("mysql", "user")
+                creds["password"] = config.get("mysql", "password")
+
+    return creds
+
+
+#: Running statements, filtered on the server. Only statements from other
+#: connections with SQL text are returned.
+PROCESSLIST_QUERY = """
+    SELECT ID, USER, DB, TIME, INFO
+    FROM information_schema.PROCESSLIST
+    WHERE INFO IS NOT NULL
+      AND ID != CONNECTION_ID()
+      AND TIME >= %s
+"""
+
+
+def processlist_query(db_blacklist=None, user_blacklist=None, min_time=0):
+    """ Builds the process list query and its parameters.
+
+        :param min_time: only include queries running for this many seconds
+        :returns: a two item tuple: (SQL, parameters)
+
+    """
+    sql = PROCESSLIST_QUERY
+    params = [min_time]
+
+    if db_blacklist:
+        sql += "      AND DB IN (%s)\n" % ", ".join(["%s"] * len(db_blacklist))
+        params.extend(db_blacklist)
+
+    if user_blacklist:
+        sql += "      AND USER IN (%s)\n" % ", ".join(
+            ["%s"] * len(user_blacklist))
+        params.extend(user_blacklist)
+
+    return sql, params
+
+
+def parse_server_config(path, defaults):
+    """ Read the list of servers to monitor from an INI file.
+
+    Each section describes one server and may set ``host``, ``port``,
+    ``user`` and ``password``. Missing options are taken from ``defaults``.
+
+    .. code-block:: ini
+
+        [primary]
+        host = db1.example.com
+
+        [replica]
+        host = db2.example.com
+        port = 3307
+
+    :returns: a list of credential dicts, with the section name as ``name``
+
+    """
+    config = ConfigParser.RawConfigParser()
+    with open(path, "r") as f:
+        config.readfp(f)
+
+    servers = []
+    for section in config.sections():
+        creds = dict(defaults, name=section)
+        for option in ("host", "user", "password"):
+            if config.has_option(section, option):
+                creds[option] = config.get(section, option)
+        if config.has_option(section, "port"):
+            creds["port"] = config.getint(section, "port")
+        servers.append(creds)
+
+    return servers
+
+
+def running_processes(db, db_blacklist=None, user_blacklist=None, min_time=0):
+    """ Returns watched queries that have been running for ``min_time``
+        seconds or more.
+
+        Filtering is done by the server, so the cost of each poll depends on
+        the number of matching queries rather than the number of connections.
+
+        :param db: MySQLdb connection object
+        :param db_blacklist: list of databases to monitor
+        :param user_blacklist: list of users to monitor queries of
+        :returns: a list of (process ID, user, database, seconds, query) rows
+
+    """
+    sql, params = processlist_query(db_blacklist, user_blacklist, min_time)
+
+    cursor = db.cursor()
+    try:
+        cursor.execute(sql, params)
+        process_list = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    for row in process_list:
+        log.debug("Process row: %s, %s, %s, %s, %s", *row)
+
+    return process_list
+
+
+def metric_name(value):
+    """ Makes a database or user name safe to use in a statsd metric """
+    return re.sub(r"[^A-Za-z0-9_-]", "_", value or "none")
+
+
+def percentile(values, pct):
+    """ Returns the ``pct`` percentile of a non-empty list of numbers """
+    values = sorted(values)
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class UsageWindow(object):
+    """ Tracks cumulative query seconds per key over a sliding window.
+
+    :param int window: window length in seconds
+
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = collections.defaultdict(collections.deque)
+        self.totals = collections.defaultdict(float)
+
+    def add(self, key, seconds, now):
+        self.samples[key].append((now, seconds))
+        self.totals[key] += seconds
+
+    def usage(self, key, now):
+        """ Returns the query seconds used by ``key`` within the window """
+        samples = self.samples.get(key)
+        if not samples:
+            return 0.0
+
+        cutoff = now - self.window
+        while samples and samples[0][0] <= cutoff:
+            self.totals[key] -= samples.popleft()[1]
+
+        if not samples:
+            del self.samples[key]
+            del self.totals[key]
+            return 0.0
+        return self.totals[key]
+
+
+class ServerMonitor(threading.Thread):
+    """ Kills long running queries on one server.
+
+    Each monitor runs on its own thread with its own connection, so a slow
+    or unreachable server doesn't delay kills on the others. Connection
+    errors are retried with exponential backoff.
+
+    Polls are scheduled for the moment the oldest watched query will reach
+    ``limit``, bounded by ``min_interval`` and ``max_interval``. Only
+    queries within ``max_interval`` of the limit are fetched. How late each
+    kill lands is recorded and summarized in the log.
+
+    With ``fair_share`` set the monitor also adds up the time queries run
+    for each student (or MySQL user, or database) over the last ``window``
+    seconds. Once a student goes over ``budget`` seconds their running
+    queries are killed, and new ones are killed as soon as they're seen
+    until older usage falls out of the window. Every watched query is
+    fetched on each poll in this mode, and polls are at most
+    ``sample_interval`` seconds apart. Each poll charges the time since the
+    previous one (or since the query started, if later) to every query it
+    sees, including those it kills.
+
+    In ``"student"`` mode queries are charged to the student named by their
+    tag (see the evaluator's ``tag_queries`` option) and untagged queries
+    aren't charged. The ``"user"`` mode is of no use if students share the
+    grader's MySQL account, as they normally do.
+
+    Kills are counted in statsd per database and user, along with the
+    runtime of killed queries and the latency of each poll. If a
+    ``KillHistory`` is given every killed statement is recorded in it.
+
+    :param dict creds: server credentials, as returned by ``parse_db_args``
+    :param stop: ``threading.Event`` that ends the monitoring loop
+    :param history: optional ``KillHistory`` shared by all monitors
+
+    """
+
+    def __init__(self, creds, db_blacklist=None, user_blacklist=None,
+                 limit=30, stop=None, min_interval=MIN_POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL, fair_share=None,
+                 budget=FAIR_SHARE_BUDGET, window=FAIR_SHARE_WINDOW,
+                 history=None, sample_interval=SAMPLE_INTERVAL):
+        self.server = creds.get("name") or "%s:%s" % (creds["host"],
+                                                      creds["port"])
+        super(ServerMonitor, self).__init__(name="sqlmon-%s" % self.server)
+        self.daemon = True
+
+        self.creds = creds
+        self.db_blacklist = db_blacklist
+        self.user_blacklist = user_blacklist
+        self.limit = limit
+        self.min_interval = min_interval
+        self.max_interval = min(max_interval, limit)
+        self.stop_event = stop or threading.Event()
+        self.history = history
+        self.db = None
+
+        # Process ID -> (earliest, latest) possible start time. TIME only
+        # has second resolution, so each poll narrows the range.
+        self.start_times = {}
+        self.lateness = collections.deque(maxlen=1000)
+        self.kills_since_report = 0
+
+        # Fair share budgets
+        if fair_share is not None and fair_share not in FAIR_SHARE_MODES:
+            raise ValueError("Unknown fair share mode: %s" % fair_share)
+        self.fair_share = fair_share
+        self.budget = budget
+        self.sample_interval = sample_interval
+        self.usage = UsageWindow(window) if fair_share else None
+        self.last_poll = None
+
+    def connect(self):
+        self.db = MySQLdb.connect(host=self.creds["host"],
+                                  port=self.creds["port"],
+                                  user=self.creds["user"],
+                                  passwd=self.creds["password"],
+                                  connect_timeout=10)
+        log.info("[%s] Connected", self.server)
+
+    def close(self):
+        if self.db is not None:
+            try:
+                self.db.close()
+            except MySQLdb.Error:
+                pass
+            self.db = None
+        self.start_times.clear()
+
+    def estimate_start(self, pid, now, elapsed):
+        """ Narrows the known start time range of a query.
+
+        :returns: a two item tuple: (earliest, latest) start time
+
+        """
+        earliest, latest = now - elapsed - 1, now - elapsed
+        if pid in self.start_times:
+            known_earliest, known_latest = self.start_times[pid]
+            # A range that doesn't overlap means the connection has
+            # started a new query
+            if known_earliest <= latest and earliest <= known_latest:
+                earliest = max(earliest, known_earliest)
+                latest = min(latest, known_latest)
+        return earliest, latest
+
+    def poll(self):
+        """ Kill every expired query on the server.
+
+        :returns: seconds to wait before the next poll
+
+        """
+        min_time = max(self.limit - self.max_interval, 0)
+        wait = self.max_interval
+        if self.fair_share:
+            min_time = 0
+            wait = min(wait, self.sample_interval)
+
+        timer = statsd.timer(STATSD_PREFIX + '.poll').start()
+        rows = running_processes(self.db, self.db_blacklist,
+                                 self.user_blacklist, min_time)
+        timer.stop()
+        now = time.time()
+
+        start_times = {}
+        running = collections.defaultdict(list)
+        for process in rows:
+            pid, user, database, elapsed, query = process
+            earliest, latest = self.estimate_start(pid, now, elapsed)
+            started = (earliest + latest) / 2.0
+
+            # Charge queries before killing them, so their last interval
+            # counts too
+            key = self.share_key(process)
+            if key is not None:
+                self.account(key, started, now)
+
+            if elapsed >= self.limit:
+                if self.kill(process):
+                    self.record_lateness(now - started - self.limit)
+                continue
+
+            start_times[pid] = (earliest, latest)
+            wait = min(wait, latest + self.limit - now)
+            if key is not None:
+                running[key].append(process)
+
+        for key, processes in running.iteritems():
+            wait = min(wait, self.enforce_budget(key, processes, now))
+
+        self.start_times = start_times
+        self.last_poll = now
+        return max(wait, self.min_interval)
+
+    def share_key(self, process):
+        """ Returns the student, user or database a query is charged to in
+        fair share mode, or ``None`` if it isn't charged.
+
+        """
+        pid, user, database, elapsed, query = process
+        if self.fair_share == "student":
+            return parse_student_tag(query)[0]
+        elif self.fair_share == "user":
+            return user
+        elif self.fair_share == "db":
+            return database
+        return None
+
+    def account(self, key, started, now):
+        """ Charges the time a running query has run since the last poll
+        (or since it started, if later) to ``key``.
+
+        """
+        since = started
+        if self.last_poll is not None:
+            since = max(since, self.last_poll)
+        self.usage.add(key, max(now - since, 0), now)
+
+    def enforce_budget(self, key, processes, now):
+        """ Kills the running queries of a user (or database) that has gone
+        over budget.
+
+        :returns: seconds until the budget would run out
+
+        """
+        used = self.usage.usage(key, now)
+        if used <= self.budget:
+            return (self.budget - used) / len(processes)
+
+        reason = "%s %s used %.0fs of its %ds budget in the last %ds" % (
+            self.fair_share, key, used, self.budget, self.usage.window)
+        for process in processes:
+            self.kill(process, reason, "budget")
+        return self.max_interval
+
+    def kill(self, process, reason=None, kind="limit"):
+        """ Kills a query, returning ``False`` if it had already finished.
+
+        :param process: a row from ``running_processes``
+        :param str reason: explanation for the log
+        :param str kind: metric name for the kind of kill
+
+        """
+        pid, user, database, elapsed, query = process
+        try:
+            self.db.query("KILL %d" % pid)
+        except MySQLdb.OperationalError as e:
+            # The query finished between polling and killing
+            if e.args[0] != ER_NO_SUCH_THREAD:
+                raise
+            log.debug("[%s] Query #%d already finished", self.server, pid)
+            return False
+
+        if reason is None:
+            reason = "exceeded %ds execution limit" % self.limit
+        log.warning("[%s] Killed query #%d: %s (%s)",
+                    self.server, pid, query, reason)
+
+        statsd.incr('%s.kills.%s' % (STATSD_PREFIX, kind))
+        statsd.incr('%s.kills.db.%s' % (STATSD_PREFIX, metric_name(database)))
+        statsd.incr('%s.kills.user.%s' % (STATSD_PREFIX, metric_name(user)))
+        statsd.timing(STATSD_PREFIX + '.kill_runtime', elapsed * 1000)
+
+        if self.history is not None:
+            try:
+                self.history.record(query, database, user, kind=kind)
+            except (IOError, OSError) as e:
+                log.error("[%s] Error writing kill history: %s",
+                          self.server, e)
+
+        return True
+
+    def record_lateness(self, seconds):
+        self.lateness.append(seconds)
+        self.kills_since_report += 1
+        statsd.timing(STATSD_PREFIX + '.kill_lateness', seconds * 1000)
+
+    def report_lateness(self):
+        """ Logs the distribution of recent kill lateness """
+        if not self.kills_since_report:
+            return
+        lateness = list(self.lateness)
+        log.info("[%s] %d kill(s) since last report. Lateness over last %d: "
+                 "p50 %.2fs, p95 %.2fs, p99 %.2fs, max %.2fs",
+                 self.server, self.kills_since_report, len(lateness),
+                 percentile(lateness, 50), percentile(lateness, 95),
+                 percentile(lateness, 99), max(lateness))
+        self.kills_since_report = 0
+
+    def run(self):
+        backoff = MIN_BACKOFF
+        next_report = time.time() + LATENESS_REPORT_INTERVAL
+        while not self.stop_event.is_set():
+            try:
+                if self.db is None:
+                    self.connect()
+                wait = self.poll()
+            except Exception as e:
+                log.error("[%s] Monitoring failed, reconnecting in %ds: %s",
+                          self.server, backoff, e)
+                self.close()
+                self.stop_event.wait(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+
+            backoff = MIN_BACKOFF
+            if time.time() >= next_report:
+                self.report_lateness()
+                next_report = time.time() + LATENESS_REPORT_INTERVAL
+            self.stop_event.wait(wait)
+
+        self.report_lateness()
+        self.close()
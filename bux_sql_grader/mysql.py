@@ -6,39 +6,82 @@
 
 """
 
+import atexit
 import copy
-import csv
+import functools
+import itertools
+import json
 import logging
 import os
+import threading
+import time
 
 from statsd import statsd
 
 import MySQLdb
 import MySQLdb.constants.FIELD_TYPE
 import MySQLdb.converters
+import MySQLdb.cursors
 from MySQLdb import OperationalError, Warning, Error
 
 import sqlfilter
 import sqlparse
 
 from string import Template
-from StringIO import StringIO
 
 from xml.sax.saxutils import escape as xml_escape
 
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
-
 from bux_grader_framework import BaseEvaluator
 from bux_grader_framework.exceptions import ImproperlyConfiguredGrader
 
+from .background import BackgroundQueue, DeadlineRunner
+from .breaker import CircuitBreaker, CircuitOpen
+from .cache import AnswerCache, LRUCache
+from .history import RunawayQueries, query_fingerprint, tag_statement
+from .profiling import EvaluationProfiler
+from .slowlog import SlowEvaluationLog
+from .rendering import (NO_ROWS_HTML, escape_html, fit_messages, html_size,
+                        render_table)
 from .scoring import MySQLRubricScorer
+from .storage import URL_EXPIRES, BaseStorage, LocalStorage, S3Storage
+from .streaming import (DEFAULT_CHUNK_SIZE, GZIP_HEADERS, MIN_PART_SIZE,
+                        GzipStream, SpooledChunks, format_csv_col, iter_csv)
+from .timing import NULL_TIMING, EvaluationTiming, LogTimingSink
 
 
 log = logging.getLogger(__file__)
 
 MAX_QUERY_LENGTH = 10000
 
+#: Lifetime of presigned result download URLs, in seconds
+S3_URL_EXPIRES = URL_EXPIRES
+
+#: Bytes held back from result table budgets for the row count footer
+RESULT_STATS_RESERVE = 256
+
+#: With ``max_response_bytes``, each block of warnings or hints may use up
+#: to this fraction of the budget
+RESPONSE_MESSAGE_SHARE = 1 / 8.0
+
+#: Slow evaluations waiting to be logged (and explained) in the background.
+#: More are dropped.
+SLOW_LOG_QUEUE_SIZE = 100
+
+#: Shown instead of a result table when not even its header fits the budget
+RESULTS_TOO_LARGE_HTML = "<p><small>Results too large to display.</small></p>"
+
+#: Most rows fetched at a time when result sizes are limited
+FETCH_BATCH_SIZE = 1000
+
+#: Rows in the first batch fetched with ``max_result_bytes``. Later batches
+#: are sized to fit in what is left of the limit at the average row size.
+FIRST_FETCH_BATCH_SIZE = 10
+
+#: With ``adaptive_fetch``, student rows fetched per grader result row.
+#: Row count scoring tests allow for 50% more rows than the grader's, so
+#: rows past twice as many can't change the score.
+ADAPTIVE_FETCH_FACTOR = 2
+
 INVALID_STUDENT_QUERY = Template("""
 <div class="error">
     <h4 style="color:#b40">Could not execute query:</h4>
@@ -97,6 +140,12 @@ EVAL_FAILURE_HINTS = """
 </ul>
 """
 
+RUNAWAY_QUERY = """
+<div class="error">
+    <h4 style="color:#b40">Query not run:</h4>
+    <p>This query was recently stopped for running too long, so it has not been run again. Please revise it before resubmitting.</p>
+</div>""" + EVAL_FAILURE_HINTS
+
 SQL_BLACKLIST = (
     "SLEEP",
     "AES_DECRYPT",
@@ -127,50 +176,377 @@ SQL_BLACKLIST = (
     )
 
 
+class PartialRows(tuple):
+    """ Result rows that were cut short by ``max_result_bytes`` """
+    pass
+
+
+class SampledRows(tuple):
+    """ The first rows of a result set whose remaining rows have not been
+    fetched yet.
+
+    ``remaining`` fetches the rest from the (still open) cursor, after which
+    ``total`` holds the full row count. ``close`` leaves unread rows unread
+    and calls ``abandon``, which should close the connection.
+
+    """
+
+    def __new__(cls, rows, cursor, abandon=None):
+        sample = super(SampledRows, cls).__new__(cls, rows)
+        sample.cursor = cursor
+        sample.abandon = abandon
+        sample.total = None
+        return sample
+
+    def remaining(self):
+        """ Yields the rows following the sample """
+        if self.cursor is None:
+            return
+
+        count = len(self)
+        while True:
+            batch = self.cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not batch:
+                break
+            count += len(batch)
+            for row in batch:
+                yield row
+        self.total = count
+
+        cursor, self.cursor = self.cursor, None
+        try:
+            cursor.close()
+        except Error as e:
+            log.warning("Could not close result cursor: %s", e)
+
+    def close(self):
+        cursor, self.cursor = self.cursor, None
+        if cursor is None:
+            return
+        # Unread rows would have to be read before the connection could be
+        # used again (the cursor would read them all on close)
+        if self.abandon is not None:
+            self.abandon()
+
+
+def result_row_size(row):
+    """ Estimates the size of a converted result row in bytes """
+    return sum(len(col) if isinstance(col, basestring) else 8 for col in row)
+
+
+def fetch_batch_size(count, size, max_size):
+    """ Returns how many rows to fetch next so that, at the average size of
+    the ``count`` rows (``size`` bytes) fetched so far, they should fit in
+    what is left of ``max_size`` bytes.
+
+    """
+    if not count:
+        return FIRST_FETCH_BATCH_SIZE
+    if not size:
+        return FETCH_BATCH_SIZE
+    return max(1, min(FETCH_BATCH_SIZE, (max_size - size) * count // size))
+
+
 class InvalidQuery(Exception):
     """ Raised when a SQL query can not be executed """
     pass
 
 
 class S3UploaderMixin(object):
-    """ A mixin that provides a method for uploading contents to S3 """
+    """ A mixin that provides methods for uploading results to S3
+
+    Uploads go through a storage backend (see :mod:`bux_sql_grader.storage`)
+    chosen with ``storage``: ``"s3"`` (the default), ``"local"`` (files
+    under ``storage_root`` served from ``storage_url``) or a
+    :class:`~bux_sql_grader.storage.BaseStorage` instance.
+
+    With ``s3_async`` enabled uploads are handed to a bounded pool of
+    background workers and the download link is returned immediately.
+
+    With ``s3_content_addressed`` enabled objects are named by a digest of
+    their contents and identical results are only uploaded once.
+
+    Each upload may take at most ``s3_upload_deadline`` seconds, and at most
+    ``s3_upload_threads`` uploads with a deadline (including ones that
+    missed it and are still running) may be in flight; further uploads fail
+    straight away. After
+    ``s3_breaker_threshold`` consecutive failures uploads are skipped (and
+    students see ``UPLOAD_FAILED_MESSAGE``) for ``s3_breaker_reset``
+    seconds, after which a single upload is tried to probe for recovery.
+
+    """
 
     DEFAULT_S3_FILENAME = "results.csv"
 
     def __init__(self, s3_bucket=None, s3_prefix="results",
-                 aws_access_key=None, aws_secret_key=None):
+                 aws_access_key=None, aws_secret_key=None,
+                 s3_part_size=MIN_PART_SIZE, s3_gzip=False,
+                 s3_async=False, s3_async_workers=2, s3_async_queue_size=100,
+                 s3_async_drain_timeout=30, s3_content_addressed=False,
+                 s3_index_size=10000, s3_index_ttl=60*60,
+                 s3_spool_size=MIN_PART_SIZE,
+                 storage="s3", storage_root=None, storage_url=None,
+                 s3_upload_deadline=None, s3_upload_threads=8,
+                 s3_breaker_threshold=5, s3_breaker_reset=30):
 
         self.s3_bucket = s3_bucket
         self.aws_access_key = aws_access_key
         self.aws_secret_key = aws_secret_key
         self.s3_prefix = s3_prefix
+        self.s3_gzip = s3_gzip
+
+        if isinstance(storage, BaseStorage):
+            self.storage = storage
+        elif storage == "s3":
+            self.storage = S3Storage(s3_bucket, aws_access_key,
+                                     aws_secret_key, s3_part_size)
+        elif storage == "local":
+            if not storage_root:
+                raise ImproperlyConfiguredGrader(
+                    "The local storage backend requires storage_root")
+            self.storage = LocalStorage(storage_root, storage_url)
+        else:
+            raise ImproperlyConfiguredGrader(
+                "Unknown storage backend: %s" % storage)
+
+        # Background uploads
+        self.s3_async = s3_async
+        self.s3_async_workers = s3_async_workers
+        self.s3_async_queue_size = s3_async_queue_size
+        self.s3_async_drain_timeout = s3_async_drain_timeout
+
+        self._upload_queue_lock = threading.Lock()
+        self._upload_queue = None
+        self._upload_queue_pid = None
+
+        # Content addressed uploads. The index maps key names known to
+        # exist in storage to the time they were last seen.
+        self.s3_content_addressed = s3_content_addressed
+        self.s3_index_ttl = s3_index_ttl
+        self.s3_spool_size = s3_spool_size
+        self._s3_index = LRUCache(s3_index_size)
+
+        # Failure handling
+        self.s3_upload_deadline = s3_upload_deadline
+        self._deadline_runner = DeadlineRunner(
+            s3_upload_threads, 'bux_sql_grader.upload_deadline')
+        self.upload_breaker = CircuitBreaker(
+            'bux_sql_grader.upload_breaker',
+            failure_threshold=s3_breaker_threshold,
+            reset_timeout=s3_breaker_reset)
+
+    def s3_keyname(self, path):
+        """ Returns the bucket key name for a results path """
+        if self.s3_prefix:
+            return os.path.join(self.s3_prefix, path)
+        return path
+
+    def put_to_s3(self, contents, keyname, gzip=None):
+        """ Store contents under a key name, raising on failure.
+
+        Raises ``CircuitOpen`` without contacting storage while uploads are
+        suspended, and ``DeadlineExceeded`` if the upload takes longer than
+        ``s3_upload_deadline``.
+
+        """
+        if not self.upload_breaker.allow():
+            statsd.incr('bux_sql_grader.storage.skipped')
+            raise CircuitOpen("Uploads suspended after repeated failures")
 
-    def upload_to_s3(self, contents, path):
+        if isinstance(contents, basestring):
+            contents = [contents]
+
+        if gzip is None:
+            gzip = self.s3_gzip
+
+        headers = None
+        if gzip:
+            contents = GzipStream(contents)
+            headers = dict(GZIP_HEADERS)
+
+        try:
+            timer = statsd.timer('bux_sql_grader.%s.put' % self.storage.name).start()
+            size = self._deadline_runner.call(self.s3_upload_deadline,
+                                              self.storage.stream, keyname,
+                                              contents, headers)
+            timer.stop()
+        except Exception:
+            self.upload_breaker.record_failure()
+            # Reconnect on the next upload in case the connection went bad
+            self.storage.reset()
+            raise
+
+        self.upload_breaker.record_success()
+
+        statsd.incr('bux_sql_grader.%s.bytes_sent' % self.storage.name, size)
+        if gzip:
+            statsd.incr('bux_sql_grader.upload_results.raw_bytes',
+                        contents.raw_bytes)
+            statsd.incr('bux_sql_grader.upload_results.compressed_bytes',
+                        contents.compressed_bytes)
+        else:
+            statsd.incr('bux_sql_grader.upload_results.raw_bytes', size)
+
+    def upload_to_s3(self, contents, path, gzip=None):
         """Upload submission results to S3
 
+        ``contents`` may be a string or an iterable of strings. Iterables are
+        consumed incrementally and sent as a multipart upload once they
+        exceed ``s3_part_size``, so memory use is bounded by the part size
+        rather than the size of the results.
+
+        If ``gzip`` (default: ``s3_gzip``) is set contents are compressed as
+        they are uploaded and served with ``Content-Encoding: gzip``.
+
         TODO:
             - Use query_auth=False for `generate_url` if bucket is public
 
         """
+        keyname = self.s3_keyname(path)
+        try:
+            self.put_to_s3(contents, keyname, gzip)
+            s3_url = self.storage.url(keyname, S3_URL_EXPIRES)
+        except CircuitOpen as e:
+            log.info("Skipping results upload: %s", e)
+            s3_url = False
+        except Exception as e:
+            log.error("Error uploading results to S3: %s", e)
+            s3_url = False
+
+        return s3_url
+
+    def upload_to_s3_async(self, make_contents, path, gzip=None):
+        """Queue an upload of submission results to S3
+
+        The presigned URL is generated locally and returned straight away,
+        while ``make_contents()`` is called and uploaded by a background
+        worker. The link will 404 until the upload finishes.
+
+        :param make_contents: callable returning the contents to upload.
+                              Called again for each retry.
+        :return: presigned URL, or ``False`` if the upload was not queued
+
+        """
+        if not self.upload_breaker.available():
+            statsd.incr('bux_sql_grader.storage.skipped')
+            return False
 
+        keyname = self.s3_keyname(path)
         try:
-            s3 = S3Connection(self.aws_access_key, self.aws_secret_key)
-            bucket = s3.get_bucket(self.s3_bucket, validate=False)
+            s3_url = self.storage.url(keyname, S3_URL_EXPIRES)
+        except Exception as e:
+            log.error("Error generating S3 URL: %s", e)
+            self.storage.reset()
+            return False
 
-            if self.s3_prefix:
-                keyname = os.path.join(self.s3_prefix, path)
+        def upload():
+            self.put_to_s3(make_contents(), keyname, gzip)
+
+        if not self.get_upload_queue().submit(upload):
+            return False
+
+        return s3_url
+
+    def upload_to_s3_by_digest(self, contents, path, gzip=None):
+        """Upload submission results to S3 under a content-derived key
+
+        The key name is the SHA-256 digest of the contents, so identical
+        results share one object. ``contents`` (an iterable of strings) is
+        consumed once, hashed and spooled to a temporary file (unless it is
+        a :class:`~bux_sql_grader.streaming.SpooledChunks` already), which
+        is uploaded from if the key is not in the local index and a HEAD
+        request doesn't find it in the bucket. With ``s3_async`` the check
+        and upload are made by a background worker. The returned presigned
+        URL downloads the shared object as ``path``'s filename.
+
+        :return: presigned URL, or ``False`` if the upload failed
+
+        """
+        if not self.upload_breaker.available():
+            statsd.incr('bux_sql_grader.storage.skipped')
+            return False
+
+        if gzip is None:
+            gzip = self.s3_gzip
+
+        filename = os.path.basename(path)
+        try:
+            spooled = contents
+            if not isinstance(spooled, SpooledChunks):
+                spooled = SpooledChunks(contents, self.s3_spool_size)
+            keyname = self.s3_digest_keyname(spooled.digest,
+                                             os.path.splitext(filename)[1],
+                                             gzip)
+            upload = functools.partial(self.put_to_s3_by_digest, spooled,
+                                       keyname, gzip)
+            if self.s3_async and keyname not in self._s3_index:
+                if not self.get_upload_queue().submit(upload):
+                    return False
             else:
-                keyname = path
+                upload()
 
-            key = Key(bucket, keyname)
-            key.set_contents_from_string(contents, replace=True)
-            s3_url = key.generate_url(60*60*24)
+            s3_url = self.storage.url(keyname, S3_URL_EXPIRES, filename)
+        except CircuitOpen as e:
+            log.info("Skipping results upload: %s", e)
+            s3_url = False
         except Exception as e:
             log.error("Error uploading results to S3: %s", e)
             s3_url = False
 
         return s3_url
 
+    def s3_digest_keyname(self, digest, ext, gzip=False):
+        """ Returns the shared key name for contents with a digest """
+        if gzip:
+            digest += "-gz"
+        return self.s3_keyname(os.path.join("shared", digest + ext))
+
+    def put_to_s3_by_digest(self, spooled, keyname, gzip=None):
+        """ Uploads spooled contents unless ``keyname`` already exists """
+        if self.s3_key_is_known(keyname):
+            statsd.incr('bux_sql_grader.s3.dedup.hit')
+            return
+        statsd.incr('bux_sql_grader.s3.dedup.miss')
+        self.put_to_s3(iter(spooled), keyname, gzip)
+        self._s3_index.set(keyname, time.time())
+
+    def s3_key_is_known(self, keyname):
+        """ Checks the local index, then storage, for an existing key """
+        seen = self._s3_index.get(keyname)
+        if seen and time.time() - seen < self.s3_index_ttl:
+            return True
+
+        if self.storage.exists(keyname):
+            self._s3_index.set(keyname, time.time())
+            return True
+
+        return False
+
+    def get_upload_queue(self):
+        """ Returns the background upload queue for this process """
+        with self._upload_queue_lock:
+            if self._upload_queue is None or self._upload_queue_pid != os.getpid():
+                self._upload_queue = BackgroundQueue(
+                    name='bux_sql_grader.upload_queue',
+                    workers=self.s3_async_workers,
+                    maxsize=self.s3_async_queue_size)
+                self._upload_queue_pid = os.getpid()
+
+                # Drain pending uploads before the interpreter exits
+                atexit.register(self._upload_queue.close,
+                                self.s3_async_drain_timeout)
+
+        return self._upload_queue
+
+    def close_upload_queue(self, timeout=None):
+        """ Waits for queued uploads to finish and stops the workers """
+        with self._upload_queue_lock:
+            queue = self._upload_queue
+            self._upload_queue = None
+
+        if queue is not None:
+            queue.close(timeout)
+
 
 class MySQLEvaluator(S3UploaderMixin, BaseEvaluator):
         """ An evaluator class that handles SQL problems. """
@@ -189,7 +565,16 @@ class MySQLEvaluator(S3UploaderMixin, BaseEvaluator):
 
         def __init__(self, database, host, user, passwd, port=3306, timeout=10,
                      select_limit=10000, download_icon=None,
-                     s3_upload=True, *args, **kwargs):
+                     s3_upload=True, answer_cache_size=128,
+                     max_response_bytes=None, max_cell_chars=None,
+                     max_result_bytes=None, runaway_history=None,
+                     runaway_min_kills=1, runaway_ttl=60*60*24,
+                     timing_sink=None,
+                     profile_dir=None, profile_sample_rate=0.01,
+                     profile_threshold=5, profile_keep=100,
+                     slow_log=None, slow_threshold=5, slow_query_threshold=2,
+                     slow_explain=True, slow_explain_timeout=5,
+                     adaptive_fetch=False, tag_queries=False, *args, **kwargs):
             self.database = database
             self.host = host
             self.user = user
@@ -199,6 +584,59 @@ class MySQLEvaluator(S3UploaderMixin, BaseEvaluator):
             self.select_limit = select_limit
             self.s3_upload = s3_upload
 
+            # Response size limits (``None`` for unlimited)
+            self.max_response_bytes = max_response_bytes
+            self.max_cell_chars = max_cell_chars
+
+            # Result set size limit, in bytes (``None`` for unlimited)
+            self.max_result_bytes = max_result_bytes
+
+            # Size student fetches from the grader answer's row count
+            self.adaptive_fetch = adaptive_fetch
+
+            # Rendered grader tables / warnings, keyed by answer
+            self.answer_cache = AnswerCache(answer_cache_size)
+
+            # Prefix student statements with their anonymous ID, for
+            # ``sqlmon.py --fair-share student``
+            self.tag_queries = tag_queries
+
+            # Statements killed by sqlmon.py (see ``sqlmon.py --history``)
+            self.runaway_queries = None
+            if runaway_history:
+                self.runaway_queries = RunawayQueries(runaway_history,
+                                                      runaway_min_kills,
+                                                      runaway_ttl)
+
+            # Per-evaluation timing records: ``None`` (off), ``"log"`` or a
+            # callable that is passed each record as a dict
+            if timing_sink == "log":
+                timing_sink = LogTimingSink()
+            elif timing_sink is not None and not callable(timing_sink):
+                raise ImproperlyConfiguredGrader(
+                    "Unknown timing sink: %s" % timing_sink)
+            self.timing_sink = timing_sink
+            self._timing = threading.local()
+
+            # Profiles of a sample of slow evaluations
+            self.profiler = None
+            if profile_dir:
+                self.profiler = EvaluationProfiler(profile_dir,
+                                                   profile_sample_rate,
+                                                   profile_threshold,
+                                                   profile_keep)
+
+            # Log of slow evaluations, with EXPLAIN output of their queries
+            self.slow_log = None
+            if slow_log:
+                self.slow_log = SlowEvaluationLog(slow_log, slow_threshold,
+                                                  slow_query_threshold)
+            self.slow_explain = slow_explain
+            self.slow_explain_timeout = slow_explain_timeout
+            self._slow_log_queue = None
+            self._slow_log_queue_pid = None
+            self._slow_log_queue_lock = threading.Lock()
+
             # Path to CSV download icon
             if download_icon:
                 self.download_icon = download_icon
@@ -264,7 +702,53 @@ class MySQLEvaluator(S3UploaderMixin, BaseEvaluator):
             This method is automatically called by the evaluator worker
             process when used with the ``bux_grader_framework``.
 
+            If a ``timing_sink`` is configured, phase timings, row counts and
+            cache hits for the submission are passed to it once evaluation
+            finishes.
+
+            If ``profile_dir`` is set, a ``profile_sample_rate`` fraction of
+            evaluations are run under cProfile and profiles of those taking
+            ``profile_threshold`` seconds or more are saved to the directory.
+
+            If ``slow_log`` is set, evaluations taking ``slow_threshold``
+            seconds or more (or spending ``slow_query_threshold`` seconds
+            or more running queries) are logged to that file.
+
             """
+            if self.timing_sink is None and self.slow_log is None:
+                return self.profile_submission(submission)
+
+            timing = EvaluationTiming(
+                submission["xqueue_header"].get("submission_id"))
+            self._timing.record = timing
+            try:
+                return self.profile_submission(submission)
+            except Exception as e:
+                timing.flag("error", e.__class__.__name__)
+                raise
+            finally:
+                self._timing.record = None
+                timing.finish()
+                if self.timing_sink is not None:
+                    self.emit_timing(timing)
+                if self.slow_log is not None:
+                    self.log_slow_evaluation(timing)
+
+        def profile_submission(self, submission):
+            """ Evaluates a submission, under the profiler if it is sampled """
+            if self.profiler is None or not self.profiler.should_sample():
+                return self.evaluate_submission(submission)
+
+            self.current_timing().flag("profiled")
+            name = "%s-%s" % (
+                submission["xqueue_header"].get("submission_id"),
+                query_fingerprint(submission["xqueue_body"]["student_response"]))
+            return self.profiler.profile(name, self.evaluate_submission,
+                                         submission)
+
+        def evaluate_submission(self, submission):
+            """ Evaluates a submission, returning the grader response dict """
+            timing = self.current_timing()
             header = submission["xqueue_header"]
             body = submission["xqueue_body"]
             payload = self.parse_grader_payload(body["grader_payload"])
@@ -277,86 +761,378 @@ class MySQLEvaluator(S3UploaderMixin, BaseEvaluator):
                 response["msg"] = WARNING_TMPL.substitute(msg=msg)
                 return response
 
-            db = self.db_connect(payload["database"])
-            self.set_select_limit(db)
+            with timing.span("filter"):
+                student_response = self.filter_query(body["student_response"])
+            timing.describe(payload["database"], student_response)
+
+            # Don't re-run queries sqlmon has had to kill
+            if self.is_runaway_query(student_response):
+                timing.flag("runaway_query")
+                response["msg"] = RUNAWAY_QUERY
+                return response
+
+            with timing.span("connect"):
+                db = self.db_connect(payload["database"])
+            with timing.span("select_limit"):
+                self.set_select_limit(db)
+
+            with timing.span("filter"):
+                grader_response = self.filter_query(payload["answer"])
+
+            try:
+                db, grader_results, fetch_limit = self.run_grader_first(
+                    db, grader_response, payload)
+            except InvalidQuery as e:
+                return self.invalid_grader_response(response, e)
 
             # Evaluate the students response
-            student_warnings = []
-            student_response = self.filter_query(body["student_response"])
             try:
-                student_results = self.execute_query(db, student_response)
+                student_results = self.run_student_query(
+                    db, self.tag_student_query(student_response, body),
+                    fetch_limit)
             except InvalidQuery as e:
                 context = {"error": xml_escape(str(e))}
                 response["msg"] = INVALID_STUDENT_QUERY.substitute(context)
-                db.close()
                 return response
 
-            # Let the student know their query was insane.
-            if len(student_results[1]) == self.select_limit:
-                student_warnings.append("The result set below is incomplete. Your query was modified to LIMIT results to %d rows. Consider adding a WHERE or LIMIT clause to narrow down results, and check any JOIN statements to make sure you're joining ON the appropriate columns." % self.select_limit)
-
             # Evaluate the canonical grader answer (if present)
-            grader_warnings = []
-            grader_response = self.filter_query(payload["answer"])
-            if grader_response:
+            if grader_response and grader_results is None:
+                db = self.db_reconnect(db, payload["database"])
                 try:
-                    grader_results = self.execute_query(db, grader_response)
+                    grader_results = self.execute_grader_query(
+                        db, grader_response)
                 except InvalidQuery as e:
-                    context = {"error": xml_escape(str(e))}
-                    response["msg"] = INVALID_GRADER_QUERY.substitute(context)
-                    db.close()
-                    return response
-
-                # Let the course authors know their query was insane.
-                if len(grader_results[1]) == self.select_limit:
-                    grader_warnings.append("The result set below is incomplete. Your query was modified to LIMIT results to %d rows. Consider adding a WHERE or LIMIT clause to narrow down results, and check any JOIN statements to make sure you're joining ON the appropriate columns." % self.select_limit)
-
-                correct, score, hints = self.grade_results(student_response,
-                                                           student_results,
-                                                           grader_response,
-                                                           grader_results,
-                                                           payload["scale"])
-            else:
+                    return self.invalid_grader_response(response, e)
+
+            correct, score, hints, grader_warnings, answer_key = (
+                self.grade_submission(student_response, student_results,
+                                      grader_response, grader_results,
+                                      payload))
+
+            # Upload results CSV to S3
+            download_link = self.upload_student_results(
+                header, payload, correct, student_results)
+
+            # Let the student know their query was insane. (Sampled results
+            # are counted in full if they were uploaded.)
+            student_warnings = self.result_warnings(student_results)
+
+            # Build the grader response dict
+            with timing.span("render"):
+                response = self.build_response(correct=correct,
+                                               score=score,
+                                               hints=hints,
+                                               student_results=student_results,
+                                               student_warnings=student_warnings,
+                                               grader_results=grader_results,
+                                               grader_warnings=grader_warnings,
+                                               row_limit=payload["row_limit"],
+                                               download_link=download_link,
+                                               answer_key=answer_key)
+            timing.count("response_bytes", html_size(response["msg"]))
+
+            self.close_results(db, student_results)
+            return response
+
+        def tag_student_query(self, stmt, body):
+            """ Prefixes a student statement with the student's anonymous ID
+            if ``tag_queries`` is set, so ``sqlmon.py`` can attribute it to
+            them even though every student shares the grader's MySQL account.
+
+            """
+            if not self.tag_queries:
+                return stmt
+
+            student_info = body.get("student_info") or {}
+            if isinstance(student_info, basestring):
+                try:
+                    student_info = json.loads(student_info)
+                except ValueError:
+                    student_info = {}
+            return tag_statement(stmt, student_info.get("anonymous_student_id"))
+
+        def run_grader_first(self, db, grader_response, payload):
+            """ Runs the grader answer ahead of the student query in adaptive
+            mode, so that only as many student rows as scoring and display
+            need are fetched up front. The rest are left for the results CSV.
+
+            :returns: a three item tuple: (connection for the student query,
+                      grader results, student fetch limit). The results and
+                      limit are ``None`` unless the answer was run.
+            :raises InvalidQuery: if the grader answer fails (the connection
+                                  is closed)
+
+            """
+            if not (self.adaptive_fetch and grader_response):
+                return db, None, None
+
+            grader_results = self.execute_grader_query(db, grader_response)
+            fetch_limit = self.student_fetch_limit(grader_results,
+                                                   payload["row_limit"])
+            db = self.db_reconnect(db, payload["database"])
+            return db, grader_results, fetch_limit
+
+        def run_student_query(self, db, tagged_response, fetch_limit=None):
+            """ Runs the student query, fetching only ``fetch_limit`` rows up
+            front if it is set.
+
+            :raises InvalidQuery: if the query fails (the connection is
+                                  closed)
+
+            """
+            timing = self.current_timing()
+            try:
+                if fetch_limit:
+                    student_results = self.execute_query(db, tagged_response,
+                                                         fetch_limit)
+                else:
+                    student_results = self.execute_query(db, tagged_response)
+            except InvalidQuery:
+                timing.flag("invalid_query")
+                db.close()
+                raise
+            timing.count("student_rows", len(student_results[1]))
+            if isinstance(student_results[1], SampledRows):
+                timing.flag("sampled_rows")
+            return student_results
+
+        def grade_submission(self, student_response, student_results,
+                             grader_response, grader_results, payload):
+            """ Grades the student results against the grader answer's.
+
+            :returns: a five item tuple: (correct, score, hints, grader
+                      warnings, answer cache key)
+
+            """
+            if not grader_response:
                 # If no grader answer was found in the payload this is a
                 # sandbox query. These are always correct.
-                correct = True
-                score = 1.0
-                hints = []
-                grader_results = None
+                return True, 1.0, [], [], None
 
-            # Upload results CSV to S3
-            download_link = ""
-            if payload["upload_results"]:
+            timing = self.current_timing()
+            timing.count("grader_rows", len(grader_results[1]))
 
-                # Ensure student query generated result rows
-                if student_results[1]:
+            # Let the course authors know their query was insane.
+            grader_warnings = self.result_warnings(grader_results)
 
-                    # Store results by their pull key (hash of pull time + ID)
-                    key = header["submission_key"]
-                    filename = payload["filename"]
+            with timing.span("grade"):
+                correct, score, hints = self.grade_results(
+                    student_response, student_results, grader_response,
+                    grader_results, payload["scale"])
+            answer_key = (payload["database"], grader_response)
+            return correct, score, hints, grader_warnings, answer_key
 
-                    # Prefix filename if student response was incorrect
-                    if not correct:
-                        filename = "incorrect-" + filename
-                    filepath = os.path.join(key, filename)
+        def close_results(self, db, results):
+            """ Drops any sampled rows left in ``results``, then closes
+            ``db``.
 
-                    download_link = self.upload_results(student_results,
-                                                        filepath)
+            """
+            if isinstance(results[1], SampledRows):
+                results[1].close()
+            self.db_close(db)
 
-            # Build the grader response dict
-            response = self.build_response(correct=correct,
-                                           score=score,
-                                           hints=hints,
-                                           student_results=student_results,
-                                           student_warnings=student_warnings,
-                                           grader_results=grader_results,
-                                           grader_warnings=grader_warnings,
-                                           row_limit=payload["row_limit"],
-                                           download_link=download_link)
+        def execute_grader_query(self, db, grader_response):
+            """ Runs the grader answer, closing ``db`` if it fails """
+            try:
+                return self.execute_query(db, grader_response)
+            except InvalidQuery:
+                db.close()
+                raise
 
-            db.close()
+        def upload_student_results(self, header, payload, correct,
+                                   student_results):
+            """ Uploads the student results CSV if the problem asks for it
+            and the query returned rows.
+
+            :returns: the download link, or an empty string
+
+            """
+            # Ensure student query generated result rows
+            if not payload["upload_results"] or not student_results[1]:
+                return ""
+
+            # Store results by their pull key (hash of pull time + ID)
+            key = header["submission_key"]
+            filename = payload["filename"]
+
+            # Prefix filename if student response was incorrect
+            if not correct:
+                filename = "incorrect-" + filename
+            filepath = os.path.join(key, filename)
+
+            with self.current_timing().span("upload"):
+                return self.upload_results(student_results, filepath)
+
+        def invalid_grader_response(self, response, error):
+            """ Sets the response message for a failed grader answer """
+            self.current_timing().flag("invalid_grader_query")
+            context = {"error": xml_escape(str(error))}
+            response["msg"] = INVALID_GRADER_QUERY.substitute(context)
             return response
 
+        def student_fetch_limit(self, grader_results, row_limit):
+            """ Returns the number of student result rows needed to score
+            against ``grader_results`` and display ``row_limit`` rows, or
+            ``None`` if all rows are needed.
+
+            """
+            if not row_limit or isinstance(grader_results[1], PartialRows):
+                return None
+
+            limit = max(ADAPTIVE_FETCH_FACTOR * len(grader_results[1]) + 1,
+                        row_limit)
+            if self.select_limit and limit >= self.select_limit:
+                return None
+            return limit
+
+        def current_timing(self):
+            """ Returns the timing record of the evaluation running in this
+            thread, or a no-op stand in if there isn't one.
+
+            """
+            return getattr(self._timing, "record", None) or NULL_TIMING
+
+        def emit_timing(self, timing):
+            """ Passes a finished timing record to the timing sink """
+            try:
+                self.timing_sink(timing.as_dict())
+            except Exception:
+                log.exception("Error emitting evaluation timing")
+
+        def log_slow_evaluation(self, timing):
+            """ Queues a finished timing record to be written to the slow
+            evaluation log if the evaluation was slow.
+
+            Entries are written by a background thread, so that explaining
+            the query doesn't hold up the response.
+
+            """
+            if not self.slow_log.is_slow(timing):
+                return
+
+            statsd.incr('bux_sql_grader.slow_evaluation')
+            self.get_slow_log_queue().submit(self.record_slow_evaluation,
+                                             timing)
+
+        def get_slow_log_queue(self):
+            """ Returns the slow evaluation log queue for this process """
+            with self._slow_log_queue_lock:
+                if (self._slow_log_queue is None or
+                        self._slow_log_queue_pid != os.getpid()):
+                    self._slow_log_queue = BackgroundQueue(
+                        name='bux_sql_grader.slow_log', workers=1,
+                        maxsize=SLOW_LOG_QUEUE_SIZE, retries=0, put_timeout=0)
+                    self._slow_log_queue_pid = os.getpid()
+
+                    # Write pending entries before the interpreter exits
+                    atexit.register(self._slow_log_queue.close,
+                                    self.slow_explain_timeout)
+
+            return self._slow_log_queue
+
+        def record_slow_evaluation(self, timing):
+            """ Writes a slow evaluation to the log.
+
+            The student query is explained the first time its fingerprint is
+            logged by this process.
+
+            """
+            try:
+                explain = None
+                if (self.slow_explain and timing.statement and
+                        self.slow_log.needs_explain(
+                            query_fingerprint(timing.statement))):
+                    explain = self.explain_query(timing.database,
+                                                 timing.statement)
+                self.slow_log.record(timing, explain)
+            except Exception:
+                log.exception("Error logging slow evaluation")
+
+        def explain_query(self, database, stmt):
+            """ Returns the ``EXPLAIN`` output of a single ``SELECT``
+            statement as a list of dicts, or ``None`` for anything else.
+
+            The statement is explained on a separate connection, since the
+            one used for evaluation may still be in use. It is killed if it
+            runs for ``slow_explain_timeout`` seconds.
+
+            """
+            stmt = self.single_select(stmt)
+            if stmt is None:
+                return None
+
+            db = self.db_connect(database)
+            watchdog = threading.Timer(self.slow_explain_timeout,
+                                       self.kill_query,
+                                       (database, db.thread_id()))
+            watchdog.daemon = True
+            watchdog.start()
+            try:
+                cursor = db.cursor()
+                cursor.execute("EXPLAIN " + stmt)
+                cols = [unicode(col[0], 'utf-8') for col in cursor.description]
+                rows = cursor.fetchall()
+                cursor.close()
+            except (OperationalError, Warning, Error) as e:
+                log.warning("Could not explain query: %s", e)
+                return None
+            finally:
+                watchdog.cancel()
+                db.close()
+
+            return [dict(zip(cols, row)) for row in rows]
+
+        def kill_query(self, database, thread_id):
+            """ Stops the statement running on another connection """
+            log.warning("Killing query on connection %d", thread_id)
+            statsd.incr('bux_sql_grader.kill_query')
+            try:
+                db = self.db_connect(database)
+            except ImproperlyConfiguredGrader:
+                return
+
+            try:
+                db.query("KILL QUERY %d" % thread_id)
+            except Error as e:
+                log.warning("Could not kill query: %s", e)
+            finally:
+                db.close()
+
+        def warm_answer(self, payload, render=True):
+            """ Runs a problem's grader answer and caches its rendered results
+            table and warnings, as a submission to the problem would.
+
+            :param dict payload: the problem's grader payload
+            :param bool render: render and cache the results markup. Without
+                                it only database caches are warmed.
+            :return: the grader query results, or ``None`` if the payload
+                     has no answer
+
+            :raises InvalidQuery: if the answer could not be executed
+
+            """
+            payload = self.parse_grader_payload(payload)
+            answer = self.filter_query(payload["answer"])
+            if not answer:
+                return None
+
+            db = self.db_connect(payload["database"])
+            try:
+                self.set_select_limit(db)
+                results = self.execute_query(db, answer)
+            finally:
+                self.db_close(db)
+
+            if render:
+                answer_key = (payload["database"], answer)
+                self.check_answer_cache(answer_key, results)
+                warnings = self.result_warnings(results)
+                if warnings:
+                    self.grader_warnings_html(answer_key, warnings)
+                self.grader_results_html(answer_key, results,
+                                         payload["row_limit"])
+            return results
+
         def is_legal_query_length(self, query):
             """ Checks a query to determine if it exceeds MAX_QUERY_LENGTH. """
             if len(query) > MAX_QUERY_LENGTH:
@@ -432,20 +1208,33 @@ class MySQLEvaluator(S3UploaderMixin, BaseEvaluator):
 
             return query
 
-        def execute_query(self, db, stmt):
+        def execute_query(self, db, stmt, fetch_limit=None):
             """ Execute the SQL query
 
                 :param db: a MySQLdb connection object
                 :param string stmt: the SQL query to run
+                :param int fetch_limit: fetch at most this many rows. If there
+                                        may be more they are returned as
+                                        :class:`SampledRows`, and the
+                                        connection can't be used for other
+                                        queries until they are closed.
 
                 :raises InvalidQuery: if the query could not be executed
 
             """
+            timing = self.current_timing()
             timer = statsd.timer('bux_sql_grader.execute_query').start()
-            cursor = db.cursor()
+            if self.max_result_bytes or fetch_limit:
+                # Rows are read from the server as they are fetched so
+                # results can be abandoned part way through
+                cursor = db.cursor(MySQLdb.cursors.SSCursor)
+            else:
+                cursor = db.cursor()
             try:
-                cursor.execute(stmt)
-                rows = cursor.fetchall()
+                with timing.span("execute"):
+                    cursor.execute(stmt)
+                with timing.span("fetch"):
+                    rows = self.fetch_rows(cursor, fetch_limit)
 
                 cols = ()
                 if cursor.description:
@@ -454,7 +1243,13 @@ class MySQLEvaluator(S3UploaderMixin, BaseEvaluator):
                     # column headings.
                     cols = tuple(unicode(col[0], 'utf-8') for col in cursor.description)
 
-                cursor.close()
+                if isinstance(rows, PartialRows):
+                    self.abandon_results(db)
+                elif fetch_limit and len(rows) == fetch_limit:
+                    rows = SampledRows(rows, cursor, functools.partial(
+                        self.abandon_results, db))
+                else:
+                    cursor.close()
             except (OperationalError, Warning, Error) as e:
                 msg = e.args[1]
                 code = e.args[0]
@@ -463,6 +1258,123 @@ class MySQLEvaluator(S3UploaderMixin, BaseEvaluator):
                 timer.stop()
             return cols, rows
 
+        def abandon_results(self, db):
+            """ Closes a connection without reading the rest of its result
+            set, which would otherwise have to be read before the connection
+            could be used again. The server stops the query once it can't
+            send more rows.
+
+            """
+            statsd.incr('bux_sql_grader.execute_query.abandoned')
+            db.close()
+
+        def db_reconnect(self, db, database):
+            """ Returns ``db``, or a new connection (with the session SELECT
+            limit set) if it was closed by ``abandon_results``.
+
+            """
+            if db.open:
+                return db
+            with self.current_timing().span("connect"):
+                db = self.db_connect(database)
+            self.set_select_limit(db)
+            return db
+
+        def db_close(self, db):
+            """ Closes ``db`` unless ``abandon_results`` already has """
+            if db.open:
+                db.close()
+
+        def fetch_rows(self, cursor, limit=None):
+            """ Fetches result rows (at most ``limit``, if set) from an
+            executed cursor.
+
+            If ``max_result_bytes`` is set rows are fetched in batches sized
+            to fit in what is left of the limit, and fetching stops once
+            their converted size would pass it. A :class:`PartialRows` tuple
+            is returned in that case, and the rest of the result set is left
+            unread.
+
+            """
+            if not self.max_result_bytes and not limit:
+                return cursor.fetchall()
+
+            rows = []
+            size = 0
+            while limit is None or len(rows) < limit:
+                batch_size = FETCH_BATCH_SIZE
+                if self.max_result_bytes:
+                    batch_size = fetch_batch_size(len(rows), size,
+                                                  self.max_result_bytes)
+                if limit is not None:
+                    batch_size = min(batch_size, limit - len(rows))
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                if not self.max_result_bytes:
+                    rows.extend(batch)
+                    continue
+                for row in batch:
+                    size += result_row_size(row)
+                    if size > self.max_result_bytes:
+                        log.info("Result set exceeded %d bytes after %d rows",
+                                 self.max_result_bytes, len(rows))
+                        statsd.incr('bux_sql_grader.execute_query.truncated')
+                        self.current_timing().count("result_bytes", size)
+                        return PartialRows(rows)
+                    rows.append(row)
+
+            if self.max_result_bytes:
+                self.current_timing().count("result_bytes", size)
+            return tuple(rows)
+
+        def result_warnings(self, results):
+            """ Returns warnings for query results that were cut short """
+            rows = results[1]
+            if isinstance(rows, PartialRows):
+                return [self.result_size_warning()]
+
+            count = len(rows)
+            if isinstance(rows, SampledRows) and rows.total is not None:
+                count = rows.total
+            if count == self.select_limit:
+                return ["The result set below is incomplete. Your query was modified to LIMIT results to %d rows. Consider adding a WHERE or LIMIT clause to narrow down results, and check any JOIN statements to make sure you're joining ON the appropriate columns." % self.select_limit]
+            return []
+
+        def result_size_warning(self):
+            """ Warning shown with results cut short by ``max_result_bytes`` """
+            return "The result set below is incomplete. Your query returned more than %d KB of data, so only the rows that fit were kept. Consider selecting fewer columns, or adding a WHERE or LIMIT clause to narrow down results." % (
+                max(self.max_result_bytes // 1024, 1))
+
+        def single_select(self, stmt):
+            """ Returns ``stmt`` without a trailing semicolon if it is a
+            single ``SELECT`` statement, otherwise ``None``.
+
+            """
+            stmts = sqlparse.split(stmt)
+            if len(stmts) != 1 or sqlparse.parse(stmts[0])[0].get_type() != "SELECT":
+                return None
+            return stmts[0].rstrip().rstrip(";")
+
+        def is_runaway_query(self, stmt):
+            """ Checks whether a statement was recently killed by sqlmon """
+            if self.runaway_queries is None or not stmt:
+                return False
+
+            try:
+                entry = self.runaway_queries.get(stmt)
+            except Exception as e:
+                log.error("Error reading kill history: %s", e)
+                return False
+
+            if entry is None:
+                return False
+
+            log.info("Rejecting statement killed %d time(s) by sqlmon: %s",
+                     entry["count"], entry["fingerprint"])
+            statsd.incr('bux_sql_grader.runaway_query.rejected')
+            return True
+
         def grade_results(self, student_answer, student_results, grader_answer,
                           grader_results, scale=None):
             """ Compares student and grader responses to generate a score """
@@ -491,11 +1403,30 @@ class MySQLEvaluator(S3UploaderMixin, BaseEvaluator):
             if not message:
                 message = "Download full results"
 
-            # Convert result rows to CSV
-            csv_results = self.csv_results(results)
+            try:
+                spooled = self.spool_sampled_csv(results)
+            except Error as e:
+                log.warning("Could not fetch remaining result rows: %s", e)
+                statsd.incr('bux_sql_grader.upload_results.fetch_failed')
+                timer.stop()
+                return UPLOAD_FAILED_MESSAGE
+
+            def make_contents():
+                if spooled is not None:
+                    return iter(spooled)
+                return self.csv_chunks(results)
+
+            # Upload to S3, converting result rows to CSV as they are sent
+            if self.s3_content_addressed:
+                s3_url = self.upload_to_s3_by_digest(
+                    spooled if spooled is not None else make_contents(), path)
+            elif self.s3_async:
+                s3_url = self.upload_to_s3_async(make_contents, path)
+            else:
+                s3_url = self.upload_to_s3(make_contents(), path)
+            if spooled is not None and not self.s3_async:
+                spooled.close()
 
-            # Upload to S3
-            s3_url = self.upload_to_s3(csv_results, path)
             if s3_url:
                 context = {"url": xml_escape(s3_url), "message": xml_escape(message),
                            "icon_src": xml_escape(self.download_icon)}
@@ -509,126 +1440,257 @@ class MySQLEvaluator(S3UploaderMixin, BaseEvaluator):
         def build_response(self, correct, score, hints, student_results,
                            student_warnings=[], grader_results=None,
                            grader_warnings=[], row_limit=None,
-                           download_link=""):
-            """ Builds a grader response dict. """
+                           download_link="", answer_key=None):
+            """ Builds a grader response dict.
+
+            If ``answer_key`` (a ``(database, answer)`` tuple) is passed the
+            rendered grader table and warnings are cached for reuse by later
+            submissions to the same problem, for as long as the answer keeps
+            returning the same ``grader_results``.
+
+            If ``max_response_bytes`` is set the message is kept under that
+            size. Each block of warnings, and the hints, may use up to
+            ``RESPONSE_MESSAGE_SHARE`` of the budget and are shortened to
+            fit. The expected results table may use up to half of the budget,
+            and the student table gets whatever is left once everything else
+            has been rendered.
+
+            """
 
             response = {"correct": correct, "score": score}
 
+            if grader_results:
+                self.check_answer_cache(answer_key, grader_results)
+
             # Response message template context
             context = {"download_link": download_link, "hints": ""}
 
-            # Generate student response results table
-            context["student_results"] = self.html_results(student_results,
-                                                           row_limit)
+            budget = self.max_response_bytes
+            message_budget = self.message_budget()
 
             # Generate warning messages if queries had to be modified
             notices = ""
             if student_warnings:
-                student_warnings = [xml_escape(notice) for notice in student_warnings]
-                student_warning = "<strong>Warning</strong><p>"
-                student_warning += "</p><p>".join(student_warnings) + "</p>"
-                notices += WARNING_TMPL.substitute(msg=student_warning)
+                notices += fit_messages(self.html_warnings, student_warnings,
+                                        message_budget)
 
             if grader_warnings:
-                grader_warnings = [xml_escape(notice) for notice in grader_warnings]
-                grader_warning = "<strong>Warning</strong><p>"
-                grader_warning += "</p><p>".join(grader_warnings) + "</p>"
-                notices += WARNING_TMPL.substitute(msg=grader_warning)
+                notices += self.grader_warnings_html(answer_key,
+                                                     grader_warnings)
 
             context["notices"] = notices
 
             if grader_results and not correct:
 
                 # Generate grader response results table
-                context["grader_results"] = self.html_results(grader_results,
-                                                              row_limit)
+                context["grader_results"] = self.grader_results_html(
+                    answer_key, grader_results, row_limit)
 
                 # Generate hints markup if hints were provided
                 if hints:
-                    # Ensure hint text is XML-safe
-                    hints = [xml_escape(hint) for hint in hints]
+                    context["hints"] = fit_messages(self.html_hints, hints,
+                                                    message_budget)
+
+                template = INCORRECT_QUERY
+            else:
+                template = CORRECT_QUERY
+
+            # Generate student response results table with the remaining budget
+            student_budget = None
+            if budget:
+                context["student_results"] = ""
+                used = html_size(template.substitute(context))
+                student_budget = max(budget - used, 0)
+            context["student_results"] = self.html_results(student_results,
+                                                           row_limit,
+                                                           student_budget)
+
+            response["msg"] = template.substitute(context)
+            return response
 
-                    hints_html = "<strong>Hints</strong>"
-                    hints_html += "<ul><li>"
-                    hints_html += "</li><li>".join(hints)
-                    hints_html += "</li></ul>"
+        def message_budget(self):
+            """ Returns the bytes each block of warnings or hints may use,
+            or ``None`` if responses aren't limited.
 
-                    context["hints"] = hints_html
+            """
+            if not self.max_response_bytes:
+                return None
+            return int(self.max_response_bytes * RESPONSE_MESSAGE_SHARE)
+
+        def grader_warnings_html(self, answer_key, warnings):
+            """ Returns the (cached) warnings markup for a grader answer """
+            return self.cached_answer_html(answer_key, ("grader_warnings",),
+                                           fit_messages, self.html_warnings,
+                                           warnings, self.message_budget())
+
+        def grader_results_html(self, answer_key, results, row_limit):
+            """ Returns the (cached) expected results table for a grader
+            answer, which may use up to half of ``max_response_bytes``.
+
+            """
+            budget = self.max_response_bytes
+            return self.cached_answer_html(answer_key,
+                                           ("grader_results", row_limit),
+                                           self.html_results, results,
+                                           row_limit,
+                                           budget // 2 if budget else None)
+
+        def check_answer_cache(self, answer_key, results):
+            """ Drops markup cached for a grader answer if it no longer
+            returns ``results`` (e.g. its dataset was reloaded).
+
+            """
+            if answer_key is None:
+                return
+
+            database, answer = answer_key
+            if self.answer_cache.check(database, answer, results):
+                statsd.incr('bux_sql_grader.answer_cache.stale')
 
-                # Incorrect response template
-                response["msg"] = INCORRECT_QUERY.substitute(context)
+        def cached_answer_html(self, answer_key, name, render, *args):
+            """ Returns markup derived from a grader answer, rendering it with
+            ``render(*args)`` on a cache miss.
+
+            """
+            if answer_key is None:
+                return render(*args)
+
+            database, answer = answer_key
+            html = self.answer_cache.get(database, answer, name)
+            hit = html is not None
+            if not hit:
+                statsd.incr('bux_sql_grader.answer_cache.miss')
+                html = render(*args)
+                self.answer_cache.set(database, answer, name, html)
             else:
-                # Correct response template
-                response["msg"] = CORRECT_QUERY.substitute(context)
+                statsd.incr('bux_sql_grader.answer_cache.hit')
+            self.current_timing().flag("answer_cache." + name[0], hit)
+            return html
 
-            return response
+        def html_warnings(self, warnings):
+            """ Format a list of warning messages for display as HTML """
+            warnings = [xml_escape(notice) for notice in warnings]
+            msg = "<strong>Warning</strong><p>"
+            msg += "</p><p>".join(warnings) + "</p>"
+            return WARNING_TMPL.substitute(msg=msg)
+
+        def html_hints(self, hints):
+            """ Format a list of hints for display as HTML """
+            # Ensure hint text is XML-safe
+            hints = [xml_escape(hint) for hint in hints]
+
+            hints_html = "<strong>Hints</strong>"
+            hints_html += "<ul><li>"
+            hints_html += "</li><li>".join(hints)
+            hints_html += "</li></ul>"
+            return hints_html
 
         def csv_results(self, results):
             """ Format result set for display as CSV """
+            return "".join(self.csv_chunks(results))
+
+        def csv_chunks(self, results, chunk_size=DEFAULT_CHUNK_SIZE):
+            """ Generate result set CSV in chunks of roughly ``chunk_size``
+            bytes
+
+            The remaining rows of :class:`SampledRows` are fetched as the CSV
+            is generated.
+
+            """
             cols, rows = results
+            if isinstance(rows, SampledRows):
+                results = (cols, itertools.chain(rows, rows.remaining()))
+            return iter_csv(results, chunk_size, self.format_csv_col)
 
-            sio = StringIO()
-            writer = csv.writer(sio)
+        def spool_sampled_csv(self, results):
+            """ Reads the rest of sampled results into a spooled CSV (see
+            :class:`~bux_sql_grader.streaming.SpooledChunks`), so the query
+            has finished on the server before the upload starts.
 
-            if cols:
-                writer.writerow([self.format_csv_col(s) for s in cols])
+            :returns: the spooled CSV, or ``None`` if ``results`` aren't
+                      sampled
 
-            for row in rows:
-                writer.writerow([self.format_csv_col(s) for s in row])
+            """
+            if not isinstance(results[1], SampledRows):
+                return None
+            return SpooledChunks(self.csv_chunks(results), self.s3_spool_size)
+
+        def complete_results(self, results):
+            """ Fetches the remaining rows of sampled results, returning the
+            full results.
 
-            csv_results = sio.getvalue()
-            sio.close()
-            return csv_results
+            """
+            cols, rows = results
+            if not isinstance(rows, SampledRows):
+                return results
+            return cols, tuple(rows) + tuple(rows.remaining())
 
         def format_html_col(self, col):
             """ Format a result column value for HTML """
-            formatted = xml_escape(unicode(col))
-
-            if col is None:
-                formatted = "NULL"
-
-            return formatted
+            return escape_html(col)
 
         def format_csv_col(self, col):
             """ Format a result column value for CSV """
-            formatted = unicode(col).encode('utf-8')
+            return format_csv_col(col)
 
-            if col is None:
-                formatted = ""
+        def html_results(self, results, row_limit=None, byte_budget=None):
+            """ Format result set for display as HTML
 
-            return formatted
+            Values longer than ``max_cell_chars`` are shortened, and rows are
+            dropped once the table would exceed ``byte_budget`` bytes. If
+            not even the table header fits, a short note is returned instead.
 
-        def html_results(self, results, row_limit=None):
-            """ Format result set for display as HTML """
+            """
             cols, rows = results
             row_count = len(rows)
 
             if row_count < 1:
-                return "<pre><code>No rows found.</code></pre>"
-
-            html = "<pre><code><table><thead>"
-            html += u"<tr><th>{}</th></tr>".format(u"</th><th>".join(self.format_html_col(col) for col in cols))
-            html += "</thead><tbody>"
-
-            for idx, row in enumerate(rows):
-                if row_limit and idx >= row_limit:
-                    break
-                html += u"<tr><td>{}</td></tr>".format(
-                        u"</td><td>".join(self.format_html_col(col) for col in row))
-
-            html += "</tbody></table></code></pre>"
+                return NO_ROWS_HTML
+
+            # The full size of sampled results is only known once they have
+            # been uploaded
+            more = False
+            if isinstance(rows, SampledRows):
+                if rows.total is None:
+                    more = True
+                else:
+                    row_count = rows.total
+
+            table_budget = None
+            if byte_budget is not None:
+                table_budget = max(byte_budget - RESULT_STATS_RESERVE, 0)
+
+            html, displayed, truncated = render_table(cols, rows, row_limit,
+                                                      table_budget,
+                                                      self.max_cell_chars,
+                                                      self.format_html_col)
+
+            # Rows within the row limit that didn't fit the budget
+            shown = len(rows)
+            if row_limit:
+                shown = min(shown, row_limit)
 
             # Stats
-            if row_limit and row_count > row_limit:
-                html += self.result_stats(row_limit, row_count)
-            else:
-                html += self.result_stats(row_count, row_count)
+            html += self.result_stats(displayed, row_count, truncated, more,
+                                      shown - displayed)
 
+            if byte_budget is not None and html_size(html) > byte_budget:
+                if html_size(RESULTS_TOO_LARGE_HTML) <= byte_budget:
+                    return RESULTS_TOO_LARGE_HTML
+                return ""
             return html
 
-        def result_stats(self, displayed, total):
-            return "<p><small>Showing %d of %s row%s.</small></p>" % (displayed, total,
-                                                                      "s"[total == 1:])
+        def result_stats(self, displayed, total, truncated=0, more=False,
+                         dropped=0):
+            stats = "Showing %d of %s%s row%s." % (
+                displayed, total, "+" if more else "", "s"[total == 1:])
+            if dropped:
+                stats += " %d more row%s left out to fit the size limit." % (
+                    dropped, "s"[dropped == 1:])
+            if truncated:
+                stats += " %d long value%s shortened." % (truncated,
+                                                          "s"[truncated == 1:])
+            return "<p><small>%s</small></p>" % stats
 
         def parse_grader_payload(self, payload):
             """ Parses the grader payload JSON object.
@@ -0,0 +1,101 @@
+"""
+    bux_sql_grader.profiling
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Profiles a sample of evaluations, keeping profiles of slow ones.
+
+"""
+
+import cProfile
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from statsd import statsd
+
+from .timing import clock
+
+
+log = logging.getLogger(__name__)
+
+#: File name extension of saved profiles
+PROFILE_SUFFIX = ".prof"
+
+
+class EvaluationProfiler(object):
+    """ Runs ``cProfile`` on a random sample of calls and saves the profile
+    of any call that takes at least ``threshold`` seconds.
+
+    Profiles are written to ``directory`` as ``<time>-<name>.prof`` (load
+    them with :mod:`pstats` or a viewer such as SnakeViz). Only the newest
+    ``keep`` profiles are kept.
+
+    cProfile slows down the code it profiles, so ``sample_rate`` should be
+    kept low in production.
+
+    :param str directory: where profiles are written
+    :param float sample_rate: fraction of calls to profile (0 - 1)
+    :param float threshold: minimum wall time, in seconds, of saved profiles
+    :param int keep: number of profiles to keep
+
+    """
+
+    def __init__(self, directory, sample_rate=0.01, threshold=5, keep=100):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.keep = keep
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def should_sample(self):
+        return random.random() < self.sample_rate
+
+    def profile(self, name, func, *args, **kwargs):
+        """ Calls ``func`` under the profiler, saving the profile as
+        ``name`` if the call is slow.
+
+        """
+        profiler = cProfile.Profile()
+        start = clock()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = clock() - start
+            if elapsed >= self.threshold:
+                self.save(profiler, name, elapsed)
+
+    def save(self, profiler, name, elapsed):
+        """ Writes a profile to the profile directory, removing old ones """
+        filename = "%d-%s%s" % (time.time(), name, PROFILE_SUFFIX)
+        path = os.path.join(self.directory, filename)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            prefix=".profile-")
+            os.close(fd)
+            profiler.dump_stats(tmp_path)
+            os.rename(tmp_path, path)
+            self.prune()
+        except (IOError, OSError) as e:
+            log.error("Could not save profile %s: %s", path, e)
+            return None
+
+        log.info("Saved profile of %.2fs evaluation to %s", elapsed, path)
+        statsd.incr('bux_sql_grader.profile.saved')
+        return path
+
+    def prune(self):
+        """ Removes all but the newest ``keep`` profiles """
+        with self._lock:
+            profiles = sorted(filename for filename in os.listdir(self.directory)
+                              if filename.endswith(PROFILE_SUFFIX))
+            for filename in profiles[:-self.keep or None]:
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
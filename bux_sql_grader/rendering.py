@@ -0,0 +1,220 @@
+"""
+    bux_sql_grader.rendering
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Renders query result sets as HTML tables.
+
+"""
+
+import re
+
+from collections import namedtuple
+
+
+#: Maps characters that are unsafe in HTML text to their entities. Matches
+#: the default behavior of ``xml.sax.saxutils.escape``.
+HTML_ESCAPE_TABLE = {
+    ord(u"&"): u"&amp;",
+    ord(u"<"): u"&lt;",
+    ord(u">"): u"&gt;",
+}
+
+NULL_HTML = u"NULL"
+
+#: Appended to values shortened by ``max_cell_chars``
+ELLIPSIS = u"\u2026"
+
+NO_ROWS_HTML = "<pre><code>No rows found.</code></pre>"
+
+#: Replaces messages dropped by ``fit_messages``
+MORE_MESSAGES = u"%d more not shown."
+
+TABLE_START = u"<pre><code><table><thead>"
+TABLE_BODY = u"</thead><tbody>"
+TABLE_END = u"</tbody></table></code></pre>"
+
+# Most result values contain nothing to escape. Checking first is much
+# cheaper than running every value through ``unicode.translate``.
+_needs_escape = re.compile(u"[&<>]").search
+
+#: The return value of ``render_table``. ``displayed`` is the number of rows
+#: rendered and ``truncated`` the number of values that were shortened.
+RenderedTable = namedtuple("RenderedTable", "html displayed truncated")
+
+
+def html_size(html):
+    """ Returns the UTF-8 encoded size of a string in bytes """
+    if isinstance(html, unicode):
+        return len(html.encode('utf-8'))
+    return len(html)
+
+
+def escape_html(value):
+    """ Format a single result value for HTML display.
+
+    ``None`` is displayed as ``NULL``. All other values are coerced to
+    unicode and escaped.
+
+    """
+    if value is None:
+        return NULL_HTML
+    if type(value) is not unicode:
+        value = unicode(value)
+    if _needs_escape(value):
+        return value.translate(HTML_ESCAPE_TABLE)
+    return value
+
+
+def clip_row(row, max_chars):
+    """ Shortens long values in a row to ``max_chars`` characters.
+
+    :returns: a two item tuple: (clipped row, number of values clipped)
+
+    """
+    clipped = []
+    count = 0
+    for value in row:
+        if value is not None:
+            if type(value) is not unicode:
+                value = unicode(value)
+            if len(value) > max_chars:
+                value = value[:max_chars] + ELLIPSIS
+                count += 1
+        clipped.append(value)
+    return clipped, count
+
+
+def row_template(tag, width):
+    """ Returns a ``%`` format string for a table row of ``width`` cells """
+    open_tag = u"<%s>" % tag
+    close_tag = u"</%s>" % tag
+    return (u"<tr>" + open_tag +
+            (close_tag + open_tag).join([u"%s"] * width) +
+            close_tag + u"</tr>")
+
+
+def render_row(template, width, row, tag=u"td", formatter=escape_html):
+    """ Render a single result row using a template from ``row_template``
+
+    :param formatter: formats a single value as HTML
+
+    """
+    cells = tuple([formatter(col) for col in row])
+    if len(cells) == width:
+        return template % cells
+
+    # Ragged rows can't use the template
+    return u"<tr><%s>%s</%s></tr>" % (tag, (u"</%s><%s>" % (tag, tag)).join(cells), tag)
+
+
+def render_table(cols, rows, row_limit=None, byte_budget=None,
+                 max_cell_chars=None, formatter=escape_html):
+    """ Render a result set as an HTML table.
+
+    Output is collected in a list and joined once so rendering time stays
+    linear in the number of displayed cells.
+
+    :param tuple cols: result column names
+    :param rows: sequence of result rows
+    :param int row_limit: maximum number of rows to display
+    :param int byte_budget: stop adding rows before the table exceeds this
+                            many (UTF-8 encoded) bytes
+    :param int max_cell_chars: shorten values longer than this
+    :param formatter: formats a single value as HTML (defaults to
+                      ``escape_html``)
+    :returns: a ``RenderedTable``
+
+    """
+    width = len(cols)
+    if row_limit and len(rows) > row_limit:
+        rows = rows[:row_limit]
+
+    head_template = row_template(u"th", width)
+    body_template = row_template(u"td", width)
+
+    truncated = 0
+    if max_cell_chars:
+        cols, truncated = clip_row(cols, max_cell_chars)
+
+    parts = [TABLE_START, render_row(head_template, width, cols, u"th", formatter),
+             TABLE_BODY]
+
+    if byte_budget is None and not max_cell_chars:
+        parts.extend([render_row(body_template, width, row, formatter=formatter)
+                      for row in rows])
+        parts.append(TABLE_END)
+        return RenderedTable(u"".join(parts), len(rows), truncated)
+
+    used = sum(html_size(part) for part in parts) + html_size(TABLE_END)
+    displayed = 0
+    for row in rows:
+        clipped = 0
+        if max_cell_chars:
+            row, clipped = clip_row(row, max_cell_chars)
+        html = render_row(body_template, width, row, formatter=formatter)
+
+        if byte_budget is not None:
+            size = html_size(html)
+            if used + size > byte_budget:
+                break
+            used += size
+
+        parts.append(html)
+        truncated += clipped
+        displayed += 1
+
+    parts.append(TABLE_END)
+    return RenderedTable(u"".join(parts), displayed, truncated)
+
+
+def _shorten(message, chars):
+    if not isinstance(message, unicode):
+        message = message.decode('utf-8', 'replace')
+    return message[:chars] + ELLIPSIS
+
+
+def fit_messages(render, messages, byte_budget=None):
+    """ Renders a list of messages, dropping or shortening them to keep the
+    markup within a byte budget.
+
+    Messages are dropped from the end first, and replaced with a note
+    saying how many were left out. If even the first message doesn't fit
+    on its own it is shortened.
+
+    :param render: callable that renders a list of messages as HTML
+    :param list messages: message strings
+    :param int byte_budget: maximum size of the markup, in (UTF-8 encoded)
+                            bytes
+    :returns: the markup, or an empty string if nothing fits
+
+    """
+    html = render(messages)
+    if byte_budget is None or html_size(html) <= byte_budget:
+        return html
+
+    messages = list(messages)
+    for count in range(len(messages) - 1, 0, -1):
+        html = render(messages[:count] +
+                      [MORE_MESSAGES % (len(messages) - count)])
+        if html_size(html) <= byte_budget:
+            return html
+
+    more = []
+    if len(messages) > 1:
+        more = [MORE_MESSAGES % (len(messages) - 1)]
+
+    # Find the longest prefix of the first message that fits
+    def render_prefix(chars):
+        return render([_shorten(messages[0], chars)] + more)
+
+    low, high = 0, len(messages[0]) - 1
+    html = u""
+    while low <= high:
+        chars = (low + high) // 2
+        candidate = render_prefix(chars)
+        if html_size(candidate) <= byte_budget:
+            html = candidate
+            low = chars + 1
+        else:
+            high = chars - 1
+    return html
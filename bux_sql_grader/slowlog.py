@@ -0,0 +1,80 @@
+"""
+    bux_sql_grader.slowlog
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    A log of slow evaluations, for finding expensive problems and query
+    shapes.
+
+"""
+
+import json
+import logging
+import time
+
+from logging.handlers import RotatingFileHandler
+
+from .cache import LRUCache
+from .history import HISTORY_MAX_BYTES, MAX_QUERY_CHARS, query_fingerprint
+
+
+log = logging.getLogger(__name__)
+
+
+class SlowEvaluationLog(object):
+    """ Writes a JSON line for each slow evaluation to a rotating file.
+
+    An evaluation is slow if it took at least ``threshold`` seconds, or
+    spent at least ``query_threshold`` seconds executing queries and
+    fetching their rows. Each line has the student query's fingerprint
+    (see :func:`~bux_sql_grader.history.query_fingerprint`), database,
+    (shortened) text, row counts and phase timings, plus the ``EXPLAIN``
+    output the first time the fingerprint is logged.
+
+    :param str path: log file
+    :param float threshold: minimum total time, in seconds
+    :param float query_threshold: minimum query time, in seconds
+    :param int max_bytes: rotate the file once it is this large
+    :param int backups: number of rotated files to keep
+    :param int explain_cache_size: fingerprints remembered as explained
+
+    """
+
+    def __init__(self, path, threshold=5, query_threshold=2,
+                 max_bytes=HISTORY_MAX_BYTES, backups=3,
+                 explain_cache_size=1000):
+        self.path = path
+        self.threshold = threshold
+        self.query_threshold = query_threshold
+
+        self.handler = RotatingFileHandler(path, maxBytes=max_bytes,
+                                           backupCount=backups)
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+
+        self._explained = LRUCache(explain_cache_size)
+
+    def is_slow(self, timing):
+        """ Checks whether a finished :class:`EvaluationTiming` is slow """
+        query_time = timing.phases.get("execute", 0) + timing.phases.get("fetch", 0)
+        return (timing.elapsed >= self.threshold or
+                query_time >= self.query_threshold)
+
+    def needs_explain(self, fingerprint):
+        """ Returns ``True`` the first time it is called for a fingerprint """
+        if self._explained.get(fingerprint):
+            return False
+        self._explained.set(fingerprint, True)
+        return True
+
+    def record(self, timing, explain=None):
+        """ Writes an entry for a slow evaluation """
+        entry = timing.as_dict()
+        entry.update(time=round(time.time(), 3),
+                     fingerprint=query_fingerprint(timing.statement or u""),
+                     query=(timing.statement or u"")[:MAX_QUERY_CHARS])
+        if explain is not None:
+            entry["explain"] = explain
+
+        line = json.dumps(entry, sort_keys=True, separators=(",", ":"),
+                          default=unicode)
+        self.handler.handle(logging.makeLogRecord({"msg": line}))
+        return entry
@@ -0,0 +1,279 @@
+"""
+    bux_sql_grader.sqlite
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Defines an evaluator that grades SQL queries against local SQLite
+    copies of course datasets.
+
+"""
+
+import itertools
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from statsd import statsd
+
+from bux_grader_framework.exceptions import ImproperlyConfiguredGrader
+
+from .mysql import InvalidQuery, MySQLEvaluator, PartialRows, result_row_size
+from .timing import clock
+
+
+log = logging.getLogger(__file__)
+
+#: File name extension of database files
+SQLITE_SUFFIX = ".sqlite"
+
+#: SQLite virtual machine steps between query deadline checks
+PROGRESS_STEPS = 10000
+
+#: Authorizer actions allowed on evaluator connections. Everything else
+#: (writes, ATTACH, PRAGMA, ...) is denied.
+READ_ONLY_ACTIONS = frozenset([
+    sqlite3.SQLITE_SELECT,
+    sqlite3.SQLITE_READ,
+    getattr(sqlite3, "SQLITE_FUNCTION", 31),
+    getattr(sqlite3, "SQLITE_RECURSIVE", 33),
+])
+
+#: MySQL-only syntax, and how to describe it to students whose queries
+#: fail because of it
+MYSQL_ONLY_SYNTAX = (
+    (re.compile(r"^\s*(SHOW|DESCRIBE|DESC)\b", re.I),
+     "SHOW and DESCRIBE statements"),
+    (re.compile(r"\b(STRAIGHT_JOIN|SQL_CALC_FOUND_ROWS|SQL_NO_CACHE)\b", re.I),
+     "MySQL query hints"),
+    (re.compile(r"\bINTO\s+(OUTFILE|DUMPFILE)\b", re.I),
+     "SELECT ... INTO OUTFILE"),
+    (re.compile(r"\b(CONCAT|CONCAT_WS|IF|DATE_FORMAT|STR_TO_DATE|NOW|CURDATE|"
+                r"YEAR|MONTH|DAYOFWEEK|DATEDIFF|LOCATE|REGEXP)\s*\(", re.I),
+     "MySQL functions such as CONCAT(), IF() or DATE_FORMAT()"),
+    (re.compile(r"\bREGEXP\b", re.I),
+     "the REGEXP operator"),
+)
+
+DIALECT_NOTE = "This problem's database runs on SQLite, which doesn't support %s."
+
+
+def read_only_authorizer(action, arg1, arg2, database, trigger):
+    """ SQLite authorizer callback that only allows reads """
+    if action in READ_ONLY_ACTIONS:
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+
+def dialect_note(stmt):
+    """ Returns a note describing MySQL-only syntax in ``stmt``, if any """
+    for pattern, description in MYSQL_ONLY_SYNTAX:
+        if pattern.search(stmt):
+            return DIALECT_NOTE % description
+    return None
+
+
+class SQLiteConnection(object):
+    """ A read-only connection to a SQLite database file.
+
+    Queries are interrupted once they have run for ``timeout`` seconds.
+    Connections are kept open for reuse by the thread that opened them, so
+    ``close`` does nothing.
+
+    :param str path: database file
+    :param float timeout: query time limit, in seconds (``None`` for none)
+
+    """
+
+    #: Like ``MySQLdb`` connections; these are never closed
+    open = True
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self.deadline = None
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA query_only = ON")
+        self.connection.set_authorizer(read_only_authorizer)
+        self.connection.set_progress_handler(self.past_deadline,
+                                             PROGRESS_STEPS)
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def start_query(self):
+        if self.timeout:
+            self.deadline = clock() + self.timeout
+
+    def finish_query(self):
+        self.deadline = None
+
+    def past_deadline(self):
+        return self.deadline is not None and clock() > self.deadline
+
+    def close(self):
+        pass
+
+
+class SQLiteEvaluator(MySQLEvaluator):
+    """ An evaluator class that handles SQL problems using SQLite.
+
+    Queries run in-process against ``<database_dir>/<database>.sqlite``
+    files, which must be prepared (e.g. converted from the MySQL datasets)
+    ahead of time. Connections are opened read-only, one per thread and
+    database, and reused.
+
+    Filtering, scoring, rendering and result uploads work as they do for
+    :class:`~bux_sql_grader.mysql.MySQLEvaluator`, and accept the same
+    options apart from the MySQL connection settings. As SQLite has no
+    ``SQL_SELECT_LIMIT``, at most ``select_limit`` rows are fetched instead,
+    and queries are interrupted after ``query_timeout`` seconds.
+
+    Queries that fail because of MySQL-only syntax have a note saying so
+    added to their error message.
+
+    """
+
+    name = "sqlite"
+
+    def __init__(self, database_dir, database=None, query_timeout=30,
+                 **kwargs):
+        self.database_dir = database_dir
+        self.query_timeout = query_timeout
+        self._connections = threading.local()
+
+        super(SQLiteEvaluator, self).__init__(database, None, None, None,
+                                              **kwargs)
+
+    def database_path(self, database):
+        """ Returns the file of a database """
+        if not database or not re.match(r"^\w+$", database):
+            raise ImproperlyConfiguredGrader(
+                "Invalid SQLite database name: %s" % database)
+        return os.path.join(self.database_dir, database + SQLITE_SUFFIX)
+
+    def db_connect(self, database):
+        connections = getattr(self._connections, "by_database", None)
+        if connections is None:
+            connections = self._connections.by_database = {}
+
+        db = connections.get(database)
+        if db is None:
+            path = self.database_path(database)
+            if not os.path.isfile(path):
+                raise ImproperlyConfiguredGrader(
+                    "SQLite database not found: %s" % path)
+            try:
+                db = SQLiteConnection(path, self.query_timeout)
+            except sqlite3.Error as e:
+                log.exception("Could not open SQLite database")
+                raise ImproperlyConfiguredGrader(e)
+            connections[database] = db
+
+        return db
+
+    def set_select_limit(self, db):
+        """ SQLite has no session row limit; see ``fetch_rows`` """
+        pass
+
+    def execute_query(self, db, stmt, fetch_limit=None):
+        """ Execute the SQL query
+
+            :param db: a :class:`SQLiteConnection`
+            :param string stmt: the SQL query to run
+            :param int fetch_limit: ignored; results are read in-process,
+                                    so there is nothing to gain from
+                                    sampling them
+
+            :raises InvalidQuery: if the query could not be executed
+
+        """
+        timing = self.current_timing()
+        timer = statsd.timer('bux_sql_grader.execute_query').start()
+        cursor = db.cursor()
+        db.start_query()
+        try:
+            with timing.span("execute"):
+                cursor.execute(stmt)
+            with timing.span("fetch"):
+                rows = self.fetch_rows(cursor)
+
+            cols = ()
+            if cursor.description:
+                cols = tuple(unicode(col[0], 'utf-8') for col in cursor.description)
+
+            cursor.close()
+        except (sqlite3.Error, sqlite3.Warning) as e:
+            if db.past_deadline():
+                msg = "Query exceeded the %d second time limit" % self.query_timeout
+            else:
+                msg = "SQLite Error: {}".format(e)
+                note = dialect_note(stmt)
+                if note:
+                    msg += " ({})".format(note)
+            raise InvalidQuery(msg)
+        finally:
+            db.finish_query()
+            timer.stop()
+        return cols, rows
+
+    def fetch_rows(self, cursor, limit=None):
+        """ Fetches at most ``select_limit`` (or ``limit``, if lower) result
+        rows.
+
+        If ``max_result_bytes`` is set fetching also stops once the rows'
+        size would pass the limit, in which case a
+        :class:`~bux_sql_grader.mysql.PartialRows` tuple is returned.
+
+        """
+        limits = [value for value in (limit, self.select_limit) if value]
+        limit = min(limits) if limits else None
+        if not self.max_result_bytes:
+            if limit:
+                return tuple(cursor.fetchmany(limit))
+            return tuple(cursor.fetchall())
+
+        rows = []
+        size = 0
+        for row in itertools.islice(cursor, limit):
+            size += result_row_size(row)
+            if size > self.max_result_bytes:
+                log.info("Result set exceeded %d bytes after %d rows",
+                         self.max_result_bytes, len(rows))
+                statsd.incr('bux_sql_grader.execute_query.truncated')
+                self.current_timing().count("result_bytes", size)
+                return PartialRows(rows)
+            rows.append(row)
+
+        self.current_timing().count("result_bytes", size)
+        return tuple(rows)
+
+    def explain_query(self, database, stmt):
+        """ Returns the ``EXPLAIN QUERY PLAN`` output of a single
+        ``SELECT`` statement as a list of dicts, or ``None`` for anything
+        else.
+
+        """
+        stmt = self.single_select(stmt)
+        if stmt is None:
+            return None
+
+        db = self.db_connect(database)
+        try:
+            cursor = db.cursor()
+            cursor.execute("EXPLAIN QUERY PLAN " + stmt)
+            cols = [unicode(col[0], 'utf-8') for col in cursor.description]
+            rows = cursor.fetchall()
+            cursor.close()
+        except (sqlite3.Error, sqlite3.Warning) as e:
+            log.warning("Could not explain query: %s", e)
+            return None
+
+        return [dict(zip(cols, row)) for row in rows]
+
+    def status(self):
+        """ Assert that the default database (or database directory) exists """
+        if not self.database:
+            return os.path.isdir(self.database_dir)
+        return super(SQLiteEvaluator, self).status()
@@ -0,0 +1,241 @@
+"""
+    bux_sql_grader.storage
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Storage backends for uploaded result files.
+
+"""
+
+import errno
+import logging
+import os
+import posixpath
+import tempfile
+import threading
+import urllib
+
+from statsd import statsd
+
+from boto.s3.connection import S3Connection
+
+from .streaming import MIN_PART_SIZE, upload_chunks
+
+
+log = logging.getLogger(__name__)
+
+#: Default lifetime of result download URLs, in seconds
+URL_EXPIRES = 60*60*24
+
+
+class BaseStorage(object):
+    """ Interface for result storage backends.
+
+    Objects are addressed by a ``/`` separated name relative to the root of
+    the backend.
+
+    """
+
+    #: Prefix of the backend's statsd metrics
+    name = "storage"
+
+    def put(self, name, contents, headers=None):
+        """ Store a string, returning the number of bytes written """
+        return self.stream(name, [contents], headers)
+
+    def stream(self, name, chunks, headers=None):
+        """ Store an iterable of strings, returning the number of bytes
+        written. ``chunks`` should be consumed incrementally.
+
+        """
+        raise NotImplementedError
+
+    def url(self, name, expires=URL_EXPIRES, filename=None):
+        """ Returns a download URL for an object.
+
+        :param int expires: seconds the URL should remain valid
+        :param str filename: file name the download should be saved as
+
+        """
+        raise NotImplementedError
+
+    def exists(self, name):
+        """ Checks whether an object has been stored """
+        raise NotImplementedError
+
+    def reset(self):
+        """ Discard any cached connections after an error """
+        pass
+
+
+class S3Storage(BaseStorage):
+    """ Stores objects in an S3 bucket.
+
+    A single S3 connection (and its pool of keep-alive HTTP connections) is
+    shared by every upload made from a process. It is re-established after
+    ``reset`` or when the process forks.
+
+    :param str bucket: bucket name
+    :param int part_size: size of multipart upload parts
+
+    """
+
+    name = "s3"
+
+    def __init__(self, bucket, aws_access_key=None, aws_secret_key=None,
+                 part_size=MIN_PART_SIZE):
+        self.bucket_name = bucket
+        self.aws_access_key = aws_access_key
+        self.aws_secret_key = aws_secret_key
+        self.part_size = max(int(part_size), MIN_PART_SIZE)
+
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._bucket = None
+
+    def get_bucket(self):
+        """ Returns a (cached) bucket handle, connecting to S3 if needed """
+        with self._lock:
+            if self._connection is None or self._pid != os.getpid():
+                timer = statsd.timer('bux_sql_grader.s3.connect').start()
+                self._connection = S3Connection(self.aws_access_key,
+                                                self.aws_secret_key)
+                self._pid = os.getpid()
+                self._bucket = None
+                timer.stop()
+
+            if self._bucket is None:
+                self._bucket = self._connection.get_bucket(self.bucket_name,
+                                                           validate=False)
+            return self._bucket
+
+    def reset(self):
+        """ Discards the shared S3 connection and bucket handle """
+        with self._lock:
+            connection = self._connection
+            self._connection = None
+            self._bucket = None
+
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception as e:
+                log.warning("Error closing S3 connection: %s", e)
+
+    def stream(self, name, chunks, headers=None):
+        key, size = upload_chunks(self.get_bucket(), name, chunks,
+                                  self.part_size, headers)
+        return size
+
+    def url(self, name, expires=URL_EXPIRES, filename=None):
+        """ Returns a presigned URL. Signing is done locally. """
+        response_headers = None
+        if filename:
+            response_headers = {
+                "response-content-disposition":
+                    'attachment; filename="%s"' % filename.replace('"', '')
+            }
+        key = self.get_bucket().new_key(name)
+        return key.generate_url(expires, response_headers=response_headers)
+
+    def exists(self, name):
+        """ Checks for an object with a HEAD request """
+        return self.get_bucket().get_key(name) is not None
+
+
+class LocalStorage(BaseStorage):
+    """ Stores objects in a local directory.
+
+    Objects are written to a temporary file and renamed into place, so
+    readers never see a partial file. URLs are built from ``base_url``, which
+    should point at a web server (or ``file://`` URL) serving ``root``.
+
+    Headers (e.g. ``Content-Encoding``) can't be stored with the file and
+    are ignored; configure the web server to match if gzip is enabled.
+    Likewise, download file names are given by a symlink to the object
+    rather than a header, so the web server must follow symlinks.
+
+    :param str root: directory to store objects in
+    :param str base_url: URL that ``root`` is served from
+
+    """
+
+    name = "local"
+
+    def __init__(self, root, base_url=None):
+        if not root:
+            raise ValueError("LocalStorage requires a root directory")
+        self.root = os.path.abspath(root)
+        if base_url is None:
+            base_url = "file://" + urllib.pathname2url(self.root)
+        self.base_url = base_url.rstrip("/")
+
+    def path(self, name):
+        """ Returns the filesystem path for an object """
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError("Object name escapes storage root: %s" % name)
+        return path
+
+    def stream(self, name, chunks, headers=None):
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+        return size
+
+    def url(self, name, expires=URL_EXPIRES, filename=None):
+        """ Returns a URL under ``base_url``.
+
+        If ``filename`` differs from the object's own file name, the URL
+        points at a symlink named ``filename`` in a directory named after
+        the object, e.g. ``shared/<digest>/<filename>`` for
+        ``shared/<digest>.csv``. The object doesn't have to exist yet.
+
+        """
+        if filename and filename != posixpath.basename(name):
+            name = self.link(name, filename)
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return "%s/%s" % (self.base_url, urllib.quote(name))
+
+    def link(self, name, filename):
+        """ Creates a relative symlink to an object under another file
+        name, returning the link's name.
+
+        """
+        stem, ext = posixpath.splitext(name)
+        link_name = posixpath.join(stem, posixpath.basename(filename))
+        link_path = self.path(link_name)
+        try:
+            os.makedirs(os.path.dirname(link_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.symlink(os.path.join(os.pardir, posixpath.basename(name)),
+                       link_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return link_name
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
@@ -0,0 +1,236 @@
+"""
+    bux_sql_grader.streaming
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Incremental CSV encoding and chunked S3 uploads, so that large result
+    sets never have to be held in memory as a single encoded string.
+
+"""
+
+import csv
+import hashlib
+import logging
+import tempfile
+import zlib
+
+from StringIO import StringIO
+
+
+log = logging.getLogger(__name__)
+
+#: Target size of each chunk yielded by ``iter_csv``
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+#: S3 rejects multipart upload parts (other than the last) under 5MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+#: Headers for objects uploaded through ``GzipStream``
+GZIP_HEADERS = {
+    "Content-Encoding": "gzip",
+    "Content-Type": "text/csv",
+}
+
+
+def format_csv_col(col):
+    """ Format a result column value for CSV """
+    if col is None:
+        return ""
+    return unicode(col).encode('utf-8')
+
+
+class _ChunkBuffer(object):
+    """ A write-only file-like object that tracks its size """
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+
+    def drain(self):
+        data = "".join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+def iter_csv(results, chunk_size=DEFAULT_CHUNK_SIZE, format_col=format_csv_col):
+    """ Generates a result set as UTF-8 encoded CSV.
+
+    :param tuple results: query results as (columns, rows)
+    :param int chunk_size: approximate size in bytes of each yielded chunk
+    :param format_col: callable used to encode each value
+    :returns: an iterator of CSV strings
+
+    """
+    cols, rows = results
+
+    buf = _ChunkBuffer()
+    writer = csv.writer(buf)
+
+    if cols:
+        writer.writerow([format_col(s) for s in cols])
+
+    for row in rows:
+        writer.writerow([format_col(s) for s in row])
+        if buf.size >= chunk_size:
+            yield buf.drain()
+
+    if buf.size:
+        yield buf.drain()
+
+
+class SpooledChunks(object):
+    """ Consumes an iterable of strings once, hashing it and spooling it to
+    a temporary file so it can be read back without being regenerated.
+
+    The file is kept in memory until it grows past ``max_size`` bytes. It
+    is deleted by ``close`` or once the object is garbage collected.
+
+    :param chunks: iterable of strings
+    :param int max_size: bytes to hold in memory before spilling to disk
+    :param int chunk_size: size of the chunks read back
+
+    """
+
+    def __init__(self, chunks, max_size=MIN_PART_SIZE,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size)
+
+        digest = hashlib.sha256()
+        try:
+            for chunk in chunks:
+                digest.update(chunk)
+                self.file.write(chunk)
+                self.size += len(chunk)
+        except Exception:
+            self.file.close()
+            raise
+        self.digest = digest.hexdigest()
+
+    def __iter__(self):
+        """ Reads the contents back from the start """
+        self.file.seek(0)
+        while True:
+            data = self.file.read(self.chunk_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self.file.close()
+
+
+class GzipStream(object):
+    """ Gzip-compresses an iterable of strings as it is consumed.
+
+    Byte counts are available as ``raw_bytes`` and ``compressed_bytes``
+    once the stream has been exhausted.
+
+    :param chunks: iterable of strings to compress
+    :param int level: zlib compression level (1-9)
+
+    """
+
+    def __init__(self, chunks, level=6):
+        self.chunks = chunks
+        self.level = level
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    def __iter__(self):
+        # wbits offset by 16 selects the gzip container format
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        for chunk in self.chunks:
+            self.raw_bytes += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                self.compressed_bytes += len(data)
+                yield data
+
+        data = compressor.flush()
+        self.compressed_bytes += len(data)
+        yield data
+
+
+class _MultipartParts(object):
+    """ Sends data as the parts of a multipart upload, which is started
+    with the first part.
+
+    """
+
+    def __init__(self, bucket, keyname, headers=None):
+        self.bucket = bucket
+        self.keyname = keyname
+        self.headers = headers
+        self.upload = None
+        self.part_num = 0
+
+    @property
+    def started(self):
+        return self.upload is not None
+
+    def send(self, data):
+        if self.upload is None:
+            self.upload = self.bucket.initiate_multipart_upload(
+                self.keyname, headers=self.headers)
+        self.part_num += 1
+        self.upload.upload_part_from_file(StringIO(data), self.part_num)
+
+    def complete(self):
+        self.upload.complete_upload()
+
+    def cancel(self):
+        if self.upload is None:
+            return
+        try:
+            self.upload.cancel_upload()
+        except Exception as e:
+            log.error("Could not cancel multipart upload of %s: %s",
+                      self.keyname, e)
+
+
+def upload_chunks(bucket, keyname, chunks, part_size=MIN_PART_SIZE,
+                  headers=None):
+    """ Upload an iterable of strings to S3.
+
+    Content that fits in a single part is sent with one PUT. Anything larger
+    is sent as a multipart upload, so at most one part is buffered at a time.
+
+    :param bucket: a ``boto.s3.bucket.Bucket``
+    :param str keyname: destination key name
+    :param chunks: iterable of strings to upload
+    :param int part_size: bytes to buffer before sending a part
+    :param dict headers: extra headers to send with the object
+    :returns: a two item tuple: (uploaded key, total bytes sent)
+
+    """
+    buf = _ChunkBuffer()
+    total = 0
+    parts = _MultipartParts(bucket, keyname, headers)
+
+    try:
+        for chunk in chunks:
+            buf.write(chunk)
+            total += len(chunk)
+            if buf.size >= part_size:
+                parts.send(buf.drain())
+
+        key = bucket.new_key(keyname)
+        if parts.started:
+            if buf.size:
+                parts.send(buf.drain())
+            parts.complete()
+        else:
+            key.set_contents_from_string(buf.drain(), headers=headers,
+                                         replace=True)
+    except Exception:
+        parts.cancel()
+        raise
+
+    return key, total
@@ -0,0 +1,130 @@
+"""
+    bux_sql_grader.timing
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Per-evaluation timing records, for diagnosing slow submissions one at a
+    time rather than through aggregate statsd timers.
+
+"""
+
+import json
+import logging
+import time
+
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+#: Clock used for phase spans. Python 2 has no monotonic clock in the
+#: standard library, so this falls back to wall time there.
+clock = getattr(time, "monotonic", time.time)
+
+
+class EvaluationTiming(object):
+    """ Phase timings, counts and flags for a single evaluation.
+
+    Spans with the same phase name are added together, so a phase that
+    runs more than once (e.g. ``execute`` for the student and grader
+    queries) reports its total time.
+
+    :param submission_id: XQueue submission ID the record belongs to
+
+    """
+
+    def __init__(self, submission_id=None):
+        self.submission_id = submission_id
+        self.database = None
+        self.statement = None
+        self.phases = {}
+        self.counts = {}
+        self.flags = {}
+        self.started = clock()
+        self.elapsed = None
+
+    @contextmanager
+    def span(self, phase):
+        """ Adds the time spent in the ``with`` block to ``phase`` """
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add(phase, clock() - start)
+
+    def describe(self, database, statement):
+        """ Sets the database and (filtered) student statement """
+        self.database = database
+        self.statement = statement
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def flag(self, name, value=True):
+        self.flags[name] = value
+
+    def finish(self):
+        self.elapsed = clock() - self.started
+
+    def as_dict(self):
+        """ Returns the record as a JSON-friendly dict, with times in msec """
+        elapsed = self.elapsed
+        if elapsed is None:
+            elapsed = clock() - self.started
+        return {
+            "submission_id": self.submission_id,
+            "database": self.database,
+            "total_ms": round(elapsed * 1000, 3),
+            "phases_ms": dict((phase, round(seconds * 1000, 3))
+                              for phase, seconds in self.phases.items()),
+            "counts": dict(self.counts),
+            "flags": dict(self.flags),
+        }
+
+
+class NullTiming(object):
+    """ Stands in for an :class:`EvaluationTiming` when timing is off """
+
+    submission_id = None
+
+    @contextmanager
+    def span(self, phase):
+        yield
+
+    def describe(self, database, statement):
+        pass
+
+    def add(self, phase, seconds):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def flag(self, name, value=True):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_TIMING = NullTiming()
+
+
+class LogTimingSink(object):
+    """ Writes each timing record as a single JSON log line.
+
+    :param logger: logger to write to (defaults to this module's)
+    :param int level: log level of the records
+
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or log
+        self.level = level
+
+    def __call__(self, record):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, "Evaluation timing: %s",
+                            json.dumps(record, sort_keys=True))
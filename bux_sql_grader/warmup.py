@@ -0,0 +1,89 @@
+"""
+    bux_sql_grader.warmup
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Runs the grader answers of a course's problems ahead of time, warming
+    database caches and the evaluator's answer cache.
+
+"""
+
+import json
+import logging
+
+from multiprocessing.pool import ThreadPool
+
+from .mysql import InvalidQuery, result_row_size
+from .timing import clock
+
+
+log = logging.getLogger(__name__)
+
+
+def load_manifest(path):
+    """ Reads problem payloads from a file with one JSON object per line.
+
+    Lines may either be a grader payload or an object with a
+    ``grader_payload`` (as a dict or JSON string) and optional ``problem``
+    name. Problems without a name are numbered.
+
+    :returns: a list of (name, payload) tuples
+
+    """
+    problems = []
+    with open(path) as f:
+        for idx, line in enumerate(f):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            name = "problem-%d" % (idx + 1)
+            if "grader_payload" in entry:
+                name = entry.get("problem", name)
+                entry = entry["grader_payload"]
+                if isinstance(entry, basestring):
+                    entry = json.loads(entry)
+            problems.append((name, entry))
+    return problems
+
+
+def warm_answer(evaluator, name, payload, render=True):
+    """ Runs one problem's answer, returning a report dict """
+    report = {"problem": name,
+              "database": payload.get("database") or evaluator.database,
+              "rows": 0, "bytes": 0, "seconds": 0, "error": None}
+    start = clock()
+    try:
+        results = evaluator.warm_answer(payload, render)
+    except InvalidQuery as e:
+        report["error"] = unicode(e)
+        results = None
+    except Exception as e:
+        log.exception("Could not warm answer for %s", name)
+        report["error"] = repr(e)
+        results = None
+    report["seconds"] = clock() - start
+
+    if results is not None:
+        report["rows"] = len(results[1])
+        report["bytes"] = sum(result_row_size(row) for row in results[1])
+    return report
+
+
+def warm_answers(evaluator, problems, workers=4, render=True):
+    """ Runs the answers of ``problems`` on ``workers`` threads.
+
+    :param evaluator: a :class:`~bux_sql_grader.mysql.MySQLEvaluator`
+    :param list problems: (name, payload) tuples
+    :param bool render: also fill the evaluator's answer cache. Not worth
+                        it unless the evaluator goes on to grade.
+    :returns: a report dict per problem, in order
+
+    """
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(
+            lambda problem: warm_answer(evaluator, problem[0], problem[1],
+                                        render),
+            problems, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+"""
+    Replays recorded submissions through ``MySQLEvaluator.evaluate``.
+
+    Unlike ``test_sql_grader.py`` this doesn't need RabbitMQ, XQueue or the
+    grader framework's workers: submissions are evaluated in-process by a
+    pool of threads (or processes) at a fixed arrival rate, and latency is
+    reported for each phase of evaluation, as recorded in the evaluator's
+    timing records (see ``timing_sink``).
+
+    Submissions are read from a file with one JSON object per line, either
+    a full XQueue submission or just the interesting parts::
+
+        {"student_response": "SELECT ...",
+         "grader_payload": {"answer": "SELECT ...", "database": "lahman"}}
+
+    Run against a local MySQL server configured in a settings module, and
+    record the query results as you go::
+
+        $ python -m load_tests.replay submissions.json \\
+            --settings load_tests.example_settings --record results.json
+
+    Then replay without a database, answering queries from the recording::
+
+        $ python -m load_tests.replay submissions.json \\
+            --settings load_tests.example_settings --stand-in results.json \\
+            --rate 50 --count 2000 --workers 8
+
+"""
+import argparse
+import importlib
+import json
+import logging
+import threading
+import time
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from bux_sql_grader.metrics import configure_statsd
+from bux_sql_grader.monitor import percentile
+from bux_sql_grader.mysql import InvalidQuery, MySQLEvaluator
+
+log = logging.getLogger(__name__)
+
+#: Phases reported for each submission. ``queue`` is the time between the
+#: scheduled arrival and the start of evaluation, ``evaluate`` is the total
+#: time of the evaluator's timing record and ``total`` is the two together.
+#: The rest are the record's phases.
+PHASES = ("queue", "filter", "connect", "select_limit", "execute", "fetch",
+          "grade", "upload", "render", "evaluate", "total")
+
+
+class TimingCollector(object):
+    """ Timing sink that keeps the last record passed to it in each thread
+    (evaluators emit records from the thread that ran the evaluation).
+
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __call__(self, record):
+        self._local.record = record
+
+    def pop(self):
+        """ Returns and forgets this thread's last record, if any """
+        record = getattr(self._local, "record", None)
+        self._local.record = None
+        return record
+
+
+class RecordedResults(object):
+    """ Query results keyed by database and statement.
+
+    Stored as JSON lines of ``{"database", "query", "cols", "rows",
+    "seconds"}`` objects.
+
+    """
+
+    def __init__(self):
+        self.results = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        recorded = cls()
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                rows = tuple(tuple(row) for row in entry["rows"])
+                recorded.results[(entry["database"], entry["query"])] = (
+                    (tuple(entry["cols"]), rows), entry.get("seconds", 0))
+        return recorded
+
+    def add(self, database, query, results, seconds):
+        with self._lock:
+            self.results[(database, query)] = (results, seconds)
+
+    def get(self, database, query):
+        """ Returns a two item tuple: (results, seconds) """
+        try:
+            return self.results[(database, query)]
+        except KeyError:
+            raise InvalidQuery("No recorded results for query")
+
+    def save(self, path):
+        with self._lock:
+            with open(path, "w") as f:
+                items = sorted(self.results.items())
+                for (database, query), (results, seconds) in items:
+                    f.write(json.dumps({"database": database, "query": query,
+                                        "cols": results[0], "rows": results[1],
+                                        "seconds": seconds},
+                                       default=unicode) + "\n")
+
+
+class StandInConnection(object):
+    """ Takes the place of a MySQLdb connection when replaying recordings """
+
+    open = True
+
+    def __init__(self, database):
+        self.replay_database = database
+
+    def cursor(self):
+        return self
+
+    def execute(self, stmt):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayEvaluator(MySQLEvaluator):
+    """ Collects the timing record of each evaluation in ``timings``.
+
+    With ``recorded`` results queries are answered from the recording
+    (sleeping for the recorded execution time if ``simulate_latency`` is
+    set) instead of a database. With ``recording`` results of queries run
+    against the database are added to it.
+
+    """
+
+    def __init__(self, recorded=None, recording=None, simulate_latency=False,
+                 *args, **kwargs):
+        self.recorded = recorded
+        self.recording = recording
+        self.simulate_latency = simulate_latency
+        self.timings = TimingCollector()
+        kwargs["timing_sink"] = self.timings
+        super(ReplayEvaluator, self).__init__(*args, **kwargs)
+
+    def db_connect(self, database):
+        if self.recorded is not None:
+            return StandInConnection(database)
+        db = super(ReplayEvaluator, self).db_connect(database)
+        db.replay_database = database
+        return db
+
+    def execute_query(self, db, stmt, fetch_limit=None):
+        if self.recorded is not None:
+            with self.current_timing().span("execute"):
+                results, seconds = self.recorded.get(db.replay_database, stmt)
+                if self.simulate_latency:
+                    time.sleep(seconds)
+            return results
+
+        start = time.time()
+        results = super(ReplayEvaluator, self).execute_query(db, stmt,
+                                                             fetch_limit)
+        if self.recording is not None:
+            results = self.complete_results(results)
+            self.recording.add(db.replay_database, stmt, results,
+                               time.time() - start)
+        return results
+
+
+def load_submissions(path):
+    """ Reads submissions, wrapping partial ones in an XQueue envelope """
+    submissions = []
+    with open(path) as f:
+        for idx, line in enumerate(f):
+            if not line.strip():
+                continue
+            submission = json.loads(line)
+            if "xqueue_body" not in submission:
+                submission = {
+                    "xqueue_header": {"submission_id": idx,
+                                      "submission_key": "replay-%d" % idx},
+                    "xqueue_body": {
+                        "student_response": submission["student_response"],
+                        "student_info": {},
+                        "grader_payload": submission.get("grader_payload", {}),
+                    },
+                }
+            submissions.append(submission)
+    return submissions
+
+
+#: Evaluator config used when no settings module is given
+DEFAULT_CONFIG = {
+    "database": "",
+    "host": "127.0.0.1",
+    "user": "",
+    "passwd": "",
+}
+
+
+def load_config(settings, overrides):
+    """ Reads the ``mysql`` evaluator config from a settings module """
+    config = dict(DEFAULT_CONFIG)
+    if settings:
+        module = importlib.import_module(settings)
+        config.update(module.EVALUATOR_CONFIG["mysql"])
+    config.update(overrides)
+    return config
+
+
+# Evaluator used by the current worker process
+_evaluator = None
+
+
+def init_worker(config, recorded_path, simulate_latency):
+    global _evaluator
+    recorded = RecordedResults.load(recorded_path) if recorded_path else None
+    _evaluator = ReplayEvaluator(recorded=recorded,
+                                 simulate_latency=simulate_latency,
+                                 **config)
+
+
+def evaluate(job):
+    """ Evaluates one submission, returning its phase timings in msec """
+    index, scheduled, submission = job
+
+    started = time.time()
+    error = None
+    try:
+        _evaluator.evaluate(submission)
+    except Exception as e:
+        error = repr(e)
+    finished = time.time()
+
+    record = _evaluator.timings.pop()
+    spans = dict(record["phases_ms"])
+    spans["queue"] = (started - scheduled) * 1000
+    spans["evaluate"] = record["total_ms"]
+    spans["total"] = spans["queue"] + spans["evaluate"]
+    return {"index": index, "finished": finished, "spans": spans,
+            "error": error}
+
+
+def replay(submissions, count, rate, pool):
+    """ Submits ``count`` evaluations to ``pool`` at ``rate`` per second
+    (or all at once if ``rate`` is 0).
+
+    :returns: a two item tuple: (list of timing dicts, elapsed seconds)
+
+    """
+    results = []
+    start = time.time()
+    for index in xrange(count):
+        scheduled = start + (index / float(rate) if rate else 0)
+        delay = scheduled - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        job = (index, scheduled, submissions[index % len(submissions)])
+        pool.apply_async(evaluate, (job,), callback=results.append)
+
+    pool.close()
+    pool.join()
+
+    finished = start
+    if results:
+        finished = max(result["finished"] for result in results)
+    return results, finished - start
+
+
+def report(results, elapsed):
+    errors = [result for result in results if result["error"]]
+    print "Submissions: %d (%d errors)" % (len(results), len(errors))
+    print "Elapsed: %.2fs" % elapsed
+    if elapsed:
+        print "Throughput: %.1f submissions/s" % (len(results) / elapsed)
+    print
+
+    print "%-12s %10s %10s %10s %10s  (msec)" % (
+        "phase", "p50", "p95", "p99", "max")
+    for phase in PHASES:
+        times = [result["spans"].get(phase, 0) for result in results]
+        if not times:
+            continue
+        print "%-12s %10.2f %10.2f %10.2f %10.2f" % (
+            phase, percentile(times, 50), percentile(times, 95),
+            percentile(times, 99), max(times))
+
+    for result in errors[:5]:
+        print "Error in submission %d: %s" % (result["index"],
+                                              result["error"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay submissions through MySQLEvaluator.evaluate")
+    parser.add_argument("submissions",
+                        help="file of JSON submissions, one per line")
+    parser.add_argument("--settings",
+                        help="settings module with an EVALUATOR_CONFIG")
+    parser.add_argument("--count", type=int,
+                        help="submissions to evaluate "
+                             "(default: one pass over the file)")
+    parser.add_argument("--rate", default=0, type=float,
+                        help="arrivals per second (0 = all at once)")
+    parser.add_argument("--workers", default=4, type=int,
+                        help="concurrent evaluations")
+    parser.add_argument("--processes", action="store_true",
+                        help="use worker processes instead of threads")
+    parser.add_argument("--stand-in",
+                        help="answer queries from recorded results "
+                             "instead of MySQL")
+    parser.add_argument("--simulate-latency", action="store_true",
+                        help="sleep for the recorded execution time of "
+                             "each query")
+    parser.add_argument("--record",
+                        help="record query results from MySQL to this file")
+    parser.add_argument("--storage-root",
+                        help="store result CSVs in this directory "
+                             "instead of S3")
+    parser.add_argument("--no-upload", action="store_true",
+                        help="skip result CSV uploads")
+    parser.add_argument("--loglevel", default="warning",
+                        help="python log level")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+
+    # The evaluator reports to statsd
+    configure_statsd()
+
+    if args.record and (args.stand_in or args.processes):
+        parser.error("--record can't be used with --stand-in or --processes")
+
+    overrides = {}
+    if args.storage_root:
+        overrides.update(storage="local", storage_root=args.storage_root)
+    if args.no_upload:
+        overrides["s3_upload"] = False
+    config = load_config(args.settings, overrides)
+
+    submissions = load_submissions(args.submissions)
+    count = args.count or len(submissions)
+
+    if args.processes:
+        pool = Pool(args.workers, init_worker,
+                    (config, args.stand_in, args.simulate_latency))
+    else:
+        recording = RecordedResults() if args.record else None
+        recorded = None
+        if args.stand_in:
+            recorded = RecordedResults.load(args.stand_in)
+        _evaluator = ReplayEvaluator(recorded=recorded, recording=recording,
+                                     simulate_latency=args.simulate_latency,
+                                     **config)
+        pool = ThreadPool(args.workers)
+
+    results, elapsed = replay(submissions, count, args.rate, pool)
+    report(results, elapsed)
+
+    if args.record:
+        recording.save(args.record)
+        print
+        print "Recorded %d result sets to %s" % (len(recording.results),
+                                                 args.record)
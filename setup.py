@@ -14,7 +14,7 @@ setup(
     description='An external grader for evaluation of SQL problems.',
     long_description=open('README.md').read(),
     packages=['bux_sql_grader'],
-    scripts=['bin/sqlmon.py'],
+    scripts=['bin/sqlmon.py', 'bin/sqlwarmup.py'],
     license='LICENSE',
     install_requires=[
         'boto>=2.38.0, <3.0',
@@ -0,0 +1,175 @@
+import threading
+import time
+import unittest
+
+from mock import patch
+
+from bux_sql_grader.breaker import CircuitOpen
+from bux_sql_grader.background import (BackgroundQueue, DeadlineExceeded,
+                                       DeadlineRunner)
+
+
+@patch('bux_sql_grader.background.statsd')
+class TestDeadlineRunner(unittest.TestCase):
+
+    def test_returns_result(self, mock_statsd):
+        runner = DeadlineRunner()
+        self.assertEquals(3, runner.call(1, sum, [1, 2]))
+        self.assertEquals(3, runner.call(None, sum, [1, 2]))
+
+    def test_reraises_errors(self, mock_statsd):
+        def broken():
+            raise IOError("S3 is down")
+
+        self.assertRaises(IOError, DeadlineRunner().call, 1, broken)
+
+    def test_deadline_exceeded(self, mock_statsd):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        start = time.time()
+        self.assertRaises(DeadlineExceeded, DeadlineRunner().call, 0.05,
+                          release.wait)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_limits_abandoned_calls(self, mock_statsd):
+        runner = DeadlineRunner(max_threads=1)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        calls = []
+
+        self.assertRaises(DeadlineExceeded, runner.call, 0.01, release.wait)
+        self.assertRaises(DeadlineExceeded, runner.call, 1, calls.append, 1)
+        self.assertEquals([], calls)
+        mock_statsd.incr.assert_called_with('bux_sql_grader.deadline.rejected')
+
+        # The slot is freed once the stuck call finishes
+        release.set()
+        time.sleep(0.05)
+        runner.call(1, calls.append, 1)
+        self.assertEquals([1], calls)
+
+
+@patch('bux_sql_grader.background.statsd')
+class TestBackgroundQueue(unittest.TestCase):
+
+    def test_runs_jobs(self, mock_statsd):
+        queue = BackgroundQueue(workers=2)
+        results = []
+
+        for i in range(10):
+            self.assertTrue(queue.submit(results.append, i))
+        queue.close()
+
+        self.assertEquals(range(10), sorted(results))
+        self.assertTrue(mock_statsd.timing.called)
+
+    def test_retries_failed_jobs(self, mock_statsd):
+        queue = BackgroundQueue(workers=1, retries=2, retry_delay=0)
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise IOError("S3 is down")
+
+        queue.submit(flaky)
+        queue.close()
+
+        self.assertEquals(3, len(attempts))
+        mock_statsd.incr.assert_called_with(
+            'bux_sql_grader.background_queue.retried')
+
+    def test_gives_up_after_retries(self, mock_statsd):
+        queue = BackgroundQueue(workers=1, retries=1, retry_delay=0)
+        attempts = []
+
+        def broken():
+            attempts.append(1)
+            raise IOError("S3 is down")
+
+        queue.submit(broken)
+        queue.close()
+
+        self.assertEquals(2, len(attempts))
+        mock_statsd.incr.assert_called_with(
+            'bux_sql_grader.background_queue.failed')
+
+    def test_does_not_retry_open_circuit(self, mock_statsd):
+        queue = BackgroundQueue(workers=1, retries=2, retry_delay=0)
+        attempts = []
+
+        def skipped():
+            attempts.append(1)
+            raise CircuitOpen("Uploads suspended")
+
+        queue.submit(skipped)
+        queue.close()
+
+        self.assertEquals(1, len(attempts))
+        mock_statsd.incr.assert_called_with(
+            'bux_sql_grader.background_queue.skipped')
+
+    def test_drops_jobs_when_full(self, mock_statsd):
+        queue = BackgroundQueue(workers=1, maxsize=1, put_timeout=0.01)
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocker():
+            started.set()
+            release.wait()
+
+        self.assertTrue(queue.submit(blocker))
+        started.wait()
+        self.assertTrue(queue.submit(lambda: None))
+        self.assertFalse(queue.submit(lambda: None))
+        mock_statsd.incr.assert_called_with(
+            'bux_sql_grader.background_queue.dropped')
+
+        release.set()
+        queue.close()
+
+    def test_metrics_use_queue_name(self, mock_statsd):
+        queue = BackgroundQueue(name='bux_sql_grader.slow_log', workers=1)
+        queue.close()
+
+        self.assertFalse(queue.submit(lambda: None))
+        mock_statsd.incr.assert_called_with('bux_sql_grader.slow_log.dropped')
+
+    def test_close_drains_queue(self, mock_statsd):
+        queue = BackgroundQueue(workers=1)
+        release = threading.Event()
+        results = []
+
+        queue.submit(release.wait)
+        queue.submit(results.append, 1)
+        release.set()
+        queue.close()
+
+        self.assertEquals([1], results)
+        self.assertFalse(queue.submit(results.append, 2))
+
+    def test_close_timeout_with_full_queue(self, mock_statsd):
+        queue = BackgroundQueue(workers=1, maxsize=1)
+        release = threading.Event()
+        started = threading.Event()
+        self.addCleanup(release.set)
+
+        def blocker():
+            started.set()
+            release.wait()
+
+        queue.submit(blocker)
+        started.wait()
+        queue.submit(lambda: None)
+
+        start = time.time()
+        queue.close(0.05)
+        self.assertTrue(time.time() - start < 1)
+        mock_statsd.incr.assert_called_with(
+            'bux_sql_grader.background_queue.abandoned')
+
+        # Let the abandoned jobs finish before the statsd patch is undone
+        release.set()
+        for thread in queue._threads:
+            thread.join(1)
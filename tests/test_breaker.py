@@ -0,0 +1,66 @@
+import unittest
+
+from mock import patch
+
+from bux_sql_grader.breaker import CircuitBreaker
+
+
+@patch('bux_sql_grader.breaker.time')
+@patch('bux_sql_grader.breaker.statsd')
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_after_threshold(self, mock_statsd, mock_time):
+        mock_time.time.return_value = 100
+        breaker = CircuitBreaker('breaker', failure_threshold=2, reset_timeout=10)
+
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+
+        self.assertEquals(CircuitBreaker.OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+        self.assertFalse(breaker.available())
+        mock_statsd.incr.assert_called_with('breaker.open')
+        mock_statsd.gauge.assert_called_with('breaker.state', 2)
+
+    def test_success_resets_failure_count(self, mock_statsd, mock_time):
+        mock_time.time.return_value = 100
+        breaker = CircuitBreaker('breaker', failure_threshold=2)
+
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+
+        self.assertEquals(CircuitBreaker.CLOSED, breaker.state)
+        self.assertFalse(mock_statsd.incr.called)
+
+    def test_half_open_allows_single_probe(self, mock_statsd, mock_time):
+        mock_time.time.return_value = 100
+        breaker = CircuitBreaker('breaker', failure_threshold=1, reset_timeout=10)
+        breaker.record_failure()
+
+        mock_time.time.return_value = 110
+        self.assertTrue(breaker.available())
+        self.assertTrue(breaker.allow())
+        self.assertEquals(CircuitBreaker.HALF_OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+        self.assertFalse(breaker.available())
+
+        breaker.record_success()
+        self.assertEquals(CircuitBreaker.CLOSED, breaker.state)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_probe_reopens(self, mock_statsd, mock_time):
+        mock_time.time.return_value = 100
+        breaker = CircuitBreaker('breaker', failure_threshold=1, reset_timeout=10)
+        breaker.record_failure()
+
+        mock_time.time.return_value = 110
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+
+        self.assertEquals(CircuitBreaker.OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+        mock_time.time.return_value = 120
+        self.assertTrue(breaker.allow())
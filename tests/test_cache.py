@@ -0,0 +1,80 @@
+import unittest
+
+from bux_sql_grader.cache import AnswerCache, LRUCache, answer_fingerprint
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        self.assertEquals(1, cache.get('a'))
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals(2, cache.get('b', 2))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEquals(2, len(cache))
+
+    def test_zero_maxsize_stores_nothing(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEquals(0, len(cache))
+
+
+class TestAnswerCache(unittest.TestCase):
+
+    def test_fingerprint_ignores_surrounding_whitespace(self):
+        self.assertEquals(answer_fingerprint(u"SELECT 1"),
+                          answer_fingerprint(" SELECT 1\n"))
+
+    def test_values_are_keyed_by_database_and_answer(self):
+        cache = AnswerCache()
+        cache.set('foo', 'SELECT 1', ('html', 10), 'a')
+
+        self.assertEquals('a', cache.get('foo', 'SELECT 1', ('html', 10)))
+        self.assertEquals(None, cache.get('foo', 'SELECT 1', ('html', 5)))
+        self.assertEquals(None, cache.get('bar', 'SELECT 1', ('html', 10)))
+        self.assertEquals(None, cache.get('foo', 'SELECT 2', ('html', 10)))
+
+    def test_invalidate_drops_all_values_for_answer(self):
+        cache = AnswerCache()
+        cache.set('foo', 'SELECT 1', ('html', 10), 'a')
+        cache.set('foo', 'SELECT 1', ('html', 5), 'b')
+        cache.set('foo', 'SELECT 2', ('html', 10), 'c')
+
+        cache.invalidate('foo', 'SELECT 1')
+
+        self.assertEquals(None, cache.get('foo', 'SELECT 1', ('html', 10)))
+        self.assertEquals(None, cache.get('foo', 'SELECT 1', ('html', 5)))
+        self.assertEquals('c', cache.get('foo', 'SELECT 2', ('html', 10)))
+
+    def test_check_drops_values_from_other_results(self):
+        cache = AnswerCache()
+        results = ((u'col1',), ((u'a',),))
+
+        self.assertFalse(cache.check('foo', 'SELECT 1', results))
+        cache.set('foo', 'SELECT 1', ('html', 10), 'a')
+        self.assertFalse(cache.check('foo', 'SELECT 1',
+                                     ((u'col1',), ((u'a',),))))
+        self.assertEquals('a', cache.get('foo', 'SELECT 1', ('html', 10)))
+
+        self.assertTrue(cache.check('foo', 'SELECT 1',
+                                    ((u'col1',), ((u'b',),))))
+        self.assertEquals(None, cache.get('foo', 'SELECT 1', ('html', 10)))
+
+    def test_bounded_by_answer_count(self):
+        cache = AnswerCache(1)
+        cache.set('foo', 'SELECT 1', 'html', 'a')
+        cache.set('foo', 'SELECT 2', 'html', 'b')
+
+        self.assertEquals(1, len(cache))
+        self.assertEquals(None, cache.get('foo', 'SELECT 1', 'html'))
@@ -0,0 +1,164 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from bux_sql_grader.history import (KillHistory, RunawayQueries,
+                                    parse_student_tag, query_fingerprint,
+                                    tag_statement)
+
+
+class TestQueryFingerprint(unittest.TestCase):
+
+    def test_ignores_whitespace_and_case(self):
+        self.assertEquals(query_fingerprint(u"SELECT *\n  FROM foo;"),
+                          query_fingerprint(u"select * from foo"))
+
+    def test_distinguishes_queries(self):
+        self.assertNotEquals(query_fingerprint(u"SELECT * FROM foo"),
+                             query_fingerprint(u"SELECT * FROM bar"))
+
+    def test_accepts_byte_strings(self):
+        self.assertEquals(query_fingerprint(u"SELECT '\xe4'"),
+                          query_fingerprint(u"SELECT '\xe4'".encode('utf-8')))
+
+    def test_ignores_student_tag(self):
+        self.assertEquals(query_fingerprint(u"SELECT * FROM foo"),
+                          query_fingerprint(tag_statement(u"SELECT * FROM foo",
+                                                          u"abc")))
+
+
+class TestStudentTag(unittest.TestCase):
+
+    def test_round_trip(self):
+        tagged = tag_statement(u"SELECT '\xe4'", u"1a2b-c_3")
+        self.assertEquals(u"/* student:1a2b-c_3 */ SELECT '\xe4'", tagged)
+        self.assertEquals((u"1a2b-c_3", u"SELECT '\xe4'"),
+                          parse_student_tag(tagged))
+
+    def test_sanitizes_id(self):
+        self.assertEquals(u"/* student:abc */ SELECT 1",
+                          tag_statement(u"SELECT 1", u"a*/b c"))
+        self.assertEquals(u"SELECT 1", tag_statement(u"SELECT 1", u"*/"))
+        self.assertEquals(u"SELECT 1", tag_statement(u"SELECT 1", None))
+
+    def test_untagged(self):
+        self.assertEquals((None, "/* other */ SELECT 1"),
+                          parse_student_tag("/* other */ SELECT 1"))
+        self.assertEquals((None, None), parse_student_tag(None))
+
+
+class TestKillHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, "kills.log")
+
+    def test_record_counts_kills(self):
+        history = KillHistory(self.path)
+        history.record(u"SELECT * FROM foo", "db", "user", now=1)
+        entry = history.record(u"select * from foo", "db", "user", now=2)
+
+        self.assertEquals(2, entry["count"])
+        self.assertEquals(2, entry["last_seen"])
+        with open(self.path) as f:
+            self.assertEquals(2, len(f.readlines()))
+
+    def test_record_counts_kinds(self):
+        history = KillHistory(self.path)
+        history.record(u"SELECT * FROM foo", now=1)
+        entry = history.record(u"SELECT * FROM foo", now=2, kind="budget")
+
+        self.assertEquals(2, entry["count"])
+        self.assertEquals({"limit": {"count": 1, "last_seen": 1},
+                           "budget": {"count": 1, "last_seen": 2}},
+                          entry["kinds"])
+
+    def test_load_reads_latest_entries(self):
+        history = KillHistory(self.path)
+        history.record(u"SELECT * FROM foo", now=1)
+        history.record(u"SELECT * FROM foo", now=2)
+        history.record(u"SELECT * FROM bar", now=3)
+
+        entries = KillHistory(self.path).entries
+        self.assertEquals(2, len(entries))
+        self.assertEquals(2, entries[query_fingerprint(u"SELECT * FROM foo")]["count"])
+
+    def test_load_skips_bad_lines(self):
+        with open(self.path, "w") as f:
+            f.write("not json\n")
+            f.write(json.dumps({"fingerprint": "abc", "count": 1}) + "\n")
+
+        self.assertEquals(["abc"], KillHistory(self.path).entries.keys())
+
+    def test_rotation_keeps_counts(self):
+        history = KillHistory(self.path, max_bytes=500, backups=2)
+        for i in range(20):
+            history.record(u"SELECT %d FROM foo" % (i % 3), now=i)
+
+        self.assertTrue(os.path.exists(self.path + ".1"))
+        self.assertTrue(os.path.exists(self.path + ".2"))
+        self.assertFalse(os.path.exists(self.path + ".3"))
+
+        entries = KillHistory(self.path).entries
+        self.assertEquals(3, len(entries))
+        self.assertEquals(20, sum(entry["count"] for entry in entries.values()))
+
+
+class TestRunawayQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, "kills.log")
+
+    def test_get(self):
+        KillHistory(self.path).record(u"SELECT * FROM foo", now=100)
+        runaway = RunawayQueries(self.path, ttl=60)
+
+        self.assertEquals(1, runaway.get(u"select * from foo;", now=110)["count"])
+        self.assertEquals(None, runaway.get(u"SELECT * FROM bar", now=110))
+        self.assertEquals(None, runaway.get(u"SELECT * FROM foo", now=200))
+
+    def test_min_kills(self):
+        history = KillHistory(self.path)
+        history.record(u"SELECT * FROM foo", now=100)
+        runaway = RunawayQueries(self.path, min_kills=2, check_interval=0)
+
+        self.assertEquals(None, runaway.get(u"SELECT * FROM foo", now=100))
+        history.record(u"SELECT * FROM foo", now=101)
+        self.assertEquals(2, runaway.get(u"SELECT * FROM foo", now=101)["count"])
+
+    def test_ignores_budget_kills(self):
+        history = KillHistory(self.path)
+        history.record(u"SELECT * FROM foo", now=100, kind="budget")
+        runaway = RunawayQueries(self.path, ttl=60, check_interval=0)
+
+        self.assertEquals(None, runaway.get(u"SELECT * FROM foo", now=110))
+
+        # The ttl runs from the last time limit kill
+        history.record(u"SELECT * FROM foo", now=120)
+        history.record(u"SELECT * FROM foo", now=170, kind="budget")
+        self.assertEquals(3, runaway.get(u"SELECT * FROM foo", now=170)["count"])
+        self.assertEquals(None, runaway.get(u"SELECT * FROM foo", now=190))
+
+    def test_entries_without_kinds(self):
+        with open(self.path, "w") as f:
+            f.write(json.dumps({"fingerprint": query_fingerprint(u"SELECT 1"),
+                                "count": 1, "last_seen": 100}) + "\n")
+
+        runaway = RunawayQueries(self.path, ttl=60)
+        self.assertEquals(1, runaway.get(u"SELECT 1", now=110)["count"])
+
+    def test_missing_file(self):
+        self.assertEquals(None, RunawayQueries(self.path).get(u"SELECT 1"))
+
+    def test_rereads_changed_file(self):
+        runaway = RunawayQueries(self.path, check_interval=10)
+        self.assertEquals(None, runaway.get(u"SELECT 1", now=100))
+
+        KillHistory(self.path).record(u"SELECT 1", now=100)
+        self.assertEquals(None, runaway.get(u"SELECT 1", now=105))
+        self.assertEquals(1, runaway.get(u"SELECT 1", now=110)["count"])
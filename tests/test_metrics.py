@@ -0,0 +1,32 @@
+import unittest
+
+from mock import patch
+
+import statsd
+
+from bux_sql_grader import scoring
+from bux_sql_grader.metrics import configure_statsd
+
+
+class TestConfigureStatsd(unittest.TestCase):
+
+    @patch('bux_sql_grader.scoring.statsd', None)
+    @patch('statsd.statsd', None)
+    def test_creates_client(self):
+        client = configure_statsd("localhost", 8125)
+
+        self.assertIsInstance(client, statsd.StatsClient)
+        self.assertIs(client, statsd.statsd)
+        self.assertIs(client, scoring.statsd)
+
+    @patch('bux_sql_grader.scoring.statsd', None)
+    @patch('statsd.statsd')
+    def test_keeps_environment_client(self, mock_statsd):
+        self.assertIs(mock_statsd, configure_statsd())
+        self.assertIs(mock_statsd, scoring.statsd)
+
+    @patch('bux_sql_grader.scoring.statsd')
+    @patch('statsd.statsd', None)
+    def test_leaves_patched_modules(self, mock_statsd):
+        configure_statsd()
+        self.assertIs(mock_statsd, scoring.statsd)
@@ -0,0 +1,233 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from collections import namedtuple
+
+from mock import MagicMock, patch
+
+import MySQLdb
+
+from bux_sql_grader.monitor import (ER_NO_SUCH_THREAD, ServerMonitor,
+                                    UsageWindow, parse_db_args,
+                                    parse_server_config, processlist_query)
+
+
+CREDS = {"host": "127.0.0.1", "port": 3306, "user": "root", "password": ""}
+
+
+class FakeConnection(object):
+    """ Answers process list queries with ``rows`` and records kills """
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.finished = set()
+        self.killed = []
+        self.executed = []
+
+    def cursor(self):
+        cursor = MagicMock()
+        cursor.execute.side_effect = lambda sql, params: self.executed.append(params)
+        cursor.fetchall.side_effect = lambda: tuple(self.rows)
+        return cursor
+
+    def query(self, sql):
+        pid = int(sql.split()[1])
+        if pid in self.finished:
+            raise MySQLdb.OperationalError(ER_NO_SUCH_THREAD, "Unknown thread id")
+        self.killed.append(pid)
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def write(self, text):
+        path = os.path.join(self.root, "config.ini")
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_parse_db_args(self):
+        Args = namedtuple("Args", "host port user password config")
+        path = self.write("[client]\nhost = db1\nport = 3307\n"
+                          "user = mon\npassword = secret\n")
+
+        self.assertEquals({"host": "db1", "port": 3307, "user": "mon",
+                           "password": "secret"},
+                          parse_db_args(Args("h", 1, "u", "p", path)))
+        self.assertEquals({"host": "h", "port": 1, "user": "u", "password": "p"},
+                          parse_db_args(Args("h", 1, "u", "p", None)))
+
+    def test_parse_server_config(self):
+        path = self.write("[primary]\nhost = db1\n\n"
+                          "[replica]\nhost = db2\nport = 3307\nuser = mon\n")
+
+        primary, replica = parse_server_config(path, CREDS)
+        self.assertEquals(dict(CREDS, name="primary", host="db1"), primary)
+        self.assertEquals(dict(CREDS, name="replica", host="db2", port=3307,
+                               user="mon"), replica)
+
+
+class TestProcesslistQuery(unittest.TestCase):
+
+    def test_unfiltered(self):
+        sql, params = processlist_query(min_time=20)
+        self.assertEquals([20], params)
+        self.assertNotIn("DB IN", sql)
+        self.assertNotIn("USER IN", sql)
+
+    def test_filtered(self):
+        sql, params = processlist_query(["a", "b"], ["student"], 20)
+        self.assertEquals([20, "a", "b", "student"], params)
+        self.assertIn("AND DB IN (%s, %s)", sql)
+        self.assertIn("AND USER IN (%s)", sql)
+
+
+class TestUsageWindow(unittest.TestCase):
+
+    def test_usage_expires(self):
+        usage = UsageWindow(60)
+        usage.add("a", 5, now=0)
+        usage.add("a", 10, now=30)
+        usage.add("b", 1, now=30)
+
+        self.assertEquals(15, usage.usage("a", now=59))
+        self.assertEquals(10, usage.usage("a", now=60))
+        self.assertEquals(0, usage.usage("a", now=90))
+        self.assertEquals(1, usage.usage("b", now=60))
+        self.assertEquals(0, usage.usage("c", now=60))
+        self.assertNotIn("a", usage.samples)
+
+
+@patch('bux_sql_grader.monitor.time')
+@patch('bux_sql_grader.monitor.statsd')
+class TestServerMonitor(unittest.TestCase):
+
+    def make_monitor(self, rows=(), **kwargs):
+        monitor = ServerMonitor(CREDS, **kwargs)
+        monitor.db = FakeConnection(rows)
+        return monitor
+
+    def test_estimate_start(self, mock_statsd, mock_time):
+        monitor = self.make_monitor()
+
+        self.assertEquals((89, 90), monitor.estimate_start(1, 100, 10))
+
+        # Later polls narrow the range of the same query
+        monitor.start_times[1] = (89, 90)
+        self.assertEquals((89.5, 90), monitor.estimate_start(1, 110.5, 20))
+
+        # A range that doesn't overlap is a new query on the connection
+        self.assertEquals((99, 100), monitor.estimate_start(1, 110, 10))
+
+    def test_poll_kills_expired_queries(self, mock_statsd, mock_time):
+        mock_time.time.return_value = 100
+        monitor = self.make_monitor([(1, "student", "db", 31, "SELECT 1"),
+                                     (2, "student", "db", 25, "SELECT 2")],
+                                    limit=30, max_interval=10)
+
+        wait = monitor.poll()
+
+        self.assertEquals([1], monitor.db.killed)
+        # Only queries within max_interval of the limit are fetched
+        self.assertEquals([20], monitor.db.executed[0])
+        # The next poll is due when the second query reaches the limit
+        self.assertEquals(5, wait)
+        self.assertEquals({2: (74, 75)}, monitor.start_times)
+        self.assertEquals(1, len(monitor.lateness))
+        mock_statsd.incr.assert_any_call('bux_sql_grader.sqlmon.kills.limit')
+
+    def test_poll_interval_bounds(self, mock_statsd, mock_time):
+        mock_time.time.return_value = 100
+        monitor = self.make_monitor(limit=30, min_interval=2, max_interval=10)
+        self.assertEquals(10, monitor.poll())
+
+        monitor.db.rows = [(2, "student", "db", 29, "SELECT 2")]
+        self.assertEquals(2, monitor.poll())
+
+    def test_poll_skips_finished_queries(self, mock_statsd, mock_time):
+        mock_time.time.return_value = 100
+        monitor = self.make_monitor([(1, "student", "db", 31, "SELECT 1")])
+        monitor.db.finished.add(1)
+
+        monitor.poll()
+
+        self.assertEquals([], monitor.db.killed)
+        self.assertEquals(0, len(monitor.lateness))
+
+    def test_fair_share_budget(self, mock_statsd, mock_time):
+        monitor = self.make_monitor(limit=30, fair_share="db", budget=10,
+                                    window=60)
+        monitor.db.rows = [(1, "student", "db", 4, "SELECT 1"),
+                           (2, "student", "db", 4, "SELECT 2")]
+
+        mock_time.time.return_value = 100.0
+        monitor.poll()
+        self.assertEquals([], monitor.db.killed)
+        self.assertEquals(9, monitor.usage.usage("db", 100))
+
+        # Each poll charges the time since the last one
+        monitor.db.rows = [(1, "student", "db", 6, "SELECT 1"),
+                           (2, "student", "db", 6, "SELECT 2")]
+        mock_time.time.return_value = 102.0
+        monitor.poll()
+        self.assertEquals([1, 2], monitor.db.killed)
+        mock_statsd.incr.assert_any_call('bux_sql_grader.sqlmon.kills.budget')
+
+        # Usage falls out of the window
+        monitor.db.killed = []
+        monitor.db.rows = [(3, "student", "db", 1, "SELECT 3")]
+        mock_time.time.return_value = 200.0
+        monitor.poll()
+        self.assertEquals([], monitor.db.killed)
+
+    def test_fair_share_charges_killed_queries(self, mock_statsd, mock_time):
+        monitor = self.make_monitor(limit=5, fair_share="db", budget=100)
+        monitor.db.rows = [(1, "student", "db", 4, "SELECT 1")]
+        mock_time.time.return_value = 100.0
+        monitor.poll()
+        self.assertEquals(4.5, monitor.usage.usage("db", 100))
+
+        # The interval up to a time limit kill is charged
+        monitor.db.rows = [(1, "student", "db", 7, "SELECT 1")]
+        mock_time.time.return_value = 103.0
+        monitor.poll()
+        self.assertEquals([1], monitor.db.killed)
+        self.assertEquals(7.5, monitor.usage.usage("db", 103))
+
+    def test_fair_share_student(self, mock_statsd, mock_time):
+        monitor = self.make_monitor(limit=30, fair_share="student", budget=5)
+        monitor.db.rows = [(1, "grader", "db", 3, "/* student:a */ SELECT 1"),
+                           (2, "grader", "db", 3, "/* student:a */ SELECT 2"),
+                           (3, "grader", "db", 3, "/* student:b */ SELECT 3"),
+                           (4, "grader", "db", 3, "SELECT 4")]
+        mock_time.time.return_value = 100.0
+        monitor.poll()
+
+        self.assertEquals([1, 2], sorted(monitor.db.killed))
+        self.assertEquals(7, monitor.usage.usage("a", 100))
+        self.assertEquals(3.5, monitor.usage.usage("b", 100))
+        self.assertEquals(["a", "b"], sorted(monitor.usage.samples))
+
+    def test_fair_share_sample_interval(self, mock_statsd, mock_time):
+        mock_time.time.return_value = 100.0
+        monitor = self.make_monitor(limit=30, min_interval=0.25,
+                                    max_interval=10, fair_share="db")
+        self.assertEquals(1, monitor.poll())
+
+        monitor.sample_interval = 0.5
+        self.assertEquals(0.5, monitor.poll())
+
+    def test_kill_records_kind(self, mock_statsd, mock_time):
+        monitor = self.make_monitor(history=MagicMock())
+        monitor.kill((1, "student", "db", 5, "SELECT 1"), "over budget", "budget")
+
+        monitor.history.record.assert_called_with("SELECT 1", "db", "student",
+                                                  kind="budget")
+
+    def test_unknown_fair_share_mode(self, mock_statsd, mock_time):
+        self.assertRaises(ValueError, ServerMonitor, CREDS, fair_share="host")
@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 import MySQLdb
 
 from MySQLdb.cursors import Cursor
+from StringIO import StringIO
 
 from mock import MagicMock, patch
 
 from bux_grader_framework.exceptions import ImproperlyConfiguredGrader
-from bux_sql_grader.mysql import MySQLEvaluator, InvalidQuery, INVALID_STUDENT_QUERY, INVALID_GRADER_QUERY
+from bux_sql_grader.history import KillHistory, query_fingerprint
+from bux_sql_grader.mysql import MySQLEvaluator, InvalidQuery, PartialRows, INVALID_STUDENT_QUERY, INVALID_GRADER_QUERY, RUNAWAY_QUERY, UPLOAD_FAILED_MESSAGE
+from bux_sql_grader.mysql import FETCH_BATCH_SIZE, FIRST_FETCH_BATCH_SIZE, SampledRows, fetch_batch_size
+from bux_sql_grader.storage import BaseStorage
+from bux_sql_grader.timing import EvaluationTiming
+
+from .test_streaming import FakeBucket
 
 MYSQL_CONFIG = {
     "host": "localhost",
@@ -66,6 +79,12 @@ class TestMySQLEvaluator(unittest.TestCase):
         CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
         self.grader = MySQLEvaluator(**CONFIG)
 
+        for target in ('bux_sql_grader.storage.statsd',
+                       'bux_sql_grader.breaker.statsd'):
+            patcher = patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     def test_db_connect(self, mock_db, mock_statsd, mock_statsd_scoring):
         self.grader.db_connect('foo')
         mock_converter = mock_db.converters.conversions.copy()
@@ -99,6 +118,55 @@ class TestMySQLEvaluator(unittest.TestCase):
         results = self.grader.execute_query(db, DUMMY_QUERY['query'])
         self.assertEquals(DUMMY_QUERY['result'], results)
 
+    def test_execute_query_max_result_bytes(self, mock_db, mock_statsd, mock_statsd_scoring):
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(max_result_bytes=20, **CONFIG)
+
+        rows = [(u'a' * 8,), (u'b' * 8,), (u'c' * 8,), (u'd' * 8,)]
+        mock_cursor = MagicMock(spec=Cursor)
+        mock_cursor.fetchmany.side_effect = [rows[:3], rows[3:], ()]
+        mock_cursor.description = (('col1', 253, 8, 8, 8, 0, 0),)
+
+        db = MagicMock()
+        db.cursor = MagicMock(return_value=mock_cursor)
+
+        with patch('bux_sql_grader.mysql.statsd') as mysql_statsd:
+            cols, results = grader.execute_query(db, "SELECT col1 FROM foo")
+        self.assertEquals(tuple(rows[:2]), results)
+        self.assertTrue(isinstance(results, PartialRows))
+        db.cursor.assert_called_with(mock_db.cursors.SSCursor)
+        mysql_statsd.incr.assert_any_call('bux_sql_grader.execute_query.truncated')
+
+        # The rest of the result set is abandoned along with the connection
+        mock_cursor.fetchmany.assert_called_once_with(FIRST_FETCH_BATCH_SIZE)
+        self.assertFalse(mock_cursor.close.called)
+        db.close.assert_called_once_with()
+
+    def test_fetch_batch_size(self, mock_db, mock_statsd, mock_statsd_scoring):
+        self.assertEquals(FIRST_FETCH_BATCH_SIZE, fetch_batch_size(0, 0, 1000))
+        # 10 rows of 10 bytes leave room for 90 more
+        self.assertEquals(90, fetch_batch_size(10, 100, 1000))
+        self.assertEquals(1, fetch_batch_size(10, 999, 1000))
+        self.assertEquals(FETCH_BATCH_SIZE, fetch_batch_size(10, 100, 10**9))
+        self.assertEquals(FETCH_BATCH_SIZE, fetch_batch_size(10, 0, 1000))
+
+    def test_execute_query_max_result_bytes_fits(self, mock_db, mock_statsd, mock_statsd_scoring):
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(max_result_bytes=100, **CONFIG)
+
+        rows = [(u'a' * 8, None), (u'b' * 8, 1.5)]
+        mock_cursor = MagicMock(spec=Cursor)
+        mock_cursor.fetchmany.side_effect = [rows, ()]
+        mock_cursor.description = (('col1', 253, 8, 8, 8, 0, 0),
+                                   ('col2', 5, 8, 8, 8, 0, 1))
+
+        db = MagicMock()
+        db.cursor = MagicMock(return_value=mock_cursor)
+
+        cols, results = grader.execute_query(db, "SELECT col1, col2 FROM foo")
+        self.assertEquals(tuple(rows), results)
+        self.assertFalse(isinstance(results, PartialRows))
+
     def test_execute_query_invalid(self, mock_db, mock_statsd, mock_statsd_scoring):
         mock_cursor = MagicMock(spec=Cursor)
         mock_cursor.execute.side_effect = MySQLdb.Error(1146, 'Table does not exist')
@@ -145,6 +213,197 @@ class TestMySQLEvaluator(unittest.TestCase):
         }
         self.assertEquals(expected, self.grader.evaluate(DUMMY_SUBMISSION))
 
+    def test_evaluate_tag_queries(self, mock_db, mock_statsd, mock_statsd_scoring):
+        results = ((u'col1',), ((u'a',),))
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(tag_queries=True, **CONFIG)
+        grader.execute_query = MagicMock(return_value=results)
+        grader.upload_results = MagicMock(return_value="")
+
+        grader.evaluate(DUMMY_SUBMISSION)
+
+        # Only the student statement is tagged
+        statements = [args[1] for args, kwargs in grader.execute_query.call_args_list]
+        self.assertEquals(["/* student:abc */ SELECT * FROM foo",
+                           "SELECT * FROM foo"], statements)
+
+    def test_tag_student_query(self, mock_db, mock_statsd, mock_statsd_scoring):
+        stmt = "SELECT 1"
+        self.assertEquals(stmt, self.grader.tag_student_query(
+            stmt, {"student_info": {"anonymous_student_id": "abc"}}))
+
+        self.grader.tag_queries = True
+        self.assertEquals("/* student:abc */ SELECT 1",
+                          self.grader.tag_student_query(stmt, {
+                              "student_info": '{"anonymous_student_id": "abc"}'}))
+        self.assertEquals(stmt, self.grader.tag_student_query(stmt, {}))
+        self.assertEquals(stmt, self.grader.tag_student_query(
+            stmt, {"student_info": "not json"}))
+
+    def test_evaluate_runaway_query(self, mock_db, mock_statsd, mock_statsd_scoring):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, "kills.log")
+        KillHistory(path).record(u"select *  from foo")
+
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(runaway_history=path, **CONFIG)
+        grader.execute_query = MagicMock()
+
+        expected = {"correct": False, "score": 0, "msg": RUNAWAY_QUERY}
+        self.assertEquals(expected, grader.evaluate(DUMMY_SUBMISSION))
+        self.assertFalse(grader.execute_query.called)
+        self.assertFalse(mock_db.connect.called)
+
+    def test_evaluate_ignores_old_runaway_queries(self, mock_db, mock_statsd, mock_statsd_scoring):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, "kills.log")
+        KillHistory(path).record(u"SELECT * FROM foo", now=0)
+
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(runaway_history=path, runaway_ttl=60, **CONFIG)
+
+        self.assertFalse(grader.is_runaway_query(u"SELECT * FROM foo"))
+
+    def test_evaluate_timing_sink(self, mock_db, mock_statsd, mock_statsd_scoring):
+        records = []
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(timing_sink=records.append, **CONFIG)
+
+        student_results = ((u'col1',), ((u'a',), (u'b',)))
+        grader_results = ((u'col1',), ((u'a',), (u'b',), (u'c',)))
+        grader.execute_query = MagicMock(side_effect=[student_results,
+                                                      grader_results])
+        grader.upload_results = MagicMock(return_value="")
+
+        response = grader.evaluate(DUMMY_SUBMISSION)
+
+        self.assertEquals(1, len(records))
+        record = records[0]
+        self.assertEquals(123, record["submission_id"])
+        self.assertEquals(set(["filter", "connect", "select_limit", "grade",
+                               "upload", "render"]),
+                          set(record["phases_ms"]))
+        self.assertEquals({"student_rows": 2, "grader_rows": 3,
+                           "response_bytes": len(response["msg"])},
+                          record["counts"])
+        self.assertEquals({"answer_cache.grader_results": False},
+                          record["flags"])
+
+    def test_evaluate_timing_sink_error(self, mock_db, mock_statsd, mock_statsd_scoring):
+        records = []
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(timing_sink=records.append, **CONFIG)
+        grader.execute_query = MagicMock(side_effect=ValueError)
+
+        self.assertRaises(ValueError, grader.evaluate, DUMMY_SUBMISSION)
+        self.assertEquals({"error": "ValueError"}, records[0]["flags"])
+
+    @patch('bux_sql_grader.profiling.statsd')
+    def test_evaluate_profile(self, mock_statsd_profiling, mock_db, mock_statsd, mock_statsd_scoring):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(profile_dir=root, profile_sample_rate=1,
+                                profile_threshold=0, **CONFIG)
+        grader.execute_query = MagicMock(return_value=((u'col1',), ((u'a',),)))
+        grader.upload_results = MagicMock(return_value="")
+
+        grader.evaluate(DUMMY_SUBMISSION)
+
+        fingerprint = query_fingerprint(DUMMY_SUBMISSION["xqueue_body"]["student_response"])
+        profiles = os.listdir(root)
+        self.assertEquals(1, len(profiles))
+        self.assertTrue(profiles[0].endswith("-123-%s.prof" % fingerprint))
+
+    @patch('bux_sql_grader.background.statsd')
+    def test_evaluate_slow_log(self, mock_statsd_background, mock_db, mock_statsd, mock_statsd_scoring):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, "slow.log")
+
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(slow_log=path, slow_threshold=0, **CONFIG)
+        grader.execute_query = MagicMock(return_value=((u'col1',), ((u'a',),)))
+        grader.upload_results = MagicMock(return_value="")
+
+        # Responses don't wait for the query to be explained
+        explained = threading.Event()
+
+        def explain_query(database, stmt):
+            explained.wait(5)
+            return [{u"table": u"foo"}]
+        grader.explain_query = MagicMock(side_effect=explain_query)
+
+        grader.evaluate(DUMMY_SUBMISSION)
+        grader.evaluate(DUMMY_SUBMISSION)
+        self.assertFalse(os.path.getsize(path))
+
+        explained.set()
+        grader.get_slow_log_queue().close(5)
+        grader.slow_log.handler.close()
+
+        with open(path) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEquals(2, len(entries))
+        self.assertEquals([{u"table": u"foo"}], entries[0]["explain"])
+        self.assertNotIn("explain", entries[1])
+        grader.explain_query.assert_called_once_with("foo", "SELECT * FROM foo")
+
+    def test_explain_query(self, mock_db, mock_statsd, mock_statsd_scoring):
+        mock_cursor = MagicMock(spec=Cursor)
+        mock_cursor.description = (('id', 8, 1, 3, 3, 0, 0),
+                                   ('table', 253, 3, 64, 64, 0, 1))
+        mock_cursor.fetchall.return_value = ((1L, u'foo'),)
+        mock_db.connect.return_value.cursor.return_value = mock_cursor
+
+        self.assertEquals([{u"id": 1L, u"table": u"foo"}],
+                          self.grader.explain_query("foo", "SELECT * FROM foo;"))
+        mock_cursor.execute.assert_called_with("EXPLAIN SELECT * FROM foo")
+
+    def test_explain_query_timeout(self, mock_db, mock_statsd, mock_statsd_scoring):
+        db = mock_db.connect.return_value
+        db.thread_id.return_value = 42
+        killed = threading.Event()
+        db.query.side_effect = lambda sql: killed.set()
+        db.cursor.return_value.execute.side_effect = lambda sql: killed.wait(5)
+        db.cursor.return_value.description = (('id', 8, 1, 3, 3, 0, 0),)
+        db.cursor.return_value.fetchall.return_value = ((1L,),)
+
+        self.grader.slow_explain_timeout = 0.01
+        self.grader.explain_query("foo", "SELECT * FROM foo")
+
+        db.query.assert_called_once_with("KILL QUERY 42")
+
+    def test_explain_query_select_only(self, mock_db, mock_statsd, mock_statsd_scoring):
+        self.assertEquals(None, self.grader.explain_query(
+            "foo", "SELECT * FROM foo; DELETE FROM foo"))
+        self.assertEquals(None, self.grader.explain_query(
+            "foo", "DELETE FROM foo"))
+        self.assertFalse(mock_db.connect.called)
+
+    def test_execute_query_timing(self, mock_db, mock_statsd, mock_statsd_scoring):
+        mock_cursor = MagicMock(spec=Cursor)
+        mock_cursor.fetchall.return_value = DUMMY_QUERY['rows']
+        mock_cursor.description = DUMMY_QUERY['description']
+
+        db = MagicMock()
+        db.cursor = MagicMock(return_value=mock_cursor)
+
+        timing = EvaluationTiming(123)
+        self.grader._timing.record = timing
+        self.grader.execute_query(db, DUMMY_QUERY['query'])
+        self.grader._timing.record = None
+
+        self.assertEquals(set(["execute", "fetch"]), set(timing.phases))
+
+    def test_unknown_timing_sink(self, mock_db, mock_statsd, mock_statsd_scoring):
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        self.assertRaises(ImproperlyConfiguredGrader, MySQLEvaluator,
+                          timing_sink="statsd", **CONFIG)
+
     def test_evaluate_invalid_grader_query(self, mock_db, mock_statsd, mock_statsd_scoring):
         query = DUMMY_SUBMISSION["xqueue_body"]["grader_payload"]["answer"]
         error_msg = "Bad grader query"
@@ -179,6 +438,133 @@ class TestMySQLEvaluator(unittest.TestCase):
 
         self.assertIn("Showing 3 of 5 rows", response["msg"])
 
+    def test_evaluate_max_result_bytes(self, mock_db, mock_statsd, mock_statsd_scoring):
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(max_result_bytes=4096, **CONFIG)
+        results = ((u'col1',), PartialRows([(u'a',)]))
+        grader.execute_query = MagicMock(return_value=results)
+        grader.upload_results = MagicMock(return_value="")
+
+        response = grader.evaluate(DUMMY_SUBMISSION)
+        self.assertIn("more than 4 KB of data", response["msg"])
+
+    def test_evaluate_reconnects_after_truncation(self, mock_db, mock_statsd, mock_statsd_scoring):
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(max_result_bytes=4096, **CONFIG)
+        first, second = MagicMock(open=True), MagicMock(open=True)
+        mock_db.connect.side_effect = [first, second]
+
+        def execute_query(db, stmt, fetch_limit=None):
+            if db is first:
+                grader.abandon_results(db)
+                db.open = False
+                return ((u'col1',), PartialRows([(u'a',)]))
+            return ((u'col1',), ((u'a',),))
+        grader.execute_query = MagicMock(side_effect=execute_query)
+        grader.upload_results = MagicMock(return_value="")
+
+        grader.evaluate(copy.deepcopy(DUMMY_SUBMISSION))
+
+        # The grader answer runs on a new connection with the SELECT limit set
+        self.assertEquals([first, second],
+                          [args[0] for args, kwargs in grader.execute_query.call_args_list])
+        self.assertTrue(second.cursor.return_value.execute.call_args[0][0].startswith(
+            "SET SQL_SELECT_LIMIT"))
+        first.close.assert_called_once_with()
+        second.close.assert_called_once_with()
+
+    def make_adaptive_grader(self, mock_db, **kwargs):
+        """ Returns an adaptive fetch grader whose connections answer the
+        grader query with 5 rows and the student query with 25.
+
+        """
+        results = {
+            "SELECT * FROM foo": [(unicode(i),) for i in range(25)],
+            "SELECT * FROM foo LIMIT 5": [(unicode(i),) for i in range(5)],
+        }
+        cursors = []
+
+        def make_cursor(*args):
+            cursor = MagicMock(spec=Cursor)
+            cursor.description = (('col1', 253, 8, 8, 8, 0, 0),)
+
+            def execute(stmt):
+                rows = list(results.get(stmt, ()))
+                cursor.fetchall.return_value = tuple(rows)
+
+                def fetchmany(size):
+                    batch = tuple(rows[:size])
+                    del rows[:size]
+                    return batch
+                cursor.fetchmany.side_effect = fetchmany
+            cursor.execute.side_effect = execute
+            cursors.append(cursor)
+            return cursor
+
+        db = mock_db.connect.return_value
+        db.cursor.side_effect = make_cursor
+        db.open = True
+
+        def close():
+            db.open = False
+        db.close.side_effect = close
+
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(adaptive_fetch=True, **dict(CONFIG, **kwargs))
+        return grader, cursors
+
+    def test_evaluate_adaptive_fetch(self, mock_db, mock_statsd, mock_statsd_scoring):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        grader, cursors = self.make_adaptive_grader(
+            mock_db, storage="local", storage_root=root)
+
+        submission = copy.deepcopy(DUMMY_SUBMISSION)
+        submission["xqueue_body"]["grader_payload"]["answer"] = "SELECT * FROM foo LIMIT 5"
+        response = grader.evaluate(submission)
+
+        # The grader answer runs first, then 11 student rows are fetched
+        # for scoring and the rest are streamed to the results CSV
+        grader_cursor, student_cursor = [
+            cursor for cursor in cursors
+            if cursor.execute.call_args[0][0].startswith("SELECT")]
+        grader_cursor.execute.assert_called_with("SELECT * FROM foo LIMIT 5")
+        student_cursor.execute.assert_called_with("SELECT * FROM foo")
+        self.assertFalse(student_cursor.fetchall.called)
+        self.assertTrue(student_cursor.close.called)
+
+        self.assertFalse(response["correct"])
+        self.assertIn("Too many rows.", response["msg"])
+        self.assertIn("Showing 10 of 25 rows.", response["msg"])
+        with open(os.path.join(root, "results", "abc", "incorrect-foo.csv")) as f:
+            self.assertEquals(26, len(f.read().splitlines()))
+
+    def test_evaluate_adaptive_fetch_no_upload(self, mock_db, mock_statsd, mock_statsd_scoring):
+        grader, cursors = self.make_adaptive_grader(mock_db)
+
+        submission = copy.deepcopy(DUMMY_SUBMISSION)
+        submission["xqueue_body"]["grader_payload"]["answer"] = "SELECT * FROM foo LIMIT 5"
+        submission["xqueue_body"]["grader_payload"]["upload_results"] = False
+        response = grader.evaluate(submission)
+
+        self.assertIn("Showing 10 of 11+ rows.", response["msg"])
+        student_cursor = cursors[-1]
+        student_cursor.execute.assert_called_with("SELECT * FROM foo")
+
+        # The unread rows are abandoned along with the connection
+        self.assertEquals(1, student_cursor.fetchmany.call_count)
+        self.assertFalse(student_cursor.close.called)
+        mock_db.connect.return_value.close.assert_called_once_with()
+
+    def test_student_fetch_limit(self, mock_db, mock_statsd, mock_statsd_scoring):
+        def results(count):
+            return ((u'col1',), tuple((u'a',) for i in range(count)))
+
+        self.assertEquals(11, self.grader.student_fetch_limit(results(5), 10))
+        self.assertEquals(201, self.grader.student_fetch_limit(results(100), 10))
+        self.assertEquals(None, self.grader.student_fetch_limit(results(5000), 10))
+        self.assertEquals(None, self.grader.student_fetch_limit(results(5), None))
+
     def test_evaluate_row_limit_no_limit(self, mock_db, mock_statsd, mock_statsd_scoring):
         results = ((u'col1',), ((u'a',), (u'b',), (u'c'), (u'd',), (u'e',)))
         submission = copy.deepcopy(DUMMY_SUBMISSION)
@@ -307,8 +693,222 @@ class TestMySQLEvaluator(unittest.TestCase):
         expected = 'col1,\xc3\xb6\r\n\xc3\xa4,b\r\nc,d\r\n'
         self.assertEquals(expected, self.grader.csv_results(results))
 
-    def test_upload_results(self, mock_db, mock_statsd, mock_statsd_scoring):
-        pass
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results(self, mock_s3, mock_db, mock_statsd, mock_statsd_scoring):
+        bucket = FakeBucket()
+        mock_s3.return_value.get_bucket.return_value = bucket
+        results = ((u'col1', u'ö'), ((u'ä', u'b'), (u'c', u'd')))
+
+        link = self.grader.upload_results(results, "abc/foo.csv")
+
+        self.assertIn("https://s3.local/results/abc/foo.csv", link)
+        self.assertEquals(self.grader.csv_results(results),
+                          bucket.objects["results/abc/foo.csv"])
+
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results_sampled_rows(self, mock_s3, mock_db, mock_statsd, mock_statsd_scoring):
+        bucket = FakeBucket()
+        mock_s3.return_value.get_bucket.return_value = bucket
+        cursor = MagicMock(spec=Cursor)
+        cursor.fetchmany.side_effect = [((u'c',),), ()]
+        rows = SampledRows(((u'a',), (u'b',)), cursor)
+        put_to_s3 = self.grader.put_to_s3
+
+        def check_read(*args):
+            # The query has finished before the upload starts
+            self.assertTrue(cursor.close.called)
+            return put_to_s3(*args)
+
+        with patch.object(self.grader, 'put_to_s3', side_effect=check_read):
+            self.grader.upload_results(((u'col1',), rows), "abc/foo.csv")
+
+        self.assertEquals("col1\r\na\r\nb\r\nc\r\n",
+                          bucket.objects["results/abc/foo.csv"])
+        self.assertEquals(3, rows.total)
+
+    def test_upload_results_sampled_rows_error(self, mock_db, mock_statsd, mock_statsd_scoring):
+        cursor = MagicMock(spec=Cursor)
+        cursor.fetchmany.side_effect = MySQLdb.OperationalError(2013, 'Lost connection')
+        abandon = MagicMock()
+        rows = SampledRows(((u'a',),), cursor, abandon)
+
+        self.assertEquals(UPLOAD_FAILED_MESSAGE,
+                          self.grader.upload_results(((u'col1',), rows), "abc/foo.csv"))
+
+        # The rest of the result set is left to the connection to abandon
+        rows.close()
+        abandon.assert_called_once_with()
+        self.assertFalse(cursor.close.called)
+
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results_gzip(self, mock_s3, mock_db, mock_statsd, mock_statsd_scoring):
+        bucket = FakeBucket()
+        mock_s3.return_value.get_bucket.return_value = bucket
+        results = ((u'col1', u'ö'), ((u'ä', u'b'), (u'c', u'd')))
+        self.grader.s3_gzip = True
+
+        with patch('bux_sql_grader.mysql.statsd') as mysql_statsd:
+            self.grader.upload_results(results, "abc/foo.csv")
+
+        uploaded = bucket.objects["results/abc/foo.csv"]
+        self.assertEquals(self.grader.csv_results(results),
+                          gzip.GzipFile(fileobj=StringIO(uploaded)).read())
+        self.assertEquals({"Content-Encoding": "gzip", "Content-Type": "text/csv"},
+                          bucket.headers["results/abc/foo.csv"])
+        mysql_statsd.incr.assert_any_call('bux_sql_grader.upload_results.compressed_bytes',
+                                          len(uploaded))
+
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results_reuses_connection(self, mock_s3, mock_db, mock_statsd, mock_statsd_scoring):
+        mock_s3.return_value.get_bucket.return_value = FakeBucket()
+        results = ((u'col1',), ((u'a',),))
+
+        self.grader.upload_results(results, "abc/foo.csv")
+        self.grader.upload_results(results, "def/foo.csv")
+
+        self.assertEquals(1, mock_s3.call_count)
+        self.assertEquals(1, mock_s3.return_value.get_bucket.call_count)
+
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results_reconnects_after_failure(self, mock_s3, mock_db, mock_statsd, mock_statsd_scoring):
+        bucket = FakeBucket()
+        mock_s3.return_value.get_bucket.side_effect = [IOError("S3 is down"), bucket]
+        results = ((u'col1',), ((u'a',),))
+
+        self.assertEquals(UPLOAD_FAILED_MESSAGE,
+                          self.grader.upload_results(results, "abc/foo.csv"))
+        self.assertNotEquals(UPLOAD_FAILED_MESSAGE,
+                             self.grader.upload_results(results, "def/foo.csv"))
+        self.assertEquals(2, mock_s3.call_count)
+        self.assertIn("results/def/foo.csv", bucket.objects)
+
+    @patch('bux_sql_grader.background.statsd')
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results_async(self, mock_s3, mock_statsd_bg, mock_db, mock_statsd, mock_statsd_scoring):
+        bucket = FakeBucket()
+        mock_s3.return_value.get_bucket.return_value = bucket
+        results = ((u'col1',), ((u'a',),))
+        self.grader.s3_async = True
+
+        link = self.grader.upload_results(results, "abc/foo.csv")
+        self.assertIn("https://s3.local/results/abc/foo.csv", link)
+
+        self.grader.close_upload_queue()
+        self.assertEquals(self.grader.csv_results(results),
+                          bucket.objects["results/abc/foo.csv"])
+
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results_content_addressed(self, mock_s3, mock_db, mock_statsd, mock_statsd_scoring):
+        bucket = FakeBucket()
+        mock_s3.return_value.get_bucket.return_value = bucket
+        results = ((u'col1',), ((u'a',),))
+        self.grader.s3_content_addressed = True
+
+        first = self.grader.upload_results(results, "abc/foo.csv")
+        second = self.grader.upload_results(results, "def/incorrect-foo.csv")
+        other = self.grader.upload_results(((u'col1',), ((u'b',),)), "ghi/foo.csv")
+
+        self.assertEquals(first, second)
+        self.assertNotEquals(first, other)
+        self.assertIn("https://s3.local/results/shared/", first)
+        self.assertEquals(2, bucket.puts)
+        # Second upload of the same results is answered by the local index
+        self.assertEquals(2, bucket.heads)
+
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results_content_addressed_generates_csv_once(self, mock_s3, mock_db, mock_statsd, mock_statsd_scoring):
+        bucket = FakeBucket()
+        mock_s3.return_value.get_bucket.return_value = bucket
+        results = ((u'col1',), ((u'a',), (u'b',)))
+        self.grader.s3_content_addressed = True
+
+        with patch.object(self.grader, 'format_csv_col',
+                          wraps=self.grader.format_csv_col) as format_col:
+            self.grader.upload_results(results, "abc/foo.csv")
+
+        self.assertEquals(3, format_col.call_count)
+        self.assertEquals(["a\r\nb\r\n"],
+                          [value.split("\r\n", 1)[1] for value in bucket.objects.values()])
+
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results_content_addressed_existing_object(self, mock_s3, mock_db, mock_statsd, mock_statsd_scoring):
+        bucket = FakeBucket()
+        mock_s3.return_value.get_bucket.return_value = bucket
+        results = ((u'col1',), ((u'a',),))
+        self.grader.s3_content_addressed = True
+
+        self.grader.upload_results(results, "abc/foo.csv")
+        self.grader._s3_index.clear()
+        self.grader.upload_results(results, "def/foo.csv")
+
+        self.assertEquals(1, bucket.puts)
+        self.assertEquals(2, bucket.heads)
+
+    def test_upload_results_local_storage(self, mock_db, mock_statsd, mock_statsd_scoring):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(storage="local", storage_root=root,
+                                storage_url="http://localhost/results/",
+                                **CONFIG)
+        results = ((u'col1',), ((u'a',),))
+
+        link = grader.upload_results(results, "abc/foo.csv")
+
+        self.assertIn("http://localhost/results/results/abc/foo.csv", link)
+        with open(os.path.join(root, "results", "abc", "foo.csv")) as f:
+            self.assertEquals(grader.csv_results(results), f.read())
+
+    def test_unknown_storage_backend(self, mock_db, mock_statsd, mock_statsd_scoring):
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        self.assertRaises(ImproperlyConfiguredGrader, MySQLEvaluator,
+                          storage="ftp", **CONFIG)
+
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results_failure(self, mock_s3, mock_db, mock_statsd, mock_statsd_scoring):
+        mock_s3.return_value.get_bucket.side_effect = IOError("S3 is down")
+        results = ((u'col1',), ((u'a',),))
+
+        link = self.grader.upload_results(results, "abc/foo.csv")
+
+        self.assertEquals(UPLOAD_FAILED_MESSAGE, link)
+
+    @patch('bux_sql_grader.storage.S3Connection')
+    def test_upload_results_circuit_breaker(self, mock_s3, mock_db, mock_statsd, mock_statsd_scoring):
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(s3_breaker_threshold=2, s3_breaker_reset=60,
+                                **CONFIG)
+        mock_s3.return_value.get_bucket.side_effect = IOError("S3 is down")
+        results = ((u'col1',), ((u'a',),))
+
+        for i in range(3):
+            self.assertEquals(UPLOAD_FAILED_MESSAGE,
+                              grader.upload_results(results, "abc/foo.csv"))
+
+        # The third upload was skipped without contacting S3
+        self.assertEquals(2, mock_s3.return_value.get_bucket.call_count)
+
+        # After the cool-off a probe upload closes the circuit again
+        mock_s3.return_value.get_bucket.side_effect = None
+        mock_s3.return_value.get_bucket.return_value = FakeBucket()
+        grader.upload_breaker.opened_at -= 60
+        self.assertNotEquals(UPLOAD_FAILED_MESSAGE,
+                             grader.upload_results(results, "abc/foo.csv"))
+        self.assertEquals("closed", grader.upload_breaker.state)
+
+    def test_upload_results_deadline(self, mock_db, mock_statsd, mock_statsd_scoring):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        storage = MagicMock(spec=BaseStorage)
+        storage.stream.side_effect = lambda *args: release.wait()
+        CONFIG = dict(MYSQL_CONFIG.items() + S3_CONFIG.items())
+        grader = MySQLEvaluator(storage=storage, s3_upload_deadline=0.05,
+                                **CONFIG)
+        results = ((u'col1',), ((u'a',),))
+
+        self.assertEquals(UPLOAD_FAILED_MESSAGE,
+                          grader.upload_results(results, "abc/foo.csv"))
+        self.assertTrue(storage.reset.called)
 
     def test_enforce_sql_select_limit_ignores_legal_limits(self, mock_db, mock_statsd, mock_statsd_scoring):
         query = u"SELECT * FROM foo LIMIT 10"
@@ -368,6 +968,84 @@ SELECT * FROM foo LIMIT 10000"""
     def test_build_response(self, mock_db, mock_statsd, mock_statsd_scoring):
         pass
 
+    def test_build_response_caches_grader_html(self, mock_db, mock_statsd, mock_statsd_scoring):
+        student_results = ((u'col1',), ((u'a',),))
+        grader_results = ((u'col1',), ((u'b',),))
+        answer_key = ("foo", "SELECT * FROM foo")
+        self.grader.html_results = MagicMock(return_value=u"<table />")
+
+        for i in range(3):
+            response = self.grader.build_response(correct=False,
+                                                  score=0.0,
+                                                  hints=[],
+                                                  student_results=student_results,
+                                                  grader_results=grader_results,
+                                                  grader_warnings=["Incomplete"],
+                                                  row_limit=10,
+                                                  answer_key=answer_key)
+            self.assertIn("Incomplete", response["msg"])
+
+        # Student table is rendered every time, grader table only once
+        self.assertEquals(4, self.grader.html_results.call_count)
+
+        # Reloading the dataset changes the grader results
+        self.grader.build_response(correct=False, score=0.0, hints=[],
+                                   student_results=student_results,
+                                   grader_results=((u'col1',), ((u'c',),)),
+                                   row_limit=10, answer_key=answer_key)
+        self.assertEquals(6, self.grader.html_results.call_count)
+
+    def test_build_response_max_response_bytes(self, mock_db, mock_statsd, mock_statsd_scoring):
+        student_results = ((u'col1',), tuple((u'a' * 100,) for i in range(1000)))
+        grader_results = ((u'col1',), tuple((u'b' * 100,) for i in range(1000)))
+        self.grader.max_response_bytes = 20000
+
+        response = self.grader.build_response(correct=False,
+                                              score=0.0,
+                                              hints=["Too many rows."],
+                                              student_results=student_results,
+                                              grader_results=grader_results)
+
+        self.assertTrue(len(response["msg"]) <= 20000)
+        self.assertIn("Too many rows.", response["msg"])
+        self.assertNotIn("Showing 1000 of 1000 rows", response["msg"])
+
+    def test_build_response_max_response_bytes_messages(self, mock_db, mock_statsd, mock_statsd_scoring):
+        student_results = ((u'col1',), ((u'a',),))
+        grader_results = ((u'col1',), ((u'b',),))
+        self.grader.max_response_bytes = 4000
+
+        response = self.grader.build_response(correct=False,
+                                              score=0.0,
+                                              hints=[u"h" * 5000, u"Too many rows."],
+                                              student_results=student_results,
+                                              student_warnings=["w" * 5000],
+                                              grader_results=grader_results,
+                                              grader_warnings=["g" * 5000])
+
+        self.assertTrue(len(response["msg"]) <= 4000)
+        self.assertIn("1 more not shown.", response["msg"])
+        self.assertIn("Showing 1 of 1 row.", response["msg"])
+
+    def test_html_results_dropped_for_size(self, mock_db, mock_statsd, mock_statsd_scoring):
+        results = ((u'col1',), tuple((u'a' * 100,) for i in range(20)))
+
+        html = self.grader.html_results(results, 10, 1000)
+        self.assertTrue(len(html) <= 1000)
+        self.assertRegexpMatches(html, r"Showing \d of 20 rows\. "
+                                       r"\d more rows left out to fit the size limit\.")
+
+        self.assertEquals("<p><small>Results too large to display.</small></p>",
+                          self.grader.html_results(results, 10, 100))
+        self.assertEquals("", self.grader.html_results(results, 10, 10))
+
+    def test_html_results_max_cell_chars(self, mock_db, mock_statsd, mock_statsd_scoring):
+        results = ((u'col1',), ((u'a' * 100,), (u'b',)))
+        self.grader.max_cell_chars = 10
+
+        html = self.grader.html_results(results)
+        self.assertIn("Showing 2 of 2 rows. 1 long value shortened.", html)
+
     def test_parse_grader_payload(self, mock_db, mock_statsd, mock_statsd_scoring):
         payload = DUMMY_SUBMISSION['xqueue_body']['grader_payload']
 
@@ -407,4 +1085,20 @@ SELECT * FROM foo LIMIT 10000"""
         pass
 
     def test_html_results(self, mock_db, mock_statsd, mock_statsd_scoring):
-        pass
+        results = ((u'col1',), ((u'a',), (None,), (u'<c>',), (u'd',)))
+
+        html = self.grader.html_results(results, 3)
+        self.assertIn(u"<tr><td>NULL</td></tr><tr><td>&lt;c&gt;</td></tr>", html)
+        self.assertNotIn(u"<td>d</td>", html)
+        self.assertIn("Showing 3 of 4 rows", html)
+
+    def test_html_results_format_html_col(self, mock_db, mock_statsd, mock_statsd_scoring):
+        results = ((u'col1',), ((u'a',), (None,)))
+        with patch.object(self.grader, 'format_html_col', lambda col: u"<%s>" % col):
+            html = self.grader.html_results(results)
+        self.assertIn(u"<tr><th><col1></th></tr>", html)
+        self.assertIn(u"<tr><td><a></td></tr><tr><td><None></td></tr>", html)
+
+    def test_html_results_no_rows(self, mock_db, mock_statsd, mock_statsd_scoring):
+        html = self.grader.html_results(((u'col1',), ()))
+        self.assertEquals("<pre><code>No rows found.</code></pre>", html)
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from bux_sql_grader.profiling import EvaluationProfiler
+
+
+@patch('bux_sql_grader.profiling.statsd')
+class TestEvaluationProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_saves_slow_calls(self, mock_statsd):
+        profiler = EvaluationProfiler(self.root, threshold=0)
+
+        self.assertEquals(6, profiler.profile("123-abc", sum, [1, 2, 3]))
+        files = os.listdir(self.root)
+        self.assertEquals(1, len(files))
+        self.assertTrue(files[0].endswith("-123-abc.prof"))
+        mock_statsd.incr.assert_called_with('bux_sql_grader.profile.saved')
+
+    def test_skips_fast_calls(self, mock_statsd):
+        profiler = EvaluationProfiler(self.root, threshold=60)
+
+        profiler.profile("123-abc", sum, [1, 2, 3])
+        self.assertEquals([], os.listdir(self.root))
+
+    def test_saves_slow_failures(self, mock_statsd):
+        profiler = EvaluationProfiler(self.root, threshold=0)
+
+        self.assertRaises(ValueError, profiler.profile, "123-abc", int, "x")
+        self.assertEquals(1, len(os.listdir(self.root)))
+
+    @patch('bux_sql_grader.profiling.time')
+    def test_keeps_newest_profiles(self, mock_time, mock_statsd):
+        profiler = EvaluationProfiler(self.root, threshold=0, keep=2)
+
+        for now in (1000000001, 1000000002, 1000000003):
+            mock_time.time.return_value = now
+            profiler.profile(str(now), sum, [])
+
+        self.assertEquals(["1000000002-1000000002.prof",
+                           "1000000003-1000000003.prof"],
+                          sorted(os.listdir(self.root)))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from bux_sql_grader.rendering import (escape_html, fit_messages, html_size,
+                                      render_table, row_template)
+
+
+class TestRendering(unittest.TestCase):
+
+    def test_escape_html(self):
+        self.assertEquals(u"a &amp; b &lt;c&gt;", escape_html(u"a & b <c>"))
+        self.assertEquals(u"plain", escape_html(u"plain"))
+
+    def test_escape_html_null(self):
+        self.assertEquals(u"NULL", escape_html(None))
+
+    def test_escape_html_coerces_values(self):
+        self.assertEquals(u"2010", escape_html(2010L))
+        self.assertEquals(u"1.5", escape_html(1.5))
+        self.assertEquals(u"ä", escape_html(u"ä"))
+
+    def test_row_template(self):
+        self.assertEquals(u"<tr><td>%s</td><td>%s</td></tr>",
+                          row_template(u"td", 2))
+
+    def test_render_table(self):
+        results = ((u'col1', u'<b>'), ((u'a', None), (u'c', 1L)))
+        expected = (u"<pre><code><table><thead>"
+                    u"<tr><th>col1</th><th>&lt;b&gt;</th></tr>"
+                    u"</thead><tbody>"
+                    u"<tr><td>a</td><td>NULL</td></tr>"
+                    u"<tr><td>c</td><td>1</td></tr>"
+                    u"</tbody></table></code></pre>")
+        self.assertEquals((expected, 2, 0), render_table(*results))
+
+    def test_render_table_row_limit(self):
+        rows = tuple((unicode(i),) for i in range(5))
+        html, displayed, truncated = render_table((u'col1',), rows, 3)
+        self.assertEquals(3, displayed)
+        self.assertEquals(3, html.count(u"<td>"))
+
+    def test_render_table_ragged_rows(self):
+        html, displayed, truncated = render_table((u'col1',), ((u'a', u'b'),))
+        self.assertIn(u"<tr><td>a</td><td>b</td></tr>", html)
+
+    def test_render_table_byte_budget(self):
+        rows = tuple((u"ä" * 10,) for i in range(100))
+        html, displayed, truncated = render_table((u'col1',), rows,
+                                                  byte_budget=1000)
+        self.assertTrue(0 < displayed < 100)
+        self.assertTrue(html_size(html) <= 1000)
+        self.assertEquals(displayed, html.count(u"<td>"))
+
+    def test_render_table_budget_matches_unbudgeted_output(self):
+        rows = tuple((unicode(i), None) for i in range(10))
+        self.assertEquals(render_table((u'a', u'b'), rows),
+                          render_table((u'a', u'b'), rows, byte_budget=10000))
+
+    def test_render_table_exhausted_budget(self):
+        html, displayed, truncated = render_table((u'col1',), ((u'a',),),
+                                                  byte_budget=0)
+        self.assertEquals(0, displayed)
+
+    def test_render_table_max_cell_chars(self):
+        rows = ((u"abcdefgh", u"ab"), (u"<<<<<<", None))
+        html, displayed, truncated = render_table((u'col1', u'col2'), rows,
+                                                  max_cell_chars=4)
+        self.assertEquals(2, truncated)
+        self.assertIn(u"<td>abcd\u2026</td><td>ab</td>", html)
+        self.assertIn(u"<td>&lt;&lt;&lt;&lt;\u2026</td><td>NULL</td>", html)
+
+    def test_fit_messages(self):
+        def render(messages):
+            return u"<p>%s</p>" % u"</p><p>".join(messages)
+        messages = [u"a" * 10, u"b" * 10, u"c" * 10]
+
+        self.assertEquals(render(messages), fit_messages(render, messages))
+        self.assertEquals(u"<p>aaaaaaaaaa</p><p>2 more not shown.</p>",
+                          fit_messages(render, messages, 45))
+
+    def test_fit_messages_shortens_first_message(self):
+        def render(messages):
+            return u"<p>%s</p>" % u"</p><p>".join(messages)
+
+        html = fit_messages(render, [u"\xe4" * 100], 50)
+        self.assertTrue(html_size(html) <= 50)
+        self.assertTrue(html.startswith(u"<p>\xe4\xe4"))
+        self.assertTrue(html.endswith(u"\u2026</p>"))
+        self.assertEquals(u"", fit_messages(render, [u"abc"], 5))
@@ -0,0 +1,61 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from bux_sql_grader.history import query_fingerprint
+from bux_sql_grader.slowlog import SlowEvaluationLog
+from bux_sql_grader.timing import EvaluationTiming
+
+
+class TestSlowEvaluationLog(unittest.TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.path = os.path.join(root, "slow.log")
+
+    def make_timing(self, elapsed, execute=0, fetch=0):
+        timing = EvaluationTiming(123)
+        timing.describe("foo", u"SELECT * FROM foo")
+        timing.add("execute", execute)
+        timing.add("fetch", fetch)
+        timing.count("student_rows", 10)
+        timing.elapsed = elapsed
+        return timing
+
+    def test_is_slow(self):
+        slow_log = SlowEvaluationLog(self.path, threshold=5, query_threshold=2)
+
+        self.assertFalse(slow_log.is_slow(self.make_timing(4, 1, 0.5)))
+        self.assertTrue(slow_log.is_slow(self.make_timing(5)))
+        self.assertTrue(slow_log.is_slow(self.make_timing(3, 1, 1)))
+
+    def test_record(self):
+        slow_log = SlowEvaluationLog(self.path)
+        explain = [{u"table": u"foo", u"rows": 100}]
+
+        slow_log.record(self.make_timing(6, 1, 2), explain)
+        slow_log.record(self.make_timing(7))
+        slow_log.handler.close()
+
+        with open(self.path) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEquals(2, len(entries))
+        self.assertEquals(query_fingerprint(u"SELECT * FROM foo"),
+                          entries[0]["fingerprint"])
+        self.assertEquals("foo", entries[0]["database"])
+        self.assertEquals(u"SELECT * FROM foo", entries[0]["query"])
+        self.assertEquals({"student_rows": 10}, entries[0]["counts"])
+        self.assertEquals({"execute": 1000, "fetch": 2000},
+                          entries[0]["phases_ms"])
+        self.assertEquals(explain, entries[0]["explain"])
+        self.assertNotIn("explain", entries[1])
+
+    def test_needs_explain_once(self):
+        slow_log = SlowEvaluationLog(self.path)
+
+        self.assertTrue(slow_log.needs_explain("abc"))
+        self.assertFalse(slow_log.needs_explain("abc"))
+        self.assertTrue(slow_log.needs_explain("def"))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from bux_grader_framework.exceptions import ImproperlyConfiguredGrader
+from bux_sql_grader.mysql import InvalidQuery, PartialRows
+from bux_sql_grader.sqlite import SQLiteEvaluator, dialect_note
+
+SUBMISSION = {
+    "xqueue_header": {
+        "submission_id": 123,
+        "submission_key": "abc"
+    },
+    "xqueue_body": {
+        "student_response": "SELECT * FROM foo",
+        "student_info": {},
+        "grader_payload": {
+            "database": "foo",
+            "answer": "SELECT id, name FROM foo",
+            "row_limit": 10
+        }
+    }
+}
+
+
+@patch('bux_sql_grader.sqlite.statsd')
+@patch('bux_sql_grader.mysql.statsd')
+@patch('bux_sql_grader.scoring.statsd')
+class TestSQLiteEvaluator(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        db = sqlite3.connect(os.path.join(self.root, "foo.sqlite"))
+        db.execute("CREATE TABLE foo (id INTEGER, name TEXT)")
+        db.executemany("INSERT INTO foo VALUES (?, ?)",
+                       [(1, u"a"), (2, u"b"), (3, u"ç")])
+        db.commit()
+        db.close()
+
+        self.grader = SQLiteEvaluator(self.root, database="foo",
+                                      s3_upload=False)
+
+    def test_execute_query(self, *mocks):
+        db = self.grader.db_connect("foo")
+        results = self.grader.execute_query(db, "SELECT name, id FROM foo ORDER BY id")
+        self.assertEquals(((u"name", u"id"),
+                           ((u"a", 1), (u"b", 2), (u"ç", 3))), results)
+
+    def test_execute_query_select_limit(self, *mocks):
+        self.grader.select_limit = 2
+        db = self.grader.db_connect("foo")
+        cols, rows = self.grader.execute_query(db, "SELECT * FROM foo")
+        self.assertEquals(2, len(rows))
+
+    def test_execute_query_max_result_bytes(self, *mocks):
+        self.grader.max_result_bytes = 20
+        db = self.grader.db_connect("foo")
+        cols, rows = self.grader.execute_query(db, "SELECT * FROM foo")
+        self.assertEquals(((1, u"a"), (2, u"b")), rows)
+        self.assertTrue(isinstance(rows, PartialRows))
+
+    def test_execute_query_read_only(self, *mocks):
+        db = self.grader.db_connect("foo")
+        for stmt in ("DELETE FROM foo",
+                     "DROP TABLE foo",
+                     "PRAGMA query_only = OFF",
+                     "ATTACH DATABASE 'bar.sqlite' AS bar"):
+            self.assertRaises(InvalidQuery, self.grader.execute_query, db, stmt)
+
+        cols, rows = self.grader.execute_query(db, "SELECT * FROM foo")
+        self.assertEquals(3, len(rows))
+        self.assertFalse(os.path.exists(os.path.join(self.root, "bar.sqlite")))
+
+    def test_execute_query_timeout(self, *mocks):
+        self.grader.query_timeout = 0.01
+        db = self.grader.db_connect("foo")
+        stmt = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n"
+
+        with self.assertRaises(InvalidQuery) as cm:
+            self.grader.execute_query(db, stmt)
+        self.assertIn("time limit", str(cm.exception))
+
+    def test_execute_query_dialect_note(self, *mocks):
+        db = self.grader.db_connect("foo")
+
+        with self.assertRaises(InvalidQuery) as cm:
+            self.grader.execute_query(db, "SHOW TABLES")
+        self.assertIn("doesn't support SHOW and DESCRIBE", str(cm.exception))
+
+    def test_dialect_note(self, *mocks):
+        self.assertEquals(None, dialect_note("SELECT name FROM foo WHERE id > 1"))
+        self.assertIn("CONCAT()", dialect_note("SELECT CONCAT(name, 'x') FROM foo"))
+        self.assertIn("REGEXP", dialect_note("SELECT * FROM foo WHERE name REGEXP 'a'"))
+
+    def test_db_connect_per_thread(self, *mocks):
+        db = self.grader.db_connect("foo")
+        self.assertTrue(db is self.grader.db_connect("foo"))
+
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(self.grader.db_connect("foo")))
+        thread.start()
+        thread.join()
+        self.assertFalse(db is other[0])
+
+    def test_db_connect_missing_database(self, *mocks):
+        self.assertRaises(ImproperlyConfiguredGrader,
+                          self.grader.db_connect, "bar")
+        self.assertRaises(ImproperlyConfiguredGrader,
+                          self.grader.db_connect, "../foo")
+        self.assertFalse(os.path.exists(os.path.join(self.root, "bar.sqlite")))
+
+    def test_evaluate(self, *mocks):
+        response = self.grader.evaluate(SUBMISSION)
+        self.assertTrue(response["correct"])
+        self.assertIn(u"Showing 3 of 3 rows.", response["msg"])
+
+    def test_explain_query(self, *mocks):
+        plan = self.grader.explain_query("foo", "SELECT * FROM foo;")
+        self.assertEquals(1, len(plan))
+        self.assertEquals(None, self.grader.explain_query("foo", "DELETE FROM foo"))
+
+    def test_status(self, *mocks):
+        self.assertTrue(self.grader.status())
+        self.assertFalse(SQLiteEvaluator(self.root, database="bar").status())
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from bux_sql_grader.storage import LocalStorage, S3Storage
+
+from .test_streaming import FakeBucket
+
+
+class TestLocalStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.storage = LocalStorage(self.root, "http://localhost/files/")
+
+    def test_stream(self):
+        size = self.storage.stream("results/abc/foo.csv", ["a,b\r\n", "c,d\r\n"])
+
+        self.assertEquals(10, size)
+        with open(os.path.join(self.root, "results", "abc", "foo.csv")) as f:
+            self.assertEquals("a,b\r\nc,d\r\n", f.read())
+
+    def test_stream_replaces_atomically(self):
+        self.storage.put("foo.csv", "old")
+
+        def chunks():
+            yield "new"
+            raise IOError("boom")
+
+        self.assertRaises(IOError, self.storage.stream, "foo.csv", chunks())
+
+        # Failed writes leave the previous object and no temporary files
+        self.assertEquals(["foo.csv"], os.listdir(self.root))
+        with open(os.path.join(self.root, "foo.csv")) as f:
+            self.assertEquals("old", f.read())
+
+    def test_exists(self):
+        self.assertFalse(self.storage.exists("foo.csv"))
+        self.storage.put("foo.csv", "a")
+        self.assertTrue(self.storage.exists("foo.csv"))
+
+    def test_url(self):
+        self.assertEquals("http://localhost/files/results/a%20b.csv",
+                          self.storage.url("results/a b.csv"))
+
+    def test_url_filename(self):
+        self.storage.put("shared/abc.csv", "a,b")
+
+        url = self.storage.url("shared/abc.csv", filename="incorrect-foo.csv")
+        self.assertEquals("http://localhost/files/shared/abc/incorrect-foo.csv", url)
+        with open(os.path.join(self.root, "shared", "abc", "incorrect-foo.csv")) as f:
+            self.assertEquals("a,b", f.read())
+
+        # Links are reused
+        self.assertEquals(url, self.storage.url("shared/abc.csv",
+                                                filename="incorrect-foo.csv"))
+        self.assertEquals("http://localhost/files/shared/abc.csv",
+                          self.storage.url("shared/abc.csv", filename="abc.csv"))
+
+    def test_rejects_names_outside_root(self):
+        self.assertRaises(ValueError, self.storage.put, "../foo.csv", "a")
+
+
+@patch('bux_sql_grader.storage.statsd')
+@patch('bux_sql_grader.storage.S3Connection')
+class TestS3Storage(unittest.TestCase):
+
+    def test_stream(self, mock_s3, mock_statsd):
+        bucket = FakeBucket()
+        mock_s3.return_value.get_bucket.return_value = bucket
+        storage = S3Storage("foo", "abc", "123")
+
+        self.assertEquals(3, storage.put("results/foo.csv", "a,b"))
+        self.assertEquals("a,b", bucket.objects["results/foo.csv"])
+        self.assertTrue(storage.exists("results/foo.csv"))
+        self.assertFalse(storage.exists("results/bar.csv"))
+        self.assertEquals("https://s3.local/results/foo.csv",
+                          storage.url("results/foo.csv"))
+        mock_s3.assert_called_once_with("abc", "123")
+
+    def test_reset_reconnects(self, mock_s3, mock_statsd):
+        mock_s3.return_value.get_bucket.return_value = FakeBucket()
+        storage = S3Storage("foo")
+
+        storage.put("foo.csv", "a")
+        storage.reset()
+        storage.put("foo.csv", "b")
+
+        self.assertEquals(2, mock_s3.call_count)
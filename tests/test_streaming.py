@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import hashlib
+import unittest
+
+from StringIO import StringIO
+
+from bux_sql_grader.streaming import (GzipStream, SpooledChunks, iter_csv,
+                                      upload_chunks)
+
+
+class FakeKey(object):
+    """ Stands in for ``boto.s3.key.Key`` """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def set_contents_from_string(self, contents, headers=None, replace=True):
+        self.bucket.puts += 1
+        self.bucket.objects[self.name] = contents
+        self.bucket.headers[self.name] = headers
+
+    def generate_url(self, expires_in, response_headers=None):
+        return "https://s3.local/%s" % self.name
+
+
+class FakeMultiPartUpload(object):
+    """ Stands in for ``boto.s3.multipart.MultiPartUpload`` """
+
+    def __init__(self, bucket, name, headers):
+        self.bucket = bucket
+        self.name = name
+        self.headers = headers
+        self.parts = {}
+        self.cancelled = False
+
+    def upload_part_from_file(self, fp, part_num):
+        self.parts[part_num] = fp.read()
+        self.bucket.max_part = max(self.bucket.max_part,
+                                   len(self.parts[part_num]))
+
+    def complete_upload(self):
+        self.bucket.objects[self.name] = "".join(
+            self.parts[num] for num in sorted(self.parts))
+        self.bucket.headers[self.name] = self.headers
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
+class FakeBucket(object):
+    """ An in-memory stand-in for ``boto.s3.bucket.Bucket`` """
+
+    def __init__(self):
+        self.objects = {}
+        self.headers = {}
+        self.uploads = []
+        self.puts = 0
+        self.heads = 0
+        self.max_part = 0
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def get_key(self, name):
+        self.heads += 1
+        if name in self.objects:
+            return FakeKey(self, name)
+        return None
+
+    def initiate_multipart_upload(self, name, headers=None):
+        upload = FakeMultiPartUpload(self, name, headers)
+        self.uploads.append(upload)
+        return upload
+
+
+def make_rows(count):
+    return tuple((unicode(i), u"ä" * 20, None) for i in range(count))
+
+
+class TestIterCSV(unittest.TestCase):
+
+    def test_iter_csv(self):
+        results = ((u'col1', u'ö'), ((u'ä', None), (u'c', 1L)))
+        expected = 'col1,\xc3\xb6\r\n\xc3\xa4,\r\nc,1\r\n'
+        self.assertEquals(expected, "".join(iter_csv(results)))
+
+    def test_iter_csv_chunks(self):
+        results = ((u'a', u'b', u'c'), make_rows(1000))
+        chunks = list(iter_csv(results, chunk_size=1024))
+
+        self.assertTrue(len(chunks) > 1)
+        # Chunks only overrun the target size by the length of one row
+        self.assertTrue(all(len(chunk) < 1024 + 100 for chunk in chunks))
+        self.assertEquals(1001, "".join(chunks).count("\r\n"))
+
+
+class TestSpooledChunks(unittest.TestCase):
+
+    def test_spooled_chunks(self):
+        results = ((u'a', u'b', u'c'), make_rows(100))
+        spooled = SpooledChunks(iter_csv(results, chunk_size=16), max_size=64,
+                                chunk_size=100)
+
+        expected = hashlib.sha256("".join(iter_csv(results))).hexdigest()
+        self.assertEquals(expected, spooled.digest)
+        self.assertEquals("".join(iter_csv(results)), "".join(spooled))
+        # Can be read back more than once (e.g. for upload retries)
+        self.assertEquals(spooled.size, len("".join(spooled)))
+        spooled.close()
+
+    def test_digest_ignores_chunking(self):
+        results = ((u'a', u'b', u'c'), make_rows(100))
+        spooled = SpooledChunks(iter_csv(results))
+        rechunked = SpooledChunks(iter_csv(results, chunk_size=16))
+
+        self.assertEquals(spooled.digest, rechunked.digest)
+        spooled.close()
+        rechunked.close()
+
+
+class TestGzipStream(unittest.TestCase):
+
+    def test_gzip_stream(self):
+        results = ((u'a', u'b', u'c'), make_rows(1000))
+        expected = "".join(iter_csv(results))
+
+        stream = GzipStream(iter_csv(results, chunk_size=1024))
+        compressed = "".join(stream)
+
+        self.assertEquals(expected, gzip.GzipFile(fileobj=StringIO(compressed)).read())
+        self.assertEquals(len(expected), stream.raw_bytes)
+        self.assertEquals(len(compressed), stream.compressed_bytes)
+        self.assertTrue(stream.compressed_bytes < stream.raw_bytes)
+
+
+class TestUploadChunks(unittest.TestCase):
+
+    def test_small_upload_uses_single_put(self):
+        bucket = FakeBucket()
+        key, size = upload_chunks(bucket, "results/foo.csv", ["a,b\r\n", "c,d\r\n"])
+
+        self.assertEquals("results/foo.csv", key.name)
+        self.assertEquals(10, size)
+        self.assertEquals("a,b\r\nc,d\r\n", bucket.objects["results/foo.csv"])
+        self.assertEquals(1, bucket.puts)
+        self.assertEquals([], bucket.uploads)
+
+    def test_large_upload_uses_multipart(self):
+        bucket = FakeBucket()
+        results = ((u'a', u'b', u'c'), make_rows(5000))
+        expected = "".join(iter_csv(results))
+
+        key, size = upload_chunks(bucket, "foo.csv",
+                                  iter_csv(results, chunk_size=1024),
+                                  part_size=16 * 1024)
+
+        self.assertEquals(expected, bucket.objects["foo.csv"])
+        self.assertEquals(len(expected), size)
+        self.assertEquals(0, bucket.puts)
+        self.assertEquals(1, len(bucket.uploads))
+        self.assertTrue(len(bucket.uploads[0].parts) > 1)
+        # Memory is bounded by part size + chunk size
+        self.assertTrue(bucket.max_part < 16 * 1024 + 1024 + 100)
+
+    def test_failed_multipart_upload_is_cancelled(self):
+        bucket = FakeBucket()
+
+        def chunks():
+            yield "a" * 32
+            yield "b" * 32
+            raise IOError("boom")
+
+        self.assertRaises(IOError, upload_chunks, bucket, "foo.csv", chunks(),
+                          part_size=16)
+        self.assertTrue(bucket.uploads[0].cancelled)
+        self.assertNotIn("foo.csv", bucket.objects)
@@ -0,0 +1,58 @@
+import json
+import logging
+import unittest
+
+from mock import MagicMock, patch
+
+from bux_sql_grader.timing import EvaluationTiming, LogTimingSink, NULL_TIMING
+
+
+@patch('bux_sql_grader.timing.clock')
+class TestEvaluationTiming(unittest.TestCase):
+
+    def test_spans_add_up(self, mock_clock):
+        mock_clock.side_effect = [0, 1, 1.5, 2, 2.25, 3]
+        timing = EvaluationTiming(123)
+
+        with timing.span("execute"):
+            pass
+        with timing.span("execute"):
+            pass
+        timing.finish()
+
+        self.assertEquals({"execute": 0.75}, timing.phases)
+        self.assertEquals(3, timing.elapsed)
+
+    def test_as_dict(self, mock_clock):
+        mock_clock.side_effect = [0, 0.5]
+        timing = EvaluationTiming(123)
+        timing.add("connect", 0.0025)
+        timing.count("student_rows", 10)
+        timing.flag("answer_cache.grader_results", True)
+        timing.finish()
+
+        self.assertEquals({"submission_id": 123,
+                           "database": None,
+                           "total_ms": 500.0,
+                           "phases_ms": {"connect": 2.5},
+                           "counts": {"student_rows": 10},
+                           "flags": {"answer_cache.grader_results": True}},
+                          timing.as_dict())
+
+    def test_null_timing(self, mock_clock):
+        with NULL_TIMING.span("execute"):
+            NULL_TIMING.count("student_rows", 10)
+        self.assertFalse(mock_clock.called)
+
+
+class TestLogTimingSink(unittest.TestCase):
+
+    def test_logs_json_line(self):
+        logger = MagicMock()
+        logger.isEnabledFor.return_value = True
+        sink = LogTimingSink(logger, logging.WARNING)
+
+        sink({"submission_id": 123})
+
+        logger.log.assert_called_with(logging.WARNING, "Evaluation timing: %s",
+                                      json.dumps({"submission_id": 123}))
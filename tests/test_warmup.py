@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from mock import patch
+
+from bux_sql_grader.sqlite import SQLiteEvaluator
+from bux_sql_grader.warmup import load_manifest, warm_answers
+
+
+class TestLoadManifest(unittest.TestCase):
+
+    def test_load_manifest(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        payload = {"answer": "SELECT * FROM foo", "database": "foo"}
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(payload) + "\n")
+            f.write("\n")
+            f.write(json.dumps({"problem": "p2", "grader_payload": payload}) + "\n")
+            f.write(json.dumps({"grader_payload": json.dumps(payload)}) + "\n")
+
+        self.assertEquals([("problem-1", payload), ("p2", payload),
+                           ("problem-4", payload)],
+                          load_manifest(path))
+
+
+@patch('bux_sql_grader.sqlite.statsd')
+@patch('bux_sql_grader.mysql.statsd')
+class TestWarmAnswers(unittest.TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+
+        db = sqlite3.connect(os.path.join(root, "foo.sqlite"))
+        db.execute("CREATE TABLE foo (id INTEGER, name TEXT)")
+        db.executemany("INSERT INTO foo VALUES (?, ?)", [(1, u"ab"), (2, u"cd")])
+        db.commit()
+        db.close()
+
+        self.evaluator = SQLiteEvaluator(root, database="foo", s3_upload=False)
+
+    def test_warm_answers(self, *mocks):
+        problems = [("p1", {"answer": "SELECT * FROM foo", "row_limit": 5}),
+                    ("p2", {"answer": "SELECT * FROM bar"}),
+                    ("p3", {})]
+
+        reports = warm_answers(self.evaluator, problems, workers=2)
+
+        self.assertEquals(["p1", "p2", "p3"], [r["problem"] for r in reports])
+        self.assertEquals((2, 20, None), (reports[0]["rows"], reports[0]["bytes"],
+                                          reports[0]["error"]))
+        self.assertIn("no such table", reports[1]["error"])
+        self.assertEquals((0, None), (reports[2]["rows"], reports[2]["error"]))
+
+        html = self.evaluator.answer_cache.get("foo", "SELECT * FROM foo",
+                                               ("grader_results", 5))
+        self.assertIn("Showing 2 of 2 rows.", html)
+
+    def test_warm_answers_without_rendering(self, *mocks):
+        problems = [("p1", {"answer": "SELECT * FROM foo", "row_limit": 5})]
+
+        reports = warm_answers(self.evaluator, problems, render=False)
+
+        self.assertEquals(2, reports[0]["rows"])
+        self.assertEquals(None, self.evaluator.answer_cache.get(
+            "foo", "SELECT * FROM foo", ("grader_results", 5)))